@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Cache value encoding benchmark - compares the size of the GeoIP data and Reverse DNS hostnames cached in Redis,
+and the time to decode them on a cache hit, between the older formats (pickled JSON text / tuples) and the compact
+binary layout from :mod:`myip.codec` (pickled bytes), for a sample of addresses from the GeoIP2 databases.
+
+Sizes are of the pickled values, as stored by :class:`privex.helpers.cache.RedisCache` (``use_pickle=True``).
+
+Usage (from the repository root, with the GeoIP2 databases installed)::
+
+    python -m benchmarks.cache_codec
+    python -m benchmarks.cache_codec -c 5000 -n 20
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import argparse
+import json
+import os
+import pickle
+import random
+import sys
+import time
+from ipaddress import IPv4Address, IPv6Address
+
+os.environ.setdefault('CACHE_ADAPTER', 'memory')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+import geoip2.errors
+from privex.helpers import DictObject
+
+from myip import app as myip_app, settings
+from myip.codec import decode_geo, decode_rdns, encode_geo, encode_rdns
+
+
+def sample(count: int, seed: int):
+    """The safe form GeoIP data for ``count`` random IPv4 / IPv6 addresses which are in the GeoIP2 databases"""
+    rand, res = random.Random(seed), []
+    for _ in range(count * 1000):
+        if len(res) >= count:
+            break
+        if rand.random() < 0.7:
+            ip = str(IPv4Address(rand.randint(0x01000000, 0xDFFFFFFF)))
+        else:
+            ip = str(IPv6Address((0x2000 + rand.randint(0, 0xFFF)) << 112 | rand.getrandbits(112)))
+        try:
+            res.append(myip_app._safe_geo(myip_app._geolocate(ip, fail=True), True))
+        except geoip2.errors.AddressNotFoundError:
+            pass
+    return res
+
+
+def timed(func, values, iterations: int) -> float:
+    """Average microseconds per value to run ``func`` over ``values``"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for v in values:
+            func(v)
+    return (time.perf_counter() - start) * 1e6 / (iterations * len(values))
+
+
+def compare(name: str, legacy: list, binary: list, legacy_decode, binary_decode, iterations: int):
+    legacy_p, binary_p = [pickle.dumps(v) for v in legacy], [pickle.dumps(v) for v in binary]
+    l_size, b_size = sum(map(len, legacy_p)) / len(legacy_p), sum(map(len, binary_p)) / len(binary_p)
+    l_us = timed(lambda v: legacy_decode(pickle.loads(v)), legacy_p, iterations)
+    b_us = timed(lambda v: binary_decode(pickle.loads(v)), binary_p, iterations)
+    print(f"{name:<6} {'json':<8} {l_size:>10.1f} {l_us:>12.2f}")
+    print(f"{name:<6} {'binary':<8} {b_size:>10.1f} {b_us:>12.2f}   ({b_size / l_size:.0%} of the size)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('Copyright::')[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--count', type=int, default=1000, help='Addresses to sample')
+    parser.add_argument('-n', '--iterations', type=int, default=10, help='Times to decode every sampled value')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    geo = sample(args.count, args.seed)
+    if not geo:
+        print("None of the sampled addresses are in the GeoIP2 databases")
+        return 1
+    print(f"{'':<6} {'format':<8} {'bytes/key':>10} {'us/decode':>12}   ({len(geo)} addresses)")
+    settings.CACHE_CODEC = 'binary'
+    binary = [encode_geo(d) for d in geo]
+    compare('geoip', [json.dumps(d) for d in geo], binary, lambda v: DictObject(json.loads(v)), decode_geo, args.iterations)
+
+    hosts = [(f"static.{d.ip_address.replace('.', '-').replace(':', '-')}.example.net", time.time() + 3600) for d in geo]
+    compare('rdns', hosts, [encode_rdns(*h) for h in hosts], lambda v: v, decode_rdns, args.iterations)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Cache round-trip benchmark - counts the Redis round-trips (commands + pipeline executions) needed to fetch the GeoIP data
+and reverse DNS hostnames for a batch of addresses, one key at a time (:func:`myip.app.get_safe_geodata` +
+:func:`myip.core.get_rdns` per address) versus in bulk (:func:`myip.app.get_safe_geodata_many` +
+:func:`myip.core.get_rdns_many`), from a cold cache and a warm one.
+
+Uses the Redis server at ``REDIS_HOST`` / ``REDIS_PORT`` if one is running, otherwise an in-process fake Redis which
+sleeps ``--rtt`` milliseconds per round-trip (roughly a local server over loopback). The L1 cache and GeoIP network cache
+are disabled, so every read reaches Redis.
+
+Usage (from the repository root, with the GeoIP2 databases installed)::
+
+    python -m benchmarks.cache_roundtrips
+    python -m benchmarks.cache_roundtrips -b 500 --rtt 0.5 --fake
+
+Reverse DNS is resolved with a stub resolve function, so results aren't skewed by the system resolver.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from ipaddress import IPv4Address
+
+os.environ.setdefault('CACHE_ADAPTER', 'memory')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+os.environ['L1_CACHE_ENABLED'] = 'false'
+os.environ['GEOIP_NET_CACHE'] = 'false'
+
+import geoip2.errors
+from privex.helpers.cache.RedisCache import RedisCache
+
+from myip import app as myip_app, settings
+from myip.core import GeoType, get_geoip, get_rdns, get_rdns_many, set_cache_adapter, set_resolver
+from myip.rdns import RDNSResolver
+
+
+class FakeRedis:
+    """
+    Just enough of :class:`redis.Redis` for :class:`privex.helpers.cache.RedisCache` and :class:`myip.cache.CacheLock`,
+    held in a dict - every command (or pipeline execution) counts as one round-trip, and sleeps for ``rtt`` seconds.
+    """
+    def __init__(self, rtt: float):
+        self.rtt, self.round_trips, self.data = rtt, 0, {}
+
+    def _trip(self):
+        self.round_trips += 1
+        if self.rtt > 0: time.sleep(self.rtt)
+
+    def get(self, name):
+        self._trip()
+        return self.data.get(name)
+
+    def mget(self, keys):
+        self._trip()
+        return [self.data.get(k) for k in keys]
+
+    def set(self, name, value, ex=None, px=None, nx=False):
+        self._trip()
+        if nx and name in self.data:
+            return None
+        self.data[name] = value if isinstance(value, bytes) else str(value).encode()
+        return True
+
+    def delete(self, *names):
+        self._trip()
+        return sum(self.data.pop(n, None) is not None for n in names)
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def flushdb(self):
+        self.data.clear()
+
+    def close(self):
+        pass
+
+
+class FakePipeline:
+    def __init__(self, client: FakeRedis):
+        self.client, self.commands = client, []
+
+    def set(self, name, value, ex=None):
+        self.commands.append((name, value))
+        return self
+
+    def execute(self):
+        self.client._trip()
+        commands, self.commands = self.commands, []
+        for name, value in commands:
+            self.client.data[name] = value
+        return [True] * len(commands)
+
+
+def counted_redis(client):
+    """Count the round-trips made through a real :class:`redis.Redis` client, as ``client.round_trips``"""
+    client.round_trips = 0
+    execute_command, pipeline = client.execute_command, client.pipeline
+
+    def _execute_command(*args, **kwargs):
+        client.round_trips += 1
+        return execute_command(*args, **kwargs)
+
+    def _pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def _execute(*a, **kw):
+            client.round_trips += 1
+            return execute(*a, **kw)
+        pipe.execute = _execute
+        return pipe
+
+    client.execute_command, client.pipeline = _execute_command, _pipeline
+    return client
+
+
+def connect(args):
+    if not args.fake:
+        try:
+            import redis
+            client = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=args.db)
+            client.ping()
+            print(f"Using the Redis server at {settings.REDIS_HOST}:{settings.REDIS_PORT} (db {args.db})")
+            return counted_redis(client)
+        except Exception as e:
+            print(f"Couldn't connect to Redis at {settings.REDIS_HOST}:{settings.REDIS_PORT} ({type(e).__name__}: {e})")
+    print(f"Using an in-process fake Redis ({args.rtt} ms per round-trip)")
+    return FakeRedis(args.rtt / 1000)
+
+
+def per_key(ips):
+    for ip in ips:
+        try:
+            myip_app.get_safe_geodata(ip)
+        except Exception:
+            pass
+        get_rdns(ip)
+
+
+def bulk(ips):
+    myip_app.get_safe_geodata_many(ips)
+    get_rdns_many(ips)
+
+
+def measure(client, func, ips, warm: bool):
+    client.flushdb()
+    if warm:
+        bulk(ips)
+    start, client.round_trips = time.perf_counter(), 0
+    func(ips)
+    return client.round_trips, (time.perf_counter() - start) * 1000
+
+
+def sample_addresses(count: int, seed: int):
+    """Random IPv4 addresses which are in the GeoIP2 City database (so cold batches have GeoIP data to write)"""
+    rand, city, ips = random.Random(seed), get_geoip(GeoType.CITY), []
+    for _ in range(count * 1000):
+        if len(ips) >= count:
+            break
+        ip = str(IPv4Address(rand.randint(0x01000000, 0xDFFFFFFF)))
+        try:
+            city.city(ip)
+            ips.append(ip)
+        except geoip2.errors.AddressNotFoundError:
+            pass
+    return ips
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('Copyright::')[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-b', '--batch', type=int, default=100, help='Addresses per batch')
+    parser.add_argument('--rtt', type=float, default=0.2, help='Simulated round-trip time of the fake Redis (milliseconds)')
+    parser.add_argument('--fake', action='store_true', help="Use the fake Redis even if a Redis server is running")
+    parser.add_argument('--db', type=int, default=15, help='Redis database number to use (it is flushed!)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    client = connect(args)
+    set_cache_adapter(RedisCache(use_pickle=True, redis_instance=client), reset=True)
+    set_resolver(RDNSResolver(resolve_func=lambda ip: f"host-{ip}.example", lock_time=0))
+    ips = sample_addresses(args.batch, args.seed)
+
+    print(f"{'':<10} {'cache':<6} {'round-trips':>12} {'ms/batch':>10}   ({len(ips)} addresses per batch)")
+    for warm in (False, True):
+        for name, func in (('per-key', per_key), ('bulk', bulk)):
+            trips, ms = measure(client, func, ips, warm)
+            print(f"{name:<10} {'warm' if warm else 'cold':<6} {trips:>12} {ms:>10.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Regression benchmark - counts the cache reads/writes, GeoIP2 lookups, reverse DNS lookups and ``to_safe`` conversions
+made per request by the main lookup views (JSON, plain text and single field ``<dtype>`` responses), and fails
+(exit code 1) if any view uses more than it's budget.
+
+Each URL is requested twice from a cold cache - the first request is a cache miss, the second a cache hit.
+
+Usage (from the repository root, with the GeoIP2 databases installed)::
+
+    python -m benchmarks.geo_calls
+    python -m benchmarks.geo_calls -n 500 185.130.44.1 2a07:e00::333
+
+Reverse DNS is resolved with a stub resolve function, so results aren't skewed by the system resolver.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+
+os.environ.setdefault('CACHE_ADAPTER', 'memory')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+from myip import app as myip_app
+from myip.core import get_cache, get_geo_net_cache, set_resolver
+from myip.rdns import RDNSResolver
+
+COUNTS = Counter()
+
+# Maximum calls allowed per request - (cache miss budget, cache hit budget)
+BUDGETS = {
+    'geoip.get': (1, 1),
+    'geoip.set': (1, 0),
+    'geolocate': (1, 0),
+    'geolocate_one': (1, 1),
+    'rdns': (1, 1),
+    'to_safe': (1, 0),
+}
+
+# The URLs requested for each address, with any budgets which are tighter than :attr:`.BUDGETS`
+URLS = [
+    ('/index.json', {}),
+    ('/index.txt', {}),
+    ('/lookup/{ip}', {}),
+    ('/lookup/{ip}?format=text', {}),
+    ('/lookup/{ip}/all', {}),
+    # Single database fields never trigger a reverse DNS lookup, or a lookup against both databases
+    ('/lookup/{ip}/country', {'rdns': (0, 0), 'geolocate': (0, 0)}),
+    ('/lookup/{ip}/asn', {'rdns': (0, 0), 'geolocate': (0, 0)}),
+    ('/lookup/{ip}/hostname', {'geoip.get': (0, 0), 'geoip.set': (0, 0), 'geolocate': (0, 0), 'geolocate_one': (0, 0)}),
+]
+
+
+def _counted(name, func):
+    """Wrap ``func`` to count calls to it under ``name`` - recursive calls aren't counted"""
+    depth = [0]
+
+    def _wrapper(*args, **kwargs):
+        if depth[0] == 0: COUNTS[name] += 1
+        depth[0] += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            depth[0] -= 1
+    return _wrapper
+
+
+def _counted_cache(cache):
+    get, set_ = cache.get, cache.set
+
+    def _get(key, *args, **kwargs):
+        COUNTS[f"{str(key).split(':')[0]}.get"] += 1
+        return get(key, *args, **kwargs)
+
+    def _set(key, *args, **kwargs):
+        COUNTS[f"{str(key).split(':')[0]}.set"] += 1
+        return set_(key, *args, **kwargs)
+
+    cache.get, cache.set = _get, _set
+    return cache
+
+
+def instrument():
+    _counted_cache(get_cache())
+    # Full lookups (both databases) all go through _geolocate_net, single database fields through _geolocate_asn / _city
+    myip_app._geolocate_net = _counted('geolocate', myip_app._geolocate_net)
+    myip_app._geolocate_asn = _counted('geolocate_one', myip_app._geolocate_asn)
+    myip_app._geolocate_city = _counted('geolocate_one', myip_app._geolocate_city)
+    myip_app.get_rdns = _counted('rdns', myip_app.get_rdns)
+    myip_app.to_safe = _counted('to_safe', myip_app.to_safe)
+    set_resolver(RDNSResolver(resolve_func=lambda ip: f"host-{ip}.example", cache=get_cache))
+
+
+def measure(client, url: str, headers: dict) -> Counter:
+    COUNTS.clear()
+    res = client.get(url, headers=headers)
+    if res.status_code != 200:
+        raise Exception(f"GET {url} returned status {res.status_code}")
+    return Counter(COUNTS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('Copyright::')[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=200, help='Timed (cache hit) requests per URL')
+    parser.add_argument('ips', nargs='*', default=['185.130.44.1', '2a07:e00::333', '8.8.8.8'])
+    args = parser.parse_args()
+
+    instrument()
+    client = myip_app.app.test_client()
+    failed = False
+    for ip in args.ips:
+        headers = {'X-Real-IP': ip, 'User-Agent': 'benchmarks/geo_calls'}
+        for url, overrides in URLS:
+            url = url.format(ip=ip)
+            get_cache().remove(myip_app.geo_cache_key(ip), f'myip:rdns:{ip}')
+            get_geo_net_cache().clear()
+            miss, hit = measure(client, url, headers), measure(client, url, headers)
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                client.get(url, headers=headers)
+            per_req = (time.perf_counter() - start) / max(args.iterations, 1) * 1000
+
+            print(f"{url:<30} {per_req:8.3f} ms/req (cache hit)")
+            for name, (miss_max, hit_max) in dict(BUDGETS, **overrides).items():
+                bad = miss[name] > miss_max or hit[name] > hit_max
+                failed = failed or bad
+                print(f"    {name:<12} miss: {miss[name]} (max {miss_max})   hit: {hit[name]} (max {hit_max})"
+                      f"{'   <-- OVER BUDGET' if bad else ''}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Golden-output check for the JSON/YAML serialization layer (:func:`myip.serializer.to_safe` / :func:`myip.app._safe_geo`).
+
+Serializes a fixed set of :class:`.GeoResult`, :class:`.GeoIPResult` and :mod:`geoip2.models` objects with the app's
+JSON provider and :func:`myip.core.dump_yaml`, and compares the output byte-for-byte against the golden copies
+stored in ``benchmarks/golden/serializer.json``. Exits with code 1 if any output differs.
+
+Usage (from the repository root)::
+
+    python -m benchmarks.golden_serializer            # Compare against the golden output
+    python -m benchmarks.golden_serializer -n 2000    # ...and time each case
+    python -m benchmarks.golden_serializer --update   # Re-generate the golden output (only after an intended change!)
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
+from pathlib import Path
+
+os.environ.setdefault('CACHE_ADAPTER', 'memory')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+import geoip2.models
+from privex.helpers.geoip import GeoIPResult
+
+from myip.app import GeoData, GeoResult, _safe_geo, app
+from myip.codec import decode_geo, encode_geo
+from myip.core import GeoType, dump_yaml
+from myip.serializer import to_safe
+
+GOLDEN_FILE = Path(__file__).parent / 'golden' / 'serializer.json'
+
+CITY_RAW = dict(
+    city={'geoname_id': 2673730, 'names': {'en': 'Stockholm', 'de': 'Stockholm'}},
+    continent={'code': 'EU', 'geoname_id': 6255148, 'names': {'en': 'Europe'}},
+    country={'geoname_id': 2661886, 'is_in_european_union': True, 'iso_code': 'SE', 'names': {'en': 'Sweden'}},
+    location={'accuracy_radius': 50, 'latitude': 59.3247, 'longitude': 18.056, 'time_zone': 'Europe/Stockholm'},
+    postal={'code': '173 11'},
+    registered_country={'geoname_id': 2661886, 'iso_code': 'SE', 'names': {'en': 'Sweden'}},
+    subdivisions=[{'geoname_id': 2673722, 'iso_code': 'AB', 'names': {'en': 'Stockholm County'}}],
+)
+COUNTRY_RAW = {k: CITY_RAW[k] for k in ['continent', 'country', 'registered_country']}
+ASN_RAW = dict(autonomous_system_number=210083, autonomous_system_organization='Privex Inc.')
+
+
+def _geoip_result(ip: str, network) -> GeoIPResult:
+    return GeoIPResult(
+        country='Sweden', country_code='SE', city='Stockholm', postcode='173 11', as_number=210083, as_name='Privex Inc.',
+        ip_address=ip, network=network, long=18.056, lat=59.3247,
+        geoasn_data=geoip2.models.ASN(ip, network=str(network), prefix_len=network.prefixlen, **ASN_RAW),
+        geocity_data=geoip2.models.City(['en'], ip_address=ip, prefix_len=network.prefixlen, **CITY_RAW),
+    )
+
+
+def _geo_result(ip: str, geo) -> GeoResult:
+    res = GeoResult(ip=None, ua='golden/1.0', hostname=f'host-{ip}.example')
+    res.ip, res.ip_type, res.ip_valid = ip, 'ipv6' if ':' in ip else 'ipv4', True
+    res.set_geo(geo)
+    return res
+
+
+def cases() -> dict:
+    v4, v6 = _geoip_result('185.130.44.1', IPv4Network('185.130.44.0/22')), _geoip_result('2a07:e00::333', IPv6Network('2a07:e00::/29'))
+    missing = GeoResult(ip=None, ua='golden/1.0')
+    missing.ip, missing.ip_type, missing.ip_valid = '10.1.1.1', 'ipv4', True
+    missing.set_geo(None)
+    return {
+        'geoipresult_v4': lambda: to_safe(v4),
+        'geoipresult_v6': lambda: to_safe(v6),
+        'safe_geo_v4': lambda: _safe_geo(v4, True),
+        'safe_geo_cached': lambda: _safe_geo(decode_geo(encode_geo(_safe_geo(v6, True)))),
+        'georesult_geoipresult': lambda: to_safe(_geo_result('185.130.44.1', v4)),
+        'georesult_cached': lambda: to_safe(_geo_result('2a07:e00::333', decode_geo(encode_geo(_safe_geo(v6, True))))),
+        'georesult_not_found': lambda: to_safe(missing),
+        'batch': lambda: {ip: to_safe(r) for ip, r in [('185.130.44.1', _geo_result('185.130.44.1', v4)), ('10.1.1.1', missing)]},
+        'model_city': lambda: to_safe(geoip2.models.City(['en'], ip_address='185.130.44.1', prefix_len=22, **CITY_RAW)),
+        'model_country': lambda: to_safe(geoip2.models.Country(['en'], ip_address='185.130.44.1', prefix_len=22, **COUNTRY_RAW)),
+        'model_asn': lambda: to_safe(geoip2.models.ASN('185.130.44.1', network='185.130.44.0/22', prefix_len=22, **ASN_RAW)),
+        'geodata': lambda: to_safe(GeoData(city='Stockholm', country='Sweden', as_number=210083)),
+        'mixed': lambda: to_safe(dict(
+            addr=IPv4Address('8.8.8.8'), addr6=IPv6Address('2001:4860::8888'), net=IPv6Network('2a07:e00::/29'),
+            raw=b'bytes', kind=GeoType.CITY, none=None, flag=True, num=1.5, tup=(1, 'a', IPv4Address('1.1.1.1')),
+            nested=[{'a': [b'x', {'b': GeoType.ASN}]}], geodata=GeoData(city='Oslo'),
+        )),
+    }
+
+
+def render(obj) -> dict:
+    with app.app_context():
+        return dict(json=app.json.dumps(obj), yaml=dump_yaml(obj))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('Copyright::')[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--update', action='store_true', help='Write the current output as the new golden output')
+    parser.add_argument('-n', '--iterations', type=int, default=0, help='Time this many serializations of each case')
+    args = parser.parse_args()
+
+    out = {name: render(func()) for name, func in cases().items()}
+    if args.update:
+        GOLDEN_FILE.parent.mkdir(exist_ok=True)
+        GOLDEN_FILE.write_text(json.dumps(out, indent=1, sort_keys=True) + '\n')
+        print(f"Wrote {len(out)} golden outputs to {GOLDEN_FILE}")
+        return 0
+
+    golden, failed = json.loads(GOLDEN_FILE.read_text()), False
+    for name, func in cases().items():
+        for fmt in ['json', 'yaml']:
+            ok = golden.get(name, {}).get(fmt) == out[name][fmt]
+            failed = failed or not ok
+            print(f"{'OK  ' if ok else 'FAIL'} {name} ({fmt})")
+            if not ok:
+                print(f"    expected: {golden.get(name, {}).get(fmt)!r}\n    got:      {out[name][fmt]!r}")
+        if args.iterations:
+            start = time.perf_counter()
+            for _ in range(args.iterations):
+                func()
+            print(f"     {(time.perf_counter() - start) / args.iterations * 1e6:10.1f} us/serialization")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+A minimal MaxMind DB (``.mmdb``) writer, used to build small synthetic GeoLite2 ASN / City databases, so the
+benchmarks can run without downloading the real databases from MaxMind.
+
+Only what's needed to produce databases readable by :mod:`maxminddb` (both the pure Python reader and the
+``libmaxminddb`` C extension) is implemented - an IPv6 tree (IPv4 networks are stored under ``::/96``) with
+32-bit records, and no pointers in the data section (identical records are still only stored once).
+
+Usage (from the repository root)::
+
+    python -m benchmarks.mmdb /tmp/geoip            # Write GeoLite2-ASN.mmdb + GeoLite2-City.mmdb into /tmp/geoip
+    python -m benchmarks.mmdb -n 50000 /tmp/geoip   # ...with 50,000 random networks in each database
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import argparse
+import random
+import struct
+import sys
+import time
+import zlib
+from ipaddress import IPv4Network, IPv6Network, ip_network
+from pathlib import Path
+from typing import Any, Iterable, List, Tuple, Union
+
+Network = Union[str, IPv4Network, IPv6Network]
+
+# MaxMind DB data section type IDs
+T_UTF8, T_DOUBLE, T_BYTES, T_UINT16, T_UINT32, T_MAP, T_INT32, T_UINT64, T_ARRAY, T_BOOL = 2, 3, 4, 5, 6, 7, 8, 9, 11, 14
+
+METADATA_MARKER = b'\xab\xcd\xefMaxMind.com'
+
+
+class Typed:
+    """An integer which must be encoded as a specific MMDB type (the metadata section requires exact types)"""
+    def __init__(self, type_id: int, value: int):
+        self.type_id, self.value = type_id, value
+
+
+def _control(type_id: int, size: int) -> bytes:
+    if size < 29:
+        first, extra = size, b''
+    elif size < 285:
+        first, extra = 29, bytes([size - 29])
+    elif size < 65821:
+        first, extra = 30, struct.pack('>H', size - 285)
+    else:
+        first, extra = 31, struct.pack('>I', size - 65821)[1:]
+    if type_id <= 7:
+        return bytes([(type_id << 5) | first]) + extra
+    return bytes([first, type_id - 7]) + extra
+
+
+def _uint(v: int) -> bytes:
+    return v.to_bytes((v.bit_length() + 7) // 8, 'big') if v else b''
+
+
+def encode(v: Any) -> bytes:
+    """Encode ``v`` (a ``dict`` / ``list`` / ``str`` / ``int`` / ``float`` / ``bool`` / ``bytes`` / :class:`.Typed`) as MMDB data"""
+    if isinstance(v, Typed):
+        b = _uint(v.value)
+        return _control(v.type_id, len(b)) + b
+    if isinstance(v, bool):
+        return _control(T_BOOL, int(v))
+    if isinstance(v, str):
+        b = v.encode('utf-8')
+        return _control(T_UTF8, len(b)) + b
+    if isinstance(v, bytes):
+        return _control(T_BYTES, len(v)) + v
+    if isinstance(v, float):
+        return _control(T_DOUBLE, 8) + struct.pack('>d', v)
+    if isinstance(v, int):
+        if v < 0:
+            return _control(T_INT32, 4) + struct.pack('>i', v)
+        b = _uint(v)
+        return _control(T_UINT16 if v < 2 ** 16 else T_UINT32 if v < 2 ** 32 else T_UINT64, len(b)) + b
+    if isinstance(v, dict):
+        return _control(T_MAP, len(v)) + b''.join(encode(k) + encode(x) for k, x in v.items())
+    if isinstance(v, (list, tuple)):
+        return _control(T_ARRAY, len(v)) + b''.join(encode(x) for x in v)
+    raise TypeError(f"Cannot encode {type(v)} as MaxMind DB data")
+
+
+def write_mmdb(path: Union[str, Path], records: Iterable[Tuple[Network, dict]], database_type: str, build_epoch: int = None) -> Path:
+    """
+    Write ``records`` - an iterable of ``(network, data)`` tuples - into a new MaxMind DB at ``path``.
+
+    More specific networks override the less specific networks they're inside of, regardless of their order in ``records``.
+    """
+    root: list = [None, None]
+    data, offsets = bytearray(), {}
+    nets = sorted(((ip_network(n), rec) for n, rec in records), key=lambda x: (x[0].prefixlen + (96 if x[0].version == 4 else 0)))
+    for net, rec in nets:
+        bits, plen = int(net.network_address), net.prefixlen + (96 if isinstance(net, IPv4Network) else 0)
+        enc = encode(rec)
+        if enc not in offsets:
+            offsets[enc] = len(data)
+            data += enc
+        node = root
+        for i in range(plen):
+            bit = (bits >> (127 - i)) & 1
+            if i == plen - 1:
+                node[bit] = ('data', offsets[enc])
+            else:
+                if not isinstance(node[bit], list):
+                    # Split the (less specific) leaf, so both halves keep it's data
+                    node[bit] = [node[bit], node[bit]]
+                node = node[bit]
+
+    nodes, stack = [], [root]
+    while stack:
+        n = stack.pop()
+        nodes.append(n)
+        stack.extend(c for c in reversed(n) if isinstance(c, list))
+    ids = {id(n): i for i, n in enumerate(nodes)}
+    count = len(nodes)
+    tree = bytearray()
+    for n in nodes:
+        for c in n:
+            if c is None: tree += struct.pack('>I', count)
+            elif isinstance(c, list): tree += struct.pack('>I', ids[id(c)])
+            else: tree += struct.pack('>I', count + 16 + c[1])
+
+    meta = {
+        'binary_format_major_version': Typed(T_UINT16, 2), 'binary_format_minor_version': Typed(T_UINT16, 0),
+        'build_epoch': Typed(T_UINT64, int(time.time()) if build_epoch is None else int(build_epoch)),
+        'database_type': database_type, 'description': {'en': f'Synthetic {database_type} database'},
+        'ip_version': Typed(T_UINT16, 6), 'languages': ['en'], 'node_count': Typed(T_UINT32, count),
+        'record_size': Typed(T_UINT16, 32),
+    }
+    path = Path(path)
+    path.write_bytes(bytes(tree) + b'\x00' * 16 + bytes(data) + METADATA_MARKER + encode(meta))
+    return path
+
+
+def city_record(city: str, country_code: str, country: str, postcode: str, lat: float, lon: float, tz: str) -> dict:
+    return {
+        'city': {'geoname_id': zlib.crc32(city.encode()) % 10000000, 'names': {'en': city}},
+        'continent': {'code': 'EU', 'geoname_id': 6255148, 'names': {'en': 'Europe'}},
+        'country': {'geoname_id': zlib.crc32(country.encode()) % 10000000, 'iso_code': country_code, 'names': {'en': country}},
+        'location': {'accuracy_radius': 20, 'latitude': lat, 'longitude': lon, 'time_zone': tz},
+        'postal': {'code': postcode},
+    }
+
+
+CITIES = [
+    ('Stockholm', 'SE', 'Sweden', '173 11', 59.3333, 18.05, 'Europe/Stockholm'),
+    ('Amsterdam', 'NL', 'Netherlands', '1012', 52.3759, 4.8975, 'Europe/Amsterdam'),
+    ('Mountain View', 'US', 'United States', '94035', 37.386, -122.0838, 'America/Los_Angeles'),
+    ('Frankfurt am Main', 'DE', 'Germany', '60313', 50.1188, 8.6843, 'Europe/Berlin'),
+    ('Helsinki', 'FI', 'Finland', '00100', 60.1719, 24.9347, 'Europe/Helsinki'),
+    ('Tokyo', 'JP', 'Japan', '100-0001', 35.6893, 139.6899, 'Asia/Tokyo'),
+]
+
+ASNS = [
+    (210083, 'Privex Inc.'), (15169, 'Google LLC'), (13335, 'Cloudflare, Inc.'), (24940, 'Hetzner Online GmbH'),
+    (16509, 'Amazon.com, Inc.'), (2914, 'NTT America, Inc.'),
+]
+
+KNOWN = [
+    ('185.130.44.0/22', 0, 0), ('2a07:e00::/29', 0, 0), ('185.130.46.0/24', 1, 0), ('8.8.8.0/24', 2, 1), ('1.1.1.0/24', 2, 2),
+]
+"""Networks which are always present - ``(network, index into CITIES, index into ASNS)``"""
+
+SAMPLE_FOUND = ['185.130.44.1', '185.130.46.9', '2a07:e00::333', '8.8.8.8', '1.1.1.1']
+"""Addresses which are always found in the synthetic databases"""
+SAMPLE_MISSING = ['10.0.0.1', '192.168.1.1', 'fd00::1']
+"""Addresses which are never found in the synthetic databases"""
+
+
+def synthetic_networks(count: int = 1000, seed: int = 1) -> List[Tuple[IPv4Network, int, int]]:
+    """Generate ``count`` random IPv4 /24 and IPv6 /48 networks (plus the :attr:`.KNOWN` ones), each with a city + ASN index"""
+    rnd = random.Random(seed)
+    nets = {ip_network(n): (c, a) for n, c, a in KNOWN}
+    wide = [k for k in nets if k.prefixlen < 24]
+    while len(nets) < count + len(KNOWN):
+        if rnd.random() < 0.7:
+            net = ip_network(f"{rnd.randint(11, 126)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.0/24")
+        else:
+            net = ip_network(f"2a{rnd.randint(0, 15):02x}:{rnd.randint(0, 65535):x}:{rnd.randint(0, 65535):x}::/48")
+        if any(net.version == k.version and net.overlaps(k) for k in wide):
+            continue
+        nets.setdefault(net, (rnd.randrange(len(CITIES)), rnd.randrange(len(ASNS))))
+    return [(n, c, a) for n, (c, a) in nets.items()]
+
+
+def build_fixtures(directory: Union[str, Path], count: int = 1000, seed: int = 1, build_epoch: int = 1600000000) -> List[str]:
+    """
+    Write synthetic ``GeoLite2-ASN.mmdb`` and ``GeoLite2-City.mmdb`` databases into ``directory``, returning
+    a list of addresses (one from each network) which can be looked up in them.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    nets = synthetic_networks(count, seed)
+    write_mmdb(directory / 'GeoLite2-City.mmdb', [(n, city_record(*CITIES[c])) for n, c, a in nets], 'GeoLite2-City', build_epoch)
+    write_mmdb(
+        directory / 'GeoLite2-ASN.mmdb',
+        [(n, {'autonomous_system_number': ASNS[a][0], 'autonomous_system_organization': ASNS[a][1]}) for n, c, a in nets],
+        'GeoLite2-ASN', build_epoch
+    )
+    return [str(n.network_address + 1) for n, c, a in nets]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('Copyright::')[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--networks', type=int, default=1000, help='Number of random networks to add (default: 1000)')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed (default: 1)')
+    parser.add_argument('directory')
+    args = parser.parse_args()
+    ips = build_fixtures(args.directory, args.networks, args.seed)
+    print(f"Wrote GeoLite2-ASN.mmdb + GeoLite2-City.mmdb with {len(ips)} networks into {args.directory}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
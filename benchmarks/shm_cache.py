@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Shared memory cache benchmark - runs ``-w`` worker processes which each look up keys from the same skewed
+(log-uniform) stream of addresses, caching what they look up, as gunicorn workers behind a load balancer would.
+Compares each worker keeping it's own :class:`privex.helpers.cache.MemoryCache` against every worker sharing one
+:class:`myip.shmcache.SharedMemoryCache`, reporting the overall hit rate and the average time per cache read / write.
+
+Usage (from the repository root)::
+
+    python -m benchmarks.shm_cache
+    python -m benchmarks.shm_cache -w 8 -r 50000 -k 100000
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('CACHE_ADAPTER', 'memory')
+os.environ.setdefault('LOG_LEVEL', 'ERROR')
+
+from privex.helpers.cache import MemoryCache
+
+from myip.codec import encode_geo
+from myip.shmcache import SharedMemoryCache
+
+VALUE = encode_geo(dict(
+    country='Sweden', country_code='SE', city='Stockholm', postcode='100 05', as_number=210083,
+    as_name='Privex Inc.', ip_address='185.130.44.1', network='185.130.44.0/22', long=18.0717, lat=59.3247,
+))
+
+
+def worker(adapter: str, path: str, slots: int, requests: int, keys: int, seed: int, results):
+    cache = MemoryCache() if adapter == 'memory' else SharedMemoryCache(path, slots=slots)
+    rand, hits, cache_time = random.Random(seed), 0, 0.0
+    for _ in range(requests):
+        key = f'geoip:{int(keys ** rand.random())}'
+        started = time.perf_counter()
+        if cache.get(key) is not None:
+            hits += 1
+        else:
+            cache.set(key, VALUE, 600)
+        cache_time += time.perf_counter() - started
+    results.put((hits, cache_time))
+
+
+def run(adapter: str, args, path: str):
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=worker, args=(adapter, path, args.slots, args.requests, args.keys, args.seed + i, results))
+        for i in range(args.workers)
+    ]
+    for p in procs: p.start()
+    res = [results.get() for _ in procs]
+    for p in procs: p.join()
+    total = args.requests * args.workers
+    hits, cache_time = sum(r[0] for r in res), sum(r[1] for r in res)
+    print(f"{adapter:<8} {hits / total:>9.1%} {cache_time * 1e6 / total:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('Copyright::')[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-w', '--workers', type=int, default=4, help='Worker processes')
+    parser.add_argument('-r', '--requests', type=int, default=20000, help='Lookups per worker')
+    parser.add_argument('-k', '--keys', type=int, default=50000, help='Distinct addresses')
+    parser.add_argument('-s', '--slots', type=int, default=65536, help='Shared memory cache slots')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'adapter':<8} {'hit rate':>9} {'us/op':>12}   ({args.workers} workers x {args.requests} lookups)")
+    run('memory', args, '')
+    with tempfile.TemporaryDirectory(dir='/dev/shm' if os.path.isdir('/dev/shm') else None) as tmp:
+        run('shm', args, os.path.join(tmp, 'myip-bench'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
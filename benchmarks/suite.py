@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite - measures the throughput and p50 / p99 latency of the hot-path functions (GeoIP lookups,
+serialization, ``get_flat``, ``wants_type`` ...) and of every endpoint + output format (through the Flask test
+client), for both single and batch lookups.
+
+Runs against synthetic GeoLite2 databases built by :mod:`benchmarks.mmdb` (no MaxMind download needed), with
+``MemoryCache`` as the cache adapter and a stub rDNS resolve function, so results only depend on the code.
+
+Results are saved as JSON (by default into ``benchmarks/results/``), and can be compared against a previous run -
+the exit code is 1 if any benchmark's p50 latency got more than ``--threshold`` percent slower than the baseline.
+
+Usage (from the repository root)::
+
+    python -m benchmarks.suite                                  # Run everything, save to benchmarks/results/<date>.json
+    python -m benchmarks.suite -k lookup -n 500                 # Only benchmarks with 'lookup' in their name
+    python -m benchmarks.suite -o before.json                   # Save a baseline...
+    python -m benchmarks.suite --baseline before.json           # ...then compare a later run against it
+    python -m benchmarks.suite --list                           # List the benchmark names
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from benchmarks.mmdb import SAMPLE_FOUND, SAMPLE_MISSING, build_fixtures
+
+RESULTS_DIR = Path(__file__).parent / 'results'
+BATCH_SIZE = 100
+
+Case = Tuple[Callable[[], object], Optional[Callable[[], object]]]
+"""A benchmark - the function to time, and an (untimed) setup function which is called before each call"""
+
+
+def percentile(sorted_times: List[int], q: float) -> int:
+    return sorted_times[min(len(sorted_times) - 1, int(round(q * (len(sorted_times) - 1))))]
+
+
+def bench(func: Callable[[], object], setup: Callable[[], object] = None, iterations: int = 1000, warmup: int = 20) -> dict:
+    """Call ``func`` ``iterations`` times (after ``warmup`` untimed calls), returning it's throughput and latency stats"""
+    for _ in range(warmup):
+        if setup is not None: setup()
+        func()
+    times = []
+    for _ in range(iterations):
+        if setup is not None: setup()
+        start = time.perf_counter_ns()
+        func()
+        times.append(time.perf_counter_ns() - start)
+    times.sort()
+    total = sum(times)
+    return dict(
+        iterations=iterations, ops_per_sec=round(iterations / (total / 1e9), 1), mean_us=round(total / iterations / 1000, 2),
+        p50_us=round(percentile(times, 0.50) / 1000, 2), p99_us=round(percentile(times, 0.99) / 1000, 2),
+        min_us=round(times[0] / 1000, 2), max_us=round(times[-1] / 1000, 2),
+    )
+
+
+def setup_env(fixtures: Path, networks: int) -> List[str]:
+    """Build the synthetic databases (unless they already exist) and configure the app - must run before importing :mod:`myip`"""
+    if not (fixtures / 'GeoLite2-City.mmdb').exists() or not (fixtures / 'GeoLite2-ASN.mmdb').exists():
+        ips = build_fixtures(fixtures, networks)
+    else:
+        from benchmarks.mmdb import synthetic_networks
+        ips = [str(n.network_address + 1) for n, c, a in synthetic_networks(networks)]
+    os.environ.update(GEOIP_PATH=str(fixtures), CACHE_ADAPTER='memory', LOG_LEVEL='ERROR', USE_FAKE_IPS='false', DEBUG='false')
+    return ips
+
+
+def cases(ips: List[str]) -> Dict[str, Case]:
+    from myip import app as myip_app
+    from myip.app import _safe_geo, get_flat, get_geodata, get_safe_geodata, lookup_cidr, lookup_many
+    from myip.core import get_cache, get_geo_net_cache, set_resolver, wants_type
+    from myip.rdns import RDNSResolver
+    from myip.serializer import to_safe
+
+    set_resolver(RDNSResolver(resolve_func=lambda ip: f"host-{ip.replace(':', '-')}.example", cache=get_cache))
+    app, client = myip_app.app, myip_app.app.test_client()
+    ip, ip6 = SAMPLE_FOUND[0], SAMPLE_FOUND[2]
+    batch = (ips * (BATCH_SIZE // max(len(ips), 1) + 1))[:BATCH_SIZE - len(SAMPLE_MISSING)] + SAMPLE_MISSING
+    headers = {'X-Real-IP': ip, 'User-Agent': 'benchmarks/suite', 'Host': 'myip.example.com'}
+    geo = get_geodata(ip)
+    cold = iter(ips * 1000)
+
+    def clear_caches():
+        get_cache().remove(*[myip_app.geo_cache_key(x) for x in batch], myip_app.geo_cache_key(ip))
+        get_geo_net_cache().clear()
+
+    def _next_cold():
+        clear_caches()
+        _next_cold.ip = next(cold)
+
+    def _wants(accept: str, fmt: str = None) -> Case:
+        ctx = app.test_request_context('/', headers={'Accept': accept})
+
+        def _call():
+            ctx.push()
+            try:
+                return wants_type(fmt=fmt)
+            finally:
+                ctx.pop()
+        return _call, None
+
+    def _get(url: str, **kwargs) -> Case:
+        def _call():
+            res = client.get(url, headers=headers)
+            if res.status_code != 200:
+                raise Exception(f"GET {url} returned status {res.status_code}")
+            return res.get_data()
+        return _call, kwargs.get('setup')
+
+    found = dict(
+        **{
+            'func.get_geodata[hit]': (lambda: get_geodata(ip), None),
+            'func.get_geodata[hit,v6]': (lambda: get_geodata(ip6), None),
+            'func.get_geodata[miss]': (lambda: get_geodata(_next_cold.ip), _next_cold),
+            'func.get_safe_geodata[hit]': (lambda: get_safe_geodata(ip), None),
+            'func.to_safe[GeoIPResult]': (lambda: to_safe(geo), None),
+            'func._safe_geo[GeoIPResult]': (lambda: _safe_geo(geo, True), None),
+            'func.lookup_many[hit]': (lambda: lookup_many(batch), None),
+            'func.lookup_many[miss]': (lambda: lookup_many(batch), clear_caches),
+            'func.lookup_cidr[/16]': (lambda: list(lookup_cidr('185.130.0.0/16')), None),
+            'func.lookup_cidr[/8]': (lambda: list(lookup_cidr('11.0.0.0/8')), None),
+            'func.wants_type[accept=json]': _wants('application/json'),
+            'func.wants_type[accept=browser]': _wants('text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'),
+            'func.wants_type[fmt=yml]': _wants('*/*', 'yml'),
+        },
+        **{f'func.get_flat[{d}]': ((lambda d=d: get_flat(ip, ua='bench', dtype=d)), None) for d in ['all', 'country', 'asn', 'dns', 'ip']},
+    )
+    for fmt in ['html', 'json', 'yml', 'txt']:
+        found[f'http.index[{fmt}]'] = _get(f'/index.{fmt}')
+    for fmt in ['json', 'yml', 'txt', 'ndjson', 'csv']:
+        found[f'http.lookup[{fmt}]'] = _get(f'/lookup.{fmt}/{ip}')
+        found[f'http.lookup_batch[{fmt}]'] = _get(f"/lookup.{fmt}/?ips={','.join(batch)}")
+    found['http.lookup_batch[json,miss]'] = _get(f"/lookup.json/?ips={','.join(batch)}", setup=clear_caches)
+    found['http.lookup[country]'] = _get(f'/lookup/{ip}/country')
+    found['http.lookup_cidr[json]'] = _get('/lookup.json/185.130.0.0/16')
+    found['http.flat[ip]'] = _get('/flat')
+    for d in ['country', 'asn', 'all']:
+        found[f'http.flat[{d}]'] = _get(f'/flat/{d}')
+    return found
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """Print the p50 change of each benchmark vs ``baseline``, returning the names of those which regressed by over ``threshold`` %"""
+    regressed = []
+    print(f"\n{'benchmark':<40} {'base p50':>12} {'p50':>12} {'change':>9}")
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<40} {'-':>12} {res['p50_us']:>10.1f}us {'new':>9}")
+            continue
+        change = (res['p50_us'] - base['p50_us']) / base['p50_us'] * 100 if base['p50_us'] else 0.0
+        bad = change > threshold
+        if bad: regressed.append(name)
+        print(f"{name:<40} {base['p50_us']:>10.1f}us {res['p50_us']:>10.1f}us {change:>+8.1f}%{'   <-- REGRESSION' if bad else ''}")
+    return regressed
+
+
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('Copyright::')[0], formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--iterations', type=int, default=1000, help='Timed calls per benchmark (default: 1000)')
+    parser.add_argument('-w', '--warmup', type=int, default=20, help='Untimed calls before timing each benchmark (default: 20)')
+    parser.add_argument('-k', '--filter', action='append', default=[], help='Only run benchmarks containing this string (repeatable)')
+    parser.add_argument('-o', '--output', default=None, help='Where to save the results (default: benchmarks/results/<date>.json)')
+    parser.add_argument('-b', '--baseline', default=None, help='Compare the results against this results file')
+    parser.add_argument('-t', '--threshold', type=float, default=25.0, help='Max allowed p50 slowdown vs the baseline, in %% (default: 25)')
+    parser.add_argument('--fixtures', default=None, help='Directory for the synthetic GeoIP databases (default: a temporary directory)')
+    parser.add_argument('--networks', type=int, default=1000, help='Random networks in the synthetic databases (default: 1000)')
+    parser.add_argument('--list', action='store_true', help='List the benchmark names and exit')
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory(prefix='myip-bench-') if args.fixtures is None else None
+    ips = setup_env(Path(args.fixtures if tmp is None else tmp.name), args.networks)
+    all_cases = cases(ips)
+    selected = {k: v for k, v in all_cases.items() if not args.filter or any(f in k for f in args.filter)}
+    if args.list:
+        print('\n'.join(selected.keys()))
+        return 0
+
+    results = {}
+    print(f"{'benchmark':<40} {'ops/sec':>12} {'p50':>12} {'p99':>12}")
+    for name, (func, setup) in selected.items():
+        res = results[name] = bench(func, setup, iterations=args.iterations, warmup=args.warmup)
+        print(f"{name:<40} {res['ops_per_sec']:>12,.1f} {res['p50_us']:>10.1f}us {res['p99_us']:>10.1f}us")
+
+    out = Path(args.output) if args.output else RESULTS_DIR / f"{time.strftime('%Y%m%d-%H%M%S')}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    meta = dict(
+        timestamp=int(time.time()), git_rev=_git_rev(), python=platform.python_version(), platform=platform.platform(),
+        iterations=args.iterations, warmup=args.warmup, networks=args.networks, batch_size=BATCH_SIZE,
+    )
+    out.write_text(json.dumps(dict(meta=meta, results=results), indent=1) + '\n')
+    print(f"\nSaved results to {out}")
+
+    if args.baseline:
+        regressed = compare(results, json.loads(Path(args.baseline).read_text())['results'], args.threshold)
+        if len(regressed) > 0:
+            print(f"\n{len(regressed)} benchmark(s) regressed by more than {args.threshold}%: {', '.join(regressed)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
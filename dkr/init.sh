@@ -29,6 +29,8 @@ cd "$DIR"
 : ${HOST='0.0.0.0'}
 : ${PORT='5252'}
 : ${GU_WORKERS='4'}    # Number of Gunicorn worker processes
+: ${SERVER_MODE='sync'}  # 'sync' = Flask on sync workers, 'async' = aiohttp workers (see myip/aioapp.py)
+: ${METRICS_DIR="/tmp/myip-metrics-${PORT}"}  # Shared by the workers, so /metrics covers all of them (see myip/metrics.py)
 #EXTRA_ARGS=()
 
 if (( $# > 0 )); then
@@ -36,6 +38,8 @@ if (( $# > 0 )); then
         echo "
 Usage: docker run --rm -it privex/myip (host=${HOST}) (port=${PORT}) (workers=${GU_WORKERS}) [extra_args_for_gunicorn]
 
+Set SERVER_MODE=async to serve using aiohttp workers instead of sync workers (current: ${SERVER_MODE})
+
 We recommend using Docker's environment flags for the run command, e.g. '--env-file ${HOME}/myip.env'
 or '--env \"HOST=::\" --env GU_WORKERS=10'
 
@@ -61,10 +65,26 @@ fi
 echo " > HOST: ${HOST}"
 echo " > PORT: ${PORT}"
 echo " > GU_WORKERS: ${GU_WORKERS}"
+echo " > SERVER_MODE: ${SERVER_MODE}"
+echo " > METRICS_DIR: ${METRICS_DIR}"
 #echo " > EXTRA_ARGS:" "$(printf '%q ' "${EXTRA_ARGS[@]}")"
 
 #if (( ${#EXTRA_ARGS[@]} > 0 )); then
 #    pipenv run gunicorn -b "${HOST}:${PORT}" -w "$GU_WORKERS" "${EXTRA_ARGS[@]}" wsgi
 #else
-pipenv run gunicorn -b "${HOST}:${PORT}" -w "$GU_WORKERS" wsgi
+# Metrics from a previous run must be cleared, otherwise they'd be added to the new workers' metrics
+if [[ -n "$METRICS_DIR" ]]; then
+    rm -rf "$METRICS_DIR" && mkdir -p "$METRICS_DIR"
+    export METRICS_DIR
+fi
+
+# Build the flag sprite + fingerprinted / pre-compressed static assets (see myip/assets.py) - the old ones keep
+# being served if the build fails
+pipenv run python3 -m myip build-assets || echo "Warning: Failed to build the static assets - using the unbuilt ones."
+
+if [[ "$SERVER_MODE" == "async" ]]; then
+    pipenv run gunicorn -c gunicorn.conf.py -b "${HOST}:${PORT}" -w "$GU_WORKERS" -k aiohttp.GunicornWebWorker myip.aioapp:make_app
+else
+    pipenv run gunicorn -c gunicorn.conf.py -b "${HOST}:${PORT}" -w "$GU_WORKERS" wsgi
+fi
 #fi
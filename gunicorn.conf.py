@@ -0,0 +1,36 @@
+"""
+Gunicorn configuration used by ``run.sh`` / ``dkr/init.sh`` (``gunicorn -c gunicorn.conf.py ...``).
+
+When a worker exits (restarted by ``--max-requests``, killed by ``--timeout`` etc.), it's ``livesum`` Prometheus gauges
+(e.g. ``myip_cache_breaker_open``) are removed from ``METRICS_DIR`` - otherwise the last values the dead worker wrote
+would keep being added into every scrape until the whole service restarts (see :mod:`myip.metrics`).
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import os
+
+
+def child_exit(server, worker):
+    metrics_dir = os.getenv('METRICS_DIR', os.getenv('PROMETHEUS_MULTIPROC_DIR', ''))
+    if not metrics_dir or not os.path.isdir(metrics_dir):
+        return
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid, metrics_dir)
@@ -1,11 +1,70 @@
 #!/usr/bin/env python3
-from myip.app import app
+"""
+Usage::
+
+    python -m myip                  # Run the development server (same as 'python -m myip serve')
+    python -m myip serve --async    # Run the async (aiohttp) server - see :mod:`myip.aioapp`
+    python -m myip enrich --help    # Bulk enrich IP addresses from a file / stdin - see :mod:`myip.enrich`
+    python -m myip build-index      # Build the ASN / country reverse indexes (add --force to rebuild) - see :mod:`myip.revindex`
+    python -m myip build-assets     # Build the flag sprite + fingerprinted / pre-compressed static assets - see :mod:`myip.assets`
+
+"""
+import sys
+
 from myip import settings
 
-if __name__ == '__main__':
+
+def serve(use_async=False):
+    if use_async:
+        from myip.aioapp import run
+        return run()
+    from myip.app import app
     app.run(
         debug=settings.DEBUG,
         host=settings.HOST,
         port=settings.PORT,
     )
 
+
+def build_index(force=False) -> int:
+    from myip.core import get_reverse_index
+    from myip.revindex import ReverseIndex
+    indexes = get_reverse_index()
+    for kind, path in indexes.build(force=force).items():
+        idx = ReverseIndex(kind, path)
+        print(
+            f"{idx.kind}: {path} - {idx.network_count} networks, {idx.key_count} keys, {idx.size} bytes, "
+            f"built in {idx.build_secs:.2f} seconds (peak RSS +{idx.build_rss_kb} KB)"
+        )
+        idx.close()
+    return 0
+
+
+def build_assets() -> int:
+    from myip.assets import build_assets as _build_assets
+    manifest = _build_assets()
+    for name, sizes in manifest.sizes.items():
+        print(f"{settings.ASSETS_DIR / name}: " + ', '.join(f"{enc} {size} bytes" for enc, size in sizes.items()))
+    print(f"{len(manifest.flags)} flags in the sprite, manifest version {manifest.version}")
+    return 0
+
+
+def main(argv=None) -> int:
+    argv = sys.argv[1:] if argv is None else list(argv)
+    cmd = argv.pop(0) if len(argv) > 0 else 'serve'
+    if cmd == 'serve':
+        serve(use_async='--async' in argv)
+        return 0
+    if cmd == 'enrich':
+        from myip.enrich import main as enrich_main
+        return enrich_main(argv)
+    if cmd == 'build-index':
+        return build_index(force='--force' in argv)
+    if cmd == 'build-assets':
+        return build_assets()
+    print(__doc__, file=sys.stderr)
+    return 0 if cmd in ['-h', '--help', 'help'] else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+"""
+Asynchronous (aiohttp) front end for the Flask app - serves every route of :mod:`myip.app` (with the same content
+negotiation via :func:`myip.core.wants_type`), but waits for Reverse DNS lookups on the event loop, so a request
+stuck behind a slow PTR zone holds nothing but a coroutine, instead of a whole gunicorn sync worker.
+
+For each request:
+
+1. The addresses which the view will need the rDNS hostname of are worked out (see :func:`.rdns_plan`), the lookups
+   are started on the :class:`myip.rdns.RDNSResolver` thread pool, and awaited on the event loop (sharing a single
+   ``settings.RDNS_TIMEOUT`` deadline).
+2. The unmodified Flask view is then ran on a small thread pool (``settings.AIO_THREADS``) - within
+   :meth:`.RDNSResolver.no_wait`, so it only ever uses cached hostnames. Cache (Redis / Memcached) round-trips
+   and GeoIP lookups happen on that thread pool too, so the event loop itself never blocks.
+
+Run it with gunicorn's aiohttp worker (``SERVER_MODE=async`` in ``.env`` for ``run.sh`` / ``dkr/init.sh``)::
+
+    gunicorn -b 127.0.0.1:5151 -w 4 -k aiohttp.GunicornWebWorker myip.aioapp:make_app
+
+Or for development::
+
+    python -m myip serve --async
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import asyncio
+import io
+import logging
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+from flask import Flask, request
+from privex.helpers import empty, empty_if
+from werkzeug.exceptions import HTTPException
+
+from myip import httpcache, settings
+from myip.app import (
+    FLAT_ALIASES, FLAT_DEFAULT, STREAM_TYPES, FlatSource, app as flask_app, get_ip_info, lookup_args, lookup_cidr_arg, lookup_dtype,
+    response_etag
+)
+from myip.core import get_ip, get_resolver, merge_frm, wants_type
+from myip.rdns import RDNSResolver
+
+log = logging.getLogger(__name__)
+
+_END = object()
+
+RDNSPlan = Tuple[List[str], bool, bool]
+
+
+def _flat_needs_rdns(dtype: Optional[str]) -> bool:
+    return bool(FLAT_ALIASES.get(empty_if(dtype, '').lower(), FLAT_DEFAULT).sources & FlatSource.RDNS)
+
+
+def _not_modified(kind: str, ips, wanted: str, dtype: Optional[str], ua: str) -> bool:
+    """Whether the view will answer the current (conditional) request with a ``304`` - see :mod:`myip.httpcache`"""
+    if not request.if_none_match:
+        return False
+    return httpcache.matches(response_etag(kind, ips, wanted, dtype, ua)[0])
+
+
+def rdns_plan(app: Flask, environ: dict) -> RDNSPlan:
+    """
+    Returns ``(addresses, wait, no_wait)`` for the request ``environ`` - the addresses which the Flask view will
+    need the rDNS hostname of, whether to wait for those lookups before running the view, and whether to run the view
+    within :meth:`.RDNSResolver.no_wait`.
+
+    Streamed formats (see :attr:`myip.app.STREAM_TYPES`) don't wait up-front - the view itself waits for each batch,
+    so the first results are still sent straight away. Conditional requests which the view will answer with
+    ``304 Not Modified`` don't look up anything.
+    """
+    with app.request_context(environ):
+        try:
+            rule, args = app.url_map.bind_to_environ(environ).match(return_rule=True)
+        except HTTPException:
+            return [], False, True
+        endpoint = rule.endpoint
+        if endpoint == 'view_flat':
+            if _not_modified('flat', get_ip(), 'text', empty_if(args.get('dtype'), ''), request.headers.get('User-Agent', 'N/A')):
+                return [], False, True
+            return ([get_ip()] if _flat_needs_rdns(args.get('dtype')) else []), True, True
+        if endpoint not in ['index_slash', 'index_file', 'view_lookup']:
+            return [], False, True
+        frm = merge_frm(req=request)
+        wanted = wants_type() if 'format' in frm else wants_type(fmt=args.get('bformat'))
+        if endpoint != 'view_lookup':
+            idtype = frm.get('type', frm.get('dtype', 'all')) if wanted == 'text' else None
+            if _not_modified('index', get_ip(), wanted, idtype, request.headers.get('User-Agent', 'Empty User Agent')):
+                return [], False, True
+            return [get_ip()], wanted not in settings.RDNS_NOWAIT_FORMATS, True
+        ip, iplist = lookup_args(frm, args.get('ip_addr'))
+        dtype = args.get('dtype')
+        if lookup_cidr_arg(frm, ip, dtype) is not None:
+            return [], False, True
+        ua = request.headers.get('User-Agent', 'N/A')
+        if not empty(iplist, itr=True) and isinstance(iplist, (list, tuple)):
+            if len(iplist) > settings.MAX_ADDRESSES or _not_modified('lookup', iplist, wanted, lookup_dtype(frm, wanted, dtype), ua):
+                return [], False, True
+            stream = empty(dtype) and wanted in STREAM_TYPES
+            return [str(x) for x in iplist], not stream, not stream
+        ip = get_ip_info(get_ip() if empty(ip) else ip)
+        if _not_modified('lookup', ip, wanted, lookup_dtype(frm, wanted, dtype), ua):
+            return [], False, True
+        if not empty(dtype) or wanted == 'text':
+            return ([ip] if _flat_needs_rdns(empty_if(dtype, frm.get('type', frm.get('dtype', 'all')))) else []), True, True
+        return [ip], True, True
+
+
+def wsgi_environ(req: web.BaseRequest, body: bytes) -> dict:
+    """Build a WSGI environ for the aiohttp request ``req`` (with the already read request body ``body``)"""
+    sockname = req.transport.get_extra_info('sockname') if req.transport is not None else None
+    environ = {
+        'REQUEST_METHOD': req.method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': req.path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': req.query_string,
+        'SERVER_NAME': req.url.host or 'localhost',
+        'SERVER_PORT': str(sockname[1] if sockname else req.url.port or 80),
+        'SERVER_PROTOCOL': f"HTTP/{req.version.major}.{req.version.minor}",
+        'REMOTE_ADDR': req.remote or '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': req.scheme,
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for k, v in req.headers.items():
+        key = k.upper().replace('-', '_')
+        if key in ['CONTENT_TYPE', 'CONTENT_LENGTH']:
+            environ[key] = v
+            continue
+        key = f'HTTP_{key}'
+        environ[key] = f"{environ[key]},{v}" if key in environ else v
+    return environ
+
+
+class AsyncFrontend:
+    """
+    Serves the WSGI (Flask) ``app`` from aiohttp - see the module docstring. Use :meth:`.application` to get
+    the :class:`aiohttp.web.Application`.
+
+        >>> web.run_app(AsyncFrontend().application(), host='127.0.0.1', port=5151)
+
+    """
+    def __init__(self, app: Flask = flask_app, threads: int = None, queue_size: int = 16):
+        self.app = app
+        self.threads = settings.AIO_THREADS if threads is None else threads
+        self.queue_size = queue_size
+        self.pool: Optional[ThreadPoolExecutor] = None
+
+    async def _startup(self, _app: web.Application):
+        self.pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='myip-aio')
+
+    async def _cleanup(self, _app: web.Application):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+    def application(self) -> web.Application:
+        aio = web.Application()
+        aio.router.add_route('*', '/{tail:.*}', self.handle)
+        aio.on_startup.append(self._startup)
+        aio.on_cleanup.append(self._cleanup)
+        return aio
+
+    async def resolve(self, ips: List[str], wait: bool):
+        """Start the rDNS lookups for ``ips`` (checking the cache on the thread pool), and optionally wait for them"""
+        loop = asyncio.get_running_loop()
+        resolver: RDNSResolver = get_resolver()
+        futs = await loop.run_in_executor(self.pool, resolver.prefetch, ips)
+        if not wait or len(futs) == 0:
+            return
+        # asyncio.wait never cancels the wrapped lookups, so other requests waiting on the same address aren't affected
+        await asyncio.wait([asyncio.wrap_future(f) for f in futs], timeout=resolver.timeout)
+
+    def _run_wsgi(self, environ: dict, no_wait: bool, loop: asyncio.AbstractEventLoop, queue: asyncio.Queue, closed: threading.Event):
+        """Runs on the thread pool - calls the WSGI app, passing the status + headers, then each body chunk to ``queue``"""
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        body = None
+        try:
+            with RDNSResolver.no_wait() if no_wait else nullcontext():
+                body = self.app.wsgi_app(environ, start_response)
+                sent_start = False
+                for chunk in body:
+                    if closed.is_set(): return
+                    if not sent_start:
+                        put(tuple(started))
+                        sent_start = True
+                    if chunk: put(chunk)
+                if not sent_start: put(tuple(started))
+        except BaseException as e:
+            log.exception("Error while running WSGI app for %s", environ.get('PATH_INFO'))
+            put(e)
+        finally:
+            if hasattr(body, 'close'): body.close()
+            if not closed.is_set(): put(_END)
+
+    async def handle(self, req: web.Request) -> web.StreamResponse:
+        loop = asyncio.get_running_loop()
+        body = await req.read()
+        ips, wait, no_wait = await loop.run_in_executor(self.pool, rdns_plan, self.app, wsgi_environ(req, body))
+        if len(ips) > 0:
+            await self.resolve(ips, wait)
+
+        queue, closed = asyncio.Queue(maxsize=self.queue_size), threading.Event()
+        job = loop.run_in_executor(self.pool, self._run_wsgi, wsgi_environ(req, body), no_wait, loop, queue, closed)
+        try:
+            start = await queue.get()
+            if isinstance(start, BaseException):
+                raise web.HTTPInternalServerError()
+            status, headers = start
+            code, _, reason = status.partition(' ')
+            resp = web.StreamResponse(status=int(code), reason=reason or None)
+            for k, v in headers:
+                resp.headers.add(k, v)
+            await resp.prepare(req)
+            while True:
+                chunk = await queue.get()
+                if chunk is _END or isinstance(chunk, BaseException):
+                    break
+                await resp.write(chunk)
+            await resp.write_eof()
+            return resp
+        finally:
+            closed.set()
+            # Unblock the WSGI thread if it's waiting to put a chunk into a full queue (e.g. the client disconnected)
+            while not queue.empty():
+                queue.get_nowait()
+            await asyncio.wait([job])
+
+
+def create_app(app: Flask = flask_app, threads: int = None) -> web.Application:
+    """Returns an :class:`aiohttp.web.Application` serving the Flask ``app`` via :class:`.AsyncFrontend`"""
+    return AsyncFrontend(app, threads=threads).application()
+
+
+async def make_app() -> web.Application:
+    """Async app factory for gunicorn's ``aiohttp.GunicornWebWorker`` - ``gunicorn -k aiohttp.GunicornWebWorker myip.aioapp:make_app``"""
+    return create_app()
+
+
+def run(host: str = None, port: int = None):
+    """Run the async server directly (for development) - in production, run it with gunicorn as shown in the module docstring"""
+    web.run_app(create_app(), host=empty_if(host, settings.HOST), port=int(empty_if(port, settings.PORT)))
@@ -19,24 +19,33 @@ Copyright::
 
 
 """
-import inspect
+import csv
+import io
+import os
 import socket
+import time
+from enum import IntFlag
 from dataclasses import dataclass, field
-from ipaddress import IPv4Network, IPv6Address, IPv6Network, ip_address, IPv4Address
-from typing import Any, Callable, Dict, List, Optional, Tuple, Type, Union
-
-import markdown
-from markdown.extensions.toc import TocExtension
-from markdown.extensions.fenced_code import FencedCodeExtension
-from myip import settings
-from myip.core import GeoType, app, cf, dump_yaml, get_cache, get_ip, get_rdns, merge_frm, wants_type
-from flask import Response, request, jsonify, render_template, render_template_string
-from privex.helpers import DictDataClass, DictObject, K, STRBYTES, T, V, empty, empty_if, ip_is_v4, stringify
-from privex.helpers.geoip import GeoIPResult, geolocate_ips
+from ipaddress import IPv4Network, IPv6Address, IPv6Network, ip_address, ip_network, IPv4Address
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from myip import httpcache, metrics, settings
+from myip.codec import decode_geo, encode_geo
+from myip.mmdbtree import overlay
+from myip.profiling import profiled
+from myip.revindex import IndexBuilding, country_key
+from myip.core import (
+    GeoType, app, cf, dump_yaml, get_assets, get_cache, get_cache_many, get_cache_stats, get_geo_net_cache, get_geoip, get_geoip_epoch, get_geoip_registry, get_ip,
+    get_pages, get_rdns, get_rdns_many, get_resolver, get_reverse_index, get_single_flight, merge_frm, set_cache_many, wants_type
+)
+from myip.serializer import register_converter, to_safe
+from flask import Response, abort, g, request, jsonify, stream_with_context
+from privex.helpers import DictDataClass, DictObject, STRBYTES, empty, empty_if, ip_is_v4
+from privex.helpers.exceptions import GeoIPDatabaseNotFound
+from privex.helpers.geoip import GeoIPResult
 import geoip2.errors
 import geoip2.models
 import logging
-import json
 
 log = logging.getLogger(__name__)
 
@@ -73,174 +82,19 @@ class GeoData(dict):
         )
 
 
-def _class_dict(d: Union[type, object], fallback=None, no_private=True, no_protected=True, no_funcs=True):
-    xdt = getattr(d, '__dict__', None)
-    
-    def _chk_func(f):
-        if not no_funcs: return False
-        return inspect.ismethod(f) or inspect.isfunction(f)
-    
-    if xdt is None: return fallback
-    if no_protected:
-        return {k: v for k, v in dict(d.__dict__).items() if not k.startswith('_') and not _chk_func(v)}
-    if no_private:
-        return {k: v for k, v in dict(d.__dict__).items() if not k.startswith('__') and not _chk_func(v)}
-    return {k: v for k, v in dict(d.__dict__).items() if not _chk_func(v)}
-
-
-def _try_dict(d: Any, fb_cast: Type[T] = str, try_class=True) -> Union[dict, T]:
-    try:
-        return dict(d)
-    except Exception:
-        if try_class:
-            cld = d.__class__ if isinstance(d, object) else d
-            if cld.__name__ not in dir(__builtins__):
-                try:
-                    return _class_dict(d)
-                except Exception:
-                    pass
-        return fb_cast(d)
-
-
-CONVERTERS = {
-    bytes: stringify,
-    GeoIPResult: DictObject,
-    GeoData: DictObject,
-    geoip2.models.ASN: lambda a: DictObject(a.raw),
-    geoip2.models.City: lambda a: DictObject(a.raw),
-    geoip2.models.Country: lambda a: DictObject(a.raw),
-    GeoType: lambda a: a.value,
-    IPv4Address: str, IPv6Address: str, IPv4Network: str, IPv6Network: str,
-}
-
-
-def _do_convert(d, fallback=None, fail=False):
-    for k, v in CONVERTERS.items():
-        if not isinstance(d, k) and not type(d) == k: continue
-        try:
-            log.debug(f"Found converter for {d!r} - calling converter function (key: {k!r}): {v!r} ")
-            res = v(d)
-            log.debug(f"Result after passing {d!r} to converter is: {res!r}")
-            return res
-        except Exception as e:
-            log.warning(f"Exception while converting {d!r} - converter function (key: {k!r}): {v!r} - "
-                        f"Exception was: {type(e)} - {e!s}")
-            if fail: raise e
-            continue
-    return fallback
-
-
-def _safe_obj(
-    d: Any, fallback: K = None, fb_cast: Union[V, callable] = str, check_converter=True, do_unsafe_cast=True, **kwargs
-) -> Union[K, V, DictObject, dict, str, Any]:
-    """
-    Convert an object of any kind - into a "safe" type, defined by ``safe_types`` and ``iter_types``. This is intended
-    for preparing an object to be converted into JSON/YAML/etc., by ensuring only primitive types that are widely supported,
-    will be contained in the final object that's outputted.
-    
-    By default, ``safe_types`` contains ``(str, int, float, bool)`` - and ``iter_types`` contains ``(dict, list, tuple, set)``.
-    
-    This will recursively iterate through the contents of an object, converting each value into a safe type in ``safe_types``,
-    using either :attr:`.CONVERTERS` or ``unsafe_cast`` (default: :func:`._try_dict`).
-    
-    It won't convert iterables such as :class:`.dict` / :class:`.list` into a "safe" type, instead, they'll simply have
-    their contents recursively casted into safe types.
-    
-    
-    """
-    safe_types = tuple(empty_if(kwargs.pop('safe_types', None), (str, int, float, bool), itr=True, zero=True))
-    iter_types = tuple(empty_if(kwargs.pop('iter_types', None), (dict, list, tuple, set), itr=True, zero=True))
-    unsafe_cast = kwargs.pop('unsafe_cast', _try_dict if do_unsafe_cast else fb_cast)
-    iter_cast: Optional[Callable[[Union[list, tuple, set]], K]] = kwargs.pop('iter_cast', None)
-    dict_cast: Optional[Callable[[Union[dict, DictObject]], K]] = kwargs.pop('dict_cast', DictObject)
-    self_kw = {**dict(fallback=fallback, fb_cast=fb_cast, check_converter=check_converter, do_unsafe_cast=do_unsafe_cast), **kwargs}
-    
-    if check_converter:
-        for k, v in CONVERTERS.items():
-            if not isinstance(d, k) and not type(d) == k: continue
-            try:
-                log.debug(f"Found converter for {d!r} - calling converter function (key: {k!r}): {v!r} ")
-                res = v(d)
-                log.debug(f"Result after passing {d!r} to converter is: {res!r}")
-                if res is not None:
-                    if isinstance(res, safe_types): return res
-                    d = res
-                    break
-                    # if not isinstance(res, safe_types):
-                    #     return _safe_obj(d, **self_kw)
-                    # return res
-            except Exception as e:
-                log.warning(f"Exception while converting {d!r} - converter function (key: {k!r}): {v!r} - "
-                            f"Exception was: {type(e)} - {e!s}")
-                continue
-    if isinstance(d, safe_types):
-        log.debug(f"Object {d!r} appears to be a safe type - returning normally. Safe types: {safe_types!r}")
-        return d
-    if isinstance(d, dict):
-        log.debug(f"Object {d!r} appears to be a dict(-like) object - iterating over it, and recursively calling"
-                  f" self (_safe_obj). Iter types: {iter_types!r}")
-        cleanobj = {k: _safe_obj(v, **self_kw) for k, v in d.items()}
-        return dict_cast(cleanobj) if dict_cast is not None else cleanobj
-    if isinstance(d, iter_types):
-        log.debug(f"Object {d!r} appears to be an iterable (list-like) object - iterating over it, and recursively calling"
-                  f" self (_safe_obj). Iter types: {iter_types!r}")
-        cleanobj = [_safe_obj(v, **self_kw) for v in d]
-        log.debug(f"Object after recursive cleaning: {cleanobj!r}")
-        if iter_cast is not None: return iter_cast(cleanobj)
-        return d.__class__(cleanobj) if not isinstance(cleanobj, d.__class__) else cleanobj
-    
-    if do_unsafe_cast:
-        log.debug(f"Passing {d!r} to unsafe_cast ({unsafe_cast!r})")
-    
-        return unsafe_cast(d, fb_cast=fb_cast, try_class=kwargs.pop('try_class', True))
-    log.debug(f"Failed to convert {d!r} - returning fallback: {fallback}")
-    return fallback
-
-
-def _safe_dict(d: Union[T, Dict[str, Any], list], safe_types: tuple = None, **kwargs) -> Union[T, list, dict, DictObject]:
-    safe_types = tuple(empty_if(safe_types, (str, int, float), itr=True, zero=True))
-    iter_types = tuple(empty_if(kwargs.pop('iter_types', None), (dict, list, tuple, set), itr=True, zero=True))
-    unsafe_cast = kwargs.get('unsafe_cast', _try_dict)
-    
-    def _call_self(xdx):
-        return _safe_dict(xdx, safe_types=safe_types, **kwargs)
-    
-    def _so(xdx):
-        return _safe_obj(xdx, safe_types=safe_types, iter_types=iter_types, unsafe_cast=unsafe_cast, **kwargs)
-    
-    if isinstance(d, dict):
-        log.debug(f"(_safe_dict) Object {d!r} appears to be a dict(-like) object - iterating over it, and recursively calling"
-                  f" _safe_obj.")
-        safex = {k: _so(v) for k, v in d.items()}
-        for k, v in safex.items():
-            if isinstance(v, dict) and not isinstance(d[k], dict):
-                log.debug(f"(_safe_dict) Found new dict - converting it's contents to be safe by calling self (_safe_dict). "
-                          f"This new dict is (key: {k!r}): {v!r}")
-                safex[k] = _call_self(v)
-        
-        # return DictObject({**safex, **unsafex, **objsafe})
-        return DictObject(safex)
-    
-    if isinstance(d, iter_types):
-        itr_cast = type(d)
-        log.debug(f"(_safe_dict) Object {d!r} appears to be a iterable object - iterating over it, and recursively calling"
-                  f" _safe_obj. iter_types: {iter_types!r}")
-        return itr_cast([_so(v) for v in d])
-    log.debug(f"(_safe_dict) Object {d!r} doesn't match known types. Passing it to _safe_obj then calling self (_safe_dict)"
-              f"with it's result")
-    res_so = _so(d)
-    log.debug(f"Result from _safe_obj: {res_so} (original object: {d!r})")
-    res_self = _call_self(_so(d))
-    log.debug(f"Result from _safe_dict(_safe_obj(d)): {res_so} (original object: {d!r})")
-    return res_self
+register_converter(GeoData, DictObject)
 
 
 def _safe_geo(
     d: Union[GeoIPResult, Dict[str, Any]], force_safe=False, str_network=True, trim_geoasn=True,
-    trim_geocity=True, **kwargs
+    trim_geocity=True
 ) -> Union[dict, DictObject]:
+    if isinstance(d, GeoIPResult):
+        # Drop the raw geoip2 models before converting, rather than converting them only to throw them away
+        trim = {k for k, trimmed in [('geoasn_data', trim_geoasn), ('geocity_data', trim_geocity)] if trimmed}
+        d, force_safe = {k: v for k, v in DictObject(d).items() if k not in trim}, True
     if force_safe or not isinstance(d, (DictObject, dict)):
-        d = _safe_dict(d, **kwargs)
+        d = to_safe(d)
     d = DictObject(d)
     if str_network and not isinstance(d.network, str):
         d.network = str(d.network)
@@ -251,6 +105,16 @@ def _safe_geo(
     return d
 
 
+def geo_cache_key(ip: str, epoch: str = None) -> str:
+    """
+    The cache key for the GeoIP data of ``ip`` - ``geoip:<epoch>:<ip>``, where ``epoch`` (default: the current
+    :func:`myip.core.get_geoip_epoch`) is the build epoch of the loaded ASN + City databases. Entries cached from an
+    older database build are simply never read again (and expire by themselves), so updating the databases doesn't
+    need the cache to be flushed - and ``settings.GEOIP_CACHE_SEC`` can be days rather than minutes.
+    """
+    return f"geoip:{get_geoip_epoch() if epoch is None else epoch}:{ip}"
+
+
 def get_geodata(ip, fail=False) -> Optional[GeoIPResult]:
     """
     Obtain GeoIP information for a given IPv4/v6 address, using Redis for caching to prevent excessive GeoIP2 querying.
@@ -268,26 +132,243 @@ def get_geodata(ip, fail=False) -> Optional[GeoIPResult]:
     
     """
     ip = str(ip)
-    r, rkey = get_cache(), f'geoip:{ip}'
-    cgdata: STRBYTES = r.get(rkey)
+    ngdata = _net_cached_geodata(ip)
+    if ngdata is not None:
+        return GeoIPResult(**ngdata)
+    
+    key = geo_cache_key(ip)
+    cgdata: STRBYTES = metrics.cache_get(get_cache(), key)
 
     if not empty(cgdata):
-        return GeoIPResult(**json.loads(cgdata))
+        return GeoIPResult(**decode_geo(cgdata))
+    
+    return _load_geodata(ip, fail=fail, key=key)[0]
+
+
+def get_safe_geodata(ip, fail=False) -> Optional[DictObject]:
+    """
+    Same as :func:`.get_geodata`, but returns the GeoIP data in it's safe (JSON serializable) form produced by
+    :func:`._safe_geo` - which is the form it's cached in.
+    
+    This means a cache hit only costs one cache read and one :func:`myip.codec.decode_geo`, instead of also building
+    a :class:`.GeoIPResult` and converting it straight back into a dict with :func:`myip.serializer.to_safe`.
+    
+        >>> gd = get_safe_geodata('2a07:e00::666')
+        >>> gd.city, gd.network
+        ('Stockholm', '2a07:e00::/29')
+    
+    """
+    ip = str(ip)
+    ngdata = _net_cached_geodata(ip)
+    if ngdata is not None:
+        return ngdata
+    
+    key = geo_cache_key(ip)
+    cgdata = _cached_geodata(ip, key)
+    if cgdata is not None:
+        return cgdata
+    return _load_geodata(ip, fail=fail, key=key)[1]
+
+
+def _cached_geodata(ip: str, key: str = None) -> Optional[DictObject]:
+    """
+    Returns the safe form GeoIP data for ``ip`` cached under ``key`` (default: :func:`.geo_cache_key`) in the cache adapter,
+    or ``None`` if it isn't cached - without looking it up.
+    """
+    cgdata: STRBYTES = metrics.cache_get(get_cache(), geo_cache_key(ip) if key is None else key)
+    return None if empty(cgdata) else decode_geo(cgdata)
+
+
+def get_safe_geodata_many(ips: Iterable[Union[str, IPv4Address, IPv6Address]]) -> Dict[str, Optional[DictObject]]:
+    """
+    Batch version of :func:`.get_safe_geodata` - returns a dict mapping each (de-duplicated) address to it's GeoIP data
+    in safe form, or ``None`` if it's invalid / not found in the GeoIP databases.
     
+    Addresses which aren't in the GeoIP network cache have their :func:`.geo_cache_key` s fetched with a single
+    :func:`myip.core.get_cache_many`, and the results of any GeoIP2 lookups for cache misses are written back with
+    a single :func:`myip.core.set_cache_many` - so a batch costs two cache round-trips, rather than up to two per address.
+    
+        >>> res = get_safe_geodata_many(['185.130.44.1', '8.8.8.8', '10.0.0.1'])
+        >>> res['185.130.44.1'].city, res['10.0.0.1']
+        ('Stockholm', None)
+    
+    """
+    res: Dict[str, Optional[DictObject]] = {}
+    remaining = []
+    for ip in dict.fromkeys(str(xip) for xip in ips):
+        try:
+            res[ip] = _net_cached_geodata(ip)
+        except geoip2.errors.AddressNotFoundError:
+            res[ip] = None
+            continue
+        if res[ip] is None:
+            remaining.append(ip)
+    
+    epoch = get_geoip_epoch()
+    cached, pending = get_cache_many(geo_cache_key(ip, epoch) for ip in remaining), {}
+    for ip in remaining:
+        key = geo_cache_key(ip, epoch)
+        cgdata: STRBYTES = cached.get(key)
+        try:
+            res[ip] = decode_geo(cgdata) if not empty(cgdata) else _load_geodata(ip, pending=pending, key=key)[1]
+        except geoip2.errors.AddressNotFoundError:
+            res[ip] = None
+    if len(pending) > 0:
+        set_cache_many(pending, cf['GEOIP_CACHE_SEC'])
+    return res
+
+
+def get_geodata_many(ips: Iterable[Union[str, IPv4Address, IPv6Address]]) -> Dict[str, Optional[GeoIPResult]]:
+    """
+    Batch version of :func:`.get_geodata` - the same as :func:`.get_safe_geodata_many`, but with each address's data
+    as a :class:`.GeoIPResult`
+    """
+    return {ip: None if gdata is None else GeoIPResult(**gdata) for ip, gdata in get_safe_geodata_many(ips).items()}
+
+
+_NET_NOT_FOUND = DictObject(not_found=True)
+"""Stored in the GeoIP network cache for networks which aren't in the GeoIP2 City database"""
+
+
+def _net_cached_geodata(ip: str) -> Optional[DictObject]:
+    """
+    Returns the safe form GeoIP data for ``ip`` from the in-process GeoIP network cache (:func:`myip.core.get_geo_net_cache`),
+    or ``None`` if no cached network contains ``ip``. Raises :class:`geoip2.errors.AddressNotFoundError` if ``ip``
+    is inside a network which is cached as not found.
+    """
+    if not settings.GEOIP_NET_CACHE:
+        return None
     try:
-        gdata: List[Tuple[str, GeoIPResult]] = list(geolocate_ips(ip, throw=fail))
-    except (AttributeError, ValueError) as e:
-        log.warning(f"Exception while calling geolocate_ips({ip!r}) - reason: {type(e)} - {e!s}")
-        emg = str(e).lower()
-        if "no attribute 'country'" in emg or "no attribute 'city'" in emg or "no attribute 'as_name'" in emg:
-            raise geoip2.errors.AddressNotFoundError(f"Address {ip!r} is invalid, or not found in GeoIP2 DBs "
-                                                     f"(original exception was: {type(e)} - {e!s})")
-        if fail: raise e
+        ipo = ip_address(ip)
+    except ValueError:
+        return None
+    data = get_geo_net_cache().get(ipo)
+    metrics.cache_event('geonet', 'miss' if data is None else 'hit')
+    if data is None:
         return None
-    data = None if empty(gdata, itr=True) else gdata[0][1]
-    r.set(rkey, json.dumps(_safe_geo(data, True)), cf['GEOIP_CACHE_SEC'])
+    if data is _NET_NOT_FOUND:
+        raise geoip2.errors.AddressNotFoundError(f"Address {ip!r} is invalid, or not found in GeoIP2 DBs (network cache)")
+    # Everything except the looked up address itself is the same for every address in the network
+    return DictObject(data) if data.get('ip_address') is None else DictObject(data, ip_address=str(ipo))
+
+
+def _load_geodata(
+    ip: str, fail=False, pending: Dict[str, Any] = None, key: str = None
+) -> Tuple[Optional[GeoIPResult], Optional[DictObject]]:
+    """
+    Look up ``ip`` using :func:`._geolocate_net`, and cache the result - in it's safe form under ``key`` (default:
+    :func:`.geo_cache_key`, see :func:`._cache_geodata`), and in the in-process GeoIP network cache against the network
+    it applies to. The key should be worked out before the lookup, so data from a database which was updated in
+    between is never cached under the older build's key.
     
-    return data
+    With ``settings.SINGLE_FLIGHT`` enabled, concurrent calls for the same address share a single lookup
+    (see :func:`myip.core.get_single_flight`).
+    
+    If ``pending`` is passed, the cache entry is added to it instead of being written straight away,
+    so a batch of lookups can be written with a single :func:`myip.core.set_cache_many`.
+    
+    :return tuple res: The :class:`.GeoIPResult` from :func:`._geolocate_net`, and it's safe form
+    """
+    key = geo_cache_key(ip) if key is None else key
+    if settings.SINGLE_FLIGHT:
+        return get_single_flight().do(f'{key}:{fail}', _fetch_geodata, ip, fail, pending, key)
+    return _fetch_geodata(ip, fail, pending, key)
+
+
+def _fetch_geodata(
+    ip: str, fail=False, pending: Dict[str, Any] = None, key: str = None
+) -> Tuple[Optional[GeoIPResult], Optional[DictObject]]:
+    netcache = get_geo_net_cache() if settings.GEOIP_NET_CACHE else None
+    try:
+        with metrics.timer('geoip'):
+            data, net = _geolocate_net(ip, fail=fail)
+    except geoip2.errors.AddressNotFoundError as e:
+        if netcache is not None and getattr(e, 'network', None) is not None:
+            netcache.set(e.network, _NET_NOT_FOUND)
+        raise e
+    sdata = _cache_geodata(ip, data, pending, key)
+    if netcache is not None and net is not None and sdata is not None:
+        netcache.set(net, sdata)
+    return data, sdata
+
+
+def _cache_geodata(ip: str, data: Optional[GeoIPResult], pending: Dict[str, Any] = None, key: str = None) -> Optional[DictObject]:
+    """
+    Convert ``data`` into it's safe form using :func:`._safe_geo`, and cache it (encoded by :func:`myip.codec.encode_geo`)
+    under ``key`` (default: :func:`.geo_cache_key`) - or add it to ``pending`` (``{key: encoded}``) if it's passed,
+    for the caller to write in bulk
+    """
+    if data is None:
+        return None
+    key = geo_cache_key(ip) if key is None else key
+    with metrics.timer('serialize'):
+        sdata = _safe_geo(data, True)
+        enc = encode_geo(sdata)
+    if pending is not None:
+        pending[key] = enc
+        return sdata
+    with metrics.timer('cache'):
+        get_cache().set(key, enc, cf['GEOIP_CACHE_SEC'])
+    return sdata
+
+
+def _geolocate(ip: str, fail=False) -> Optional[GeoIPResult]:
+    """
+    Look up ``ip`` against the GeoIP2 City + ASN databases (bypassing the cache), using the shared readers from
+    :func:`myip.core.get_geoip`.
+    
+    Raises :class:`geoip2.errors.AddressNotFoundError` if the address is invalid, or couldn't be found in the GeoIP2 City DB.
+    With ``fail=True``, the original exception is raised instead - and addresses missing from the ASN DB raise too.
+    """
+    return _geolocate_net(ip, fail=fail)[0]
+
+
+def _geolocate_net(ip: str, fail=False) -> Tuple[Optional[GeoIPResult], Optional[Union[IPv4Network, IPv6Network]]]:
+    """
+    Same as :func:`._geolocate`, but also returns the network which the result applies to - the most specific of the
+    City and ASN networks containing ``ip``, as every address in it gets the same answer from both databases (other than
+    ``ip_address``). The network is ``None`` if it couldn't be determined.
+    
+    When the address isn't found in the City DB, the :class:`geoip2.errors.AddressNotFoundError` raised keeps
+    the ``network`` of the original error (the network in which no address would be found).
+    """
+    ip, res, nets = str(ip), GeoIPResult(), []
+    try:
+        city: geoip2.models.City = get_geoip(GeoType.CITY).city(ip)
+        res.geocity_data, res.country_code, res.country = city, city.country.iso_code, city.country.names.get('en', None)
+        res.city, res.postcode = city.city.names.get('en', None), city.postal.code
+        res.long, res.lat = city.location.longitude, city.location.latitude
+        nets.append(city.traits.network)
+    except (geoip2.errors.AddressNotFoundError, GeoIPDatabaseNotFound, ValueError) as e:
+        if fail: raise e
+        raise _not_found(ip, e)
+    except Exception as e:
+        log.warning("Failed to resolve Country / City for %s - Reason: %s %s", ip, type(e), str(e))
+        nets.append(None)
+    try:
+        asn: geoip2.models.ASN = get_geoip(GeoType.ASN).asn(ip)
+        res.as_name, res.as_number = asn.autonomous_system_organization, asn.autonomous_system_number
+        res.network, res.ip_address, res.geoasn_data = asn.network, asn.ip_address, asn
+        nets.append(asn.network)
+    except geoip2.errors.AddressNotFoundError as e:
+        if fail: raise e
+        nets.append(getattr(e, 'network', None))
+    except Exception as e:
+        log.warning("Failed to resolve ASN for %s - Reason: %s %s", ip, type(e), str(e))
+        nets.append(None)
+    # Same as privex's geolocate_ips - a result with ASN + co-ordinates, but no country, is treated as not found
+    if empty(res.country) and empty(res.country_code) and all([res.as_name, res.as_number, res.lat, res.long]):
+        return None, None
+    net = None if None in nets else max(nets, key=lambda n: n.prefixlen)
+    return res, net
+
+
+def _not_found(ip: str, e: Exception) -> geoip2.errors.AddressNotFoundError:
+    """The :class:`geoip2.errors.AddressNotFoundError` raised for ``ip`` when a GeoIP2 lookup failed with ``e``"""
+    return geoip2.errors.AddressNotFoundError(
+        f"Address {ip!r} is invalid, or not found in GeoIP2 DBs (original exception was: {type(e)} - {e!s})",
+        getattr(e, 'ip_address', None), getattr(e, '_prefix_len', None)
+    )
 
 
 def get_ip_info(ip):
@@ -325,11 +406,27 @@ class GeoResult(DictDataClass):
     def ip_obj(self) -> Union[IPv4Address, IPv4Address]:
         return ip_address(self.ip)
 
-    def init_ip(self, ip: str = None):
+    def init_ip(self, ip: str = None, rdns=True, rdns_wait=True):
         self.ip = str(ip if not empty(ip) else self.ip)
         self.ip_type = 'ipv4' if isinstance(self.ip_obj, IPv4Address) else 'ipv6'
         self.ip_valid = True
-        self.hostname = get_rdns(self.ip)
+        if rdns: self.hostname = get_rdns(self.ip, wait=rdns_wait)
+    
+    def set_geo(self, gdata: Optional[Union[GeoIPResult, DictObject]]):
+        """
+        Set :attr:`.geo` from the result of :func:`.get_safe_geodata` / :func:`.get_geodata` - or mark this result
+        as an error if it's ``None``. Data which is already in it's safe form (a dict) isn't passed through :func:`myip.serializer.to_safe` again.
+        """
+        if gdata is None:
+            return self.set_geo_error(f"IP address '{self.ip}' not found in GeoIP database.")
+        self.geo = _safe_geo(gdata)
+        self.geo.error = False
+    
+    def set_geo_error(self, msg: str):
+        log.info(msg)
+        self.geo = DictObject(error=True, message=msg)
+        self.error = True
+        self.messages += [msg]
     
     def __post_init__(self):
         if not empty(self.ip):
@@ -337,25 +434,17 @@ class GeoResult(DictDataClass):
         self.ua = empty_if(self.ua, 'Empty User Agent')
 
 
-def geo_view(ip: Union[str, IPv4Address, IPv4Address], ua: str = None, **extra) -> GeoResult:
+def geo_view(ip: Union[str, IPv4Address, IPv4Address], ua: str = None, rdns_wait=True, **extra) -> GeoResult:
     # data = DictObject(geo=DictObject(), hostname='', messages=[], ip_valid=False)
     # data = DictObject({**data, **extra})
     data = GeoResult(ip=None, ua=ua, **extra)
     # data.geo = DictObject()
     try:
-        data.init_ip(ip)
+        data.init_ip(ip, rdns_wait=rdns_wait)
         data.ip_valid = True
-        gdata = get_geodata(ip)
-        if gdata is None:
-            raise geoip2.errors.AddressNotFoundError(f"GeoIPResult was empty!")
-        data.geo = DictObject(_safe_geo(get_geodata(ip)))
-        data.geo.error = False
+        data.set_geo(get_safe_geodata(ip))
     except geoip2.errors.AddressNotFoundError:
-        msg = f"IP address '{ip}' not found in GeoIP database."
-        log.info(msg)
-        data.geo = DictObject(error=True, message=msg)
-        data.error = True
-        data.messages += [msg]
+        data.set_geo_error(f"IP address '{ip}' not found in GeoIP database.")
     except ValueError:
         log.warning(f'The IP address "{ip}" was not valid... Use header: {cf["USE_IP_HEADER"]} / Header: "{cf["IP_HEADER"]}"')
         data.messages += ['Invalid IP address detected']
@@ -363,6 +452,293 @@ def geo_view(ip: Union[str, IPv4Address, IPv4Address], ua: str = None, **extra)
     return data
 
 
+def lookup_many(ips: Iterable[Union[str, IPv4Address, IPv6Address]], ua: str = None, rdns=True, **extra) -> Dict[str, GeoResult]:
+    """
+    Batch version of :func:`.geo_view` - looks up multiple IP addresses at once, returning a :class:`.dict` which maps
+    each address to it's :class:`.GeoResult`.
+    
+    Unlike calling :func:`.geo_view` in a loop, duplicate addresses are only looked up once, the GeoIP data is fetched
+    with :func:`.get_safe_geodata_many` (one cache read and at most one cache write for the whole batch), and the reverse
+    DNS lookups are ran concurrently by :meth:`myip.rdns.RDNSResolver.resolve_many` (sharing a single
+    ``settings.RDNS_TIMEOUT`` deadline, and reading the cached hostnames in one go).
+    
+        >>> res = lookup_many(['185.130.44.1', '8.8.8.8', '185.130.44.1'])
+        >>> res['185.130.44.1'].geo.city
+        'Stockholm'
+    
+    :param ips: An iterable of IPv4 and/or IPv6 addresses to look up
+    :param str ua: The user agent to include in each :class:`.GeoResult`
+    :param bool rdns: (Default: ``True``) Whether or not to look up the reverse DNS hostname for each address
+    :return Dict[str,GeoResult] results: A dict mapping each (de-duplicated) address to it's :class:`.GeoResult`
+    """
+    results: Dict[str, GeoResult] = {}
+    for ip in dict.fromkeys(str(xip) for xip in ips):
+        data = results[ip] = GeoResult(ip=None, ua=ua, **extra)
+        try:
+            data.init_ip(ip, rdns=False)
+        except ValueError:
+            log.warning(f'The IP address "{ip}" was not valid (batch lookup)')
+            data.messages += ['Invalid IP address detected']
+            data.ip_valid = False
+    valid = [ip for ip, data in results.items() if data.ip_valid]
+    
+    for ip, gdata in get_safe_geodata_many(valid).items():
+        results[ip].set_geo(gdata)
+    
+    if rdns and len(valid) > 0:
+        for ip, hostname in get_rdns_many(valid).items():
+            results[ip].hostname = hostname
+    return results
+
+
+def _is_ip(ip: str) -> bool:
+    try:
+        ip_address(ip)
+        return True
+    except ValueError:
+        return False
+
+
+def iter_lookups(
+    ips: Iterable[Union[str, IPv4Address, IPv6Address]], ua: str = None, rdns=True, batch_size: int = None, **extra
+) -> Iterator[Tuple[str, GeoResult]]:
+    """
+    Streaming version of :func:`.lookup_many` - yields ``(address, GeoResult)`` for each (de-duplicated) address in
+    ``ips``, looking up ``batch_size`` addresses at a time (default: ``settings.LOOKUP_STREAM_BATCH``), so the first
+    results are available long before the last address has been looked up.
+    
+    The reverse DNS lookups for every address are started up-front, and share a single ``settings.RDNS_TIMEOUT``
+    deadline (as with :func:`.lookup_many`), rather than each batch waiting up to ``RDNS_TIMEOUT`` seconds.
+    
+        >>> for ip, res in iter_lookups(['185.130.44.1', '8.8.8.8']):
+        ...     print(ip, res.geo.get('city'))
+        185.130.44.1 Stockholm
+        8.8.8.8 None
+    
+    """
+    ips = list(dict.fromkeys(str(xip) for xip in ips))
+    batch_size = max(int(settings.LOOKUP_STREAM_BATCH if batch_size is None else batch_size), 1)
+    resolver = get_resolver()
+    deadline = time.monotonic() + resolver.timeout
+    if rdns:
+        resolver.prefetch(ip for ip in ips if _is_ip(ip))
+    for i in range(0, len(ips), batch_size):
+        results = lookup_many(ips[i:i + batch_size], ua=ua, rdns=False, **extra)
+        if rdns:
+            valid = [ip for ip, data in results.items() if data.ip_valid]
+            for ip, hostname in resolver.resolve_many(valid, timeout=max(0.0, deadline - time.monotonic())).items():
+                results[ip].hostname = hostname
+        yield from results.items()
+
+
+STREAM_TYPES = dict(ndjson='application/x-ndjson', csv='text/csv')
+"""Output formats which :func:`.view_lookup` streams one address at a time, and their content types"""
+
+CSV_FIELDS = [
+    'ip', 'ip_valid', 'ip_type', 'hostname', 'error', 'country', 'country_code', 'city', 'postcode',
+    'as_number', 'as_name', 'network', 'lat', 'long', 'message'
+]
+"""The columns of ``csv`` output - ``ip`` / ``ip_valid`` / ``ip_type`` / ``hostname`` / ``error`` come from the
+:class:`.GeoResult`, ``message`` is the first error message (if any), and the rest come from :attr:`.GeoResult.geo`"""
+
+
+def csv_row(rec: dict) -> list:
+    """Convert a safe (see :func:`myip.serializer.to_safe`) :class:`.GeoResult` into a row of :attr:`.CSV_FIELDS` values"""
+    geo = rec.get('geo', {})
+    messages = rec.get('messages', []) or [geo.get('message', '')]
+    row = dict(
+        geo, ip=rec.get('ip'), ip_valid=rec.get('ip_valid'), ip_type=rec.get('ip_type'), hostname=rec.get('hostname'),
+        error=rec.get('error') or geo.get('error', False), message=messages[0] if len(messages) > 0 else ''
+    )
+    return ['' if row.get(f) is None else row.get(f, '') for f in CSV_FIELDS]
+
+
+def _stream_lookup(iplist: Iterable[str], ua: str, fmt: str) -> Response:
+    """Stream the results for ``iplist`` as ``ndjson`` (one JSON object per line) or ``csv`` (with a header row)"""
+    def _gen():
+        if fmt == 'csv':
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(CSV_FIELDS)
+        for xip, xres in iter_lookups(iplist, ua=ua):
+            if fmt == 'csv':
+                writer.writerow(csv_row(to_safe(xres)))
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+            else:
+                yield app.json.dumps(to_safe(xres)) + "\n"
+        if fmt == 'csv' and buf.tell() > 0:
+            yield buf.getvalue()
+
+    return Response(stream_with_context(_gen()), status=200, content_type=STREAM_TYPES[fmt])
+
+
+def lookup_dtype(frm: dict, wanted: str, dtype: str = None) -> Optional[str]:
+    """Returns the plain text field which a ``/lookup`` or index response will contain, or ``None`` if it contains full records"""
+    if not empty(dtype) or wanted == 'text':
+        return empty_if(dtype, frm.get('type', frm.get('dtype', 'all')))
+    return None
+
+
+def _echoes_ua(wanted: str, dtype: Optional[str]) -> bool:
+    """Whether a response in the format ``wanted`` (returning the plain text field ``dtype``) contains the client's User-Agent"""
+    if dtype is None:
+        return wanted != 'csv'
+    return FLAT_ALIASES.get(dtype.lower(), FLAT_DEFAULT) in (FLAT_ALIASES['ua'], FLAT_ALIASES['all'])
+
+
+def response_etag(kind: str, ips: Union[str, Iterable[str]], wanted: str, dtype: str = None, ua: str = None) -> Tuple[str, bool]:
+    """
+    Returns ``(etag, echoes_ua)`` for a ``kind`` (``lookup`` / ``index`` / ``flat``) response about ``ips``, in the
+    format ``wanted``, returning the plain text field ``dtype`` (see :func:`.lookup_dtype`) - see :mod:`myip.httpcache`.
+
+    The ETag covers the GeoIP2 database build epoch, the ``User-Agent`` if the response echoes it (``echoes_ua``),
+    and for HTML pages, the requested host (they link to the v4 / v6 subdomains), the version of the built static
+    assets - rebuilding them deletes the old fingerprinted files, which a revalidated page would still link to - and
+    of the page's templates (see :meth:`myip.pages.PageRenderer.index_version`).
+    """
+    ips = ips if isinstance(ips, str) else ','.join(str(x) for x in ips)
+    echoes_ua = _echoes_ua(wanted, dtype)
+    html = (request.host, get_assets().version, get_pages().index_version()) if wanted == 'html' else ('',)
+    etag = httpcache.make_etag(kind, ips, wanted, empty_if(dtype, ''), get_geoip_epoch(), ua if echoes_ua else '', *html)
+    return etag, echoes_ua
+
+
+def http_validate(kind: str, ips: Union[str, Iterable[str]], wanted: str, dtype: str = None, ua: str = None, public=False) -> Optional[Response]:
+    """
+    Set the HTTP cache headers for the current response with :func:`myip.httpcache.validate` - returns a ``304`` response
+    if the client already has it. ``public`` responses (about an explicitly requested address) ``Vary`` on the
+    ``User-Agent`` when they echo it.
+    """
+    etag, echoes_ua = response_etag(kind, ips, wanted, dtype, ua)
+    return httpcache.validate(etag, public, ('Accept', 'User-Agent') if public and echoes_ua else ('Accept',))
+
+
+def lookup_args(frm: dict, ip_addr: str = None) -> Tuple[Optional[str], Union[list, tuple, Any]]:
+    """Returns the single address (``ip`` / ``ip_addr``) and the list of batch addresses (``ips``) passed to :func:`.view_lookup`"""
+    ip = frm.get('ip', frm.get('address', frm.get('addr', frm.get('ip_address', ip_addr))))
+    iplist = frm.get('ips', frm.get('addresses', frm.get('addrs', frm.get('ip_addresses', []))))
+    if not empty(iplist, itr=True) and isinstance(iplist, str):
+        iplist = iplist.split(',')
+    return ip, iplist
+
+
+def error_response(wanted: str, code: str, message: str, status: int) -> Response:
+    """Returns an error response in the format ``wanted`` (plain text for ``text`` / ``csv``)"""
+    if wanted in ['text', 'csv']:
+        return Response(f"ERROR: {message} (code: {code})", status=status, content_type='text/plain')
+    edict = dict(error=True, code=code, message=message)
+    if wanted == 'yaml':
+        return Response(dump_yaml(edict), status=status, content_type='text/yaml')
+    res = jsonify(edict)
+    res.status_code = status
+    return res
+
+
+CIDR_FIELDS = ['network', 'country', 'country_code', 'city', 'postcode', 'lat', 'long', 'as_number', 'as_name']
+"""The fields of each network returned by :func:`.lookup_cidr` (and the columns of ``csv`` CIDR lookups)"""
+
+
+def _cidr_city(rec: dict) -> dict:
+    country, loc = rec.get('country', {}), rec.get('location', {})
+    return dict(
+        country=country.get('names', {}).get('en'), country_code=country.get('iso_code'), city=rec.get('city', {}).get('names', {}).get('en'),
+        postcode=rec.get('postal', {}).get('code'), lat=loc.get('latitude'), long=loc.get('longitude')
+    )
+
+
+def _cidr_asn(rec: dict) -> dict:
+    return dict(as_number=rec.get('autonomous_system_number'), as_name=rec.get('autonomous_system_organization'))
+
+
+def _walk_db(gtype: GeoType, network: Union[IPv4Network, IPv6Network], transform: Callable[[dict], dict]) -> Iterable:
+    try:
+        return get_geoip_registry().tree(gtype.value).walk(network, transform=transform)
+    except GeoIPDatabaseNotFound:
+        log.warning("GeoIP %s database not found - CIDR lookups won't include it's data", gtype.value)
+        return []
+
+
+def lookup_cidr(network: Union[str, IPv4Network, IPv6Network], limit: int = None) -> Iterator[DictObject]:
+    """
+    Yields the GeoIP data (:attr:`.CIDR_FIELDS`) for each distinct network inside the CIDR range ``network``, from a single
+    walk of the City and ASN database search trees (see :mod:`myip.mmdbtree`) - rather than looking up each address.
+    Stops after ``limit`` networks, if it's set.
+
+        >>> for rec in lookup_cidr('185.130.44.0/22'):
+        ...     print(rec.network, rec.city, rec.as_number)
+        185.130.44.0/23 Stockholm 210083
+        185.130.46.0/24 Amsterdam 210083
+        185.130.47.0/24 Amsterdam 210083
+
+    """
+    network = ip_network(network, strict=False)
+    empty_city, empty_asn = dict.fromkeys(CIDR_FIELDS[1:7]), dict.fromkeys(CIDR_FIELDS[7:])
+    walk = overlay(_walk_db(GeoType.CITY, network, _cidr_city), _walk_db(GeoType.ASN, network, _cidr_asn), within=network)
+    for i, (net, (city, asn)) in enumerate(walk):
+        if limit is not None and i >= limit:
+            return
+        yield DictObject(network=str(net), **(empty_city if city is None else city), **(empty_asn if asn is None else asn))
+
+
+def lookup_cidr_arg(frm: dict, ip: Optional[str], dtype: Optional[str]) -> Optional[str]:
+    """
+    Returns the CIDR range requested from :func:`.view_lookup` - from ``cidr=``, an address containing a ``/``, or
+    ``/lookup/<address>/<prefix length>`` (which is routed as an address and a ``dtype`` of only digits) - or ``None``.
+    """
+    cidr = frm.get('cidr', frm.get('network'))
+    if not empty(cidr):
+        return str(cidr).strip()
+    if not empty(ip) and '/' in str(ip):
+        return str(ip).strip()
+    if not empty(ip) and not empty(dtype) and str(dtype).isdigit():
+        return f"{str(ip).strip()}/{dtype}"
+    return None
+
+
+def _cidr_text(rec: dict) -> str:
+    return '\t'.join('' if rec.get(f) is None else str(rec[f]) for f in CIDR_FIELDS)
+
+
+def _cidr_response(cidr: str, wanted: str) -> Response:
+    """Respond to a CIDR range lookup (see :func:`.lookup_cidr`) - streamed for plain text / ``ndjson`` / ``csv``"""
+    try:
+        network = ip_network(cidr, strict=False)
+    except ValueError:
+        return error_response(wanted, 'INVALID_CIDR', f"Invalid CIDR range: {cidr}", 400)
+    not_modified = httpcache.validate(httpcache.make_etag('cidr', str(network), wanted, get_geoip_epoch()), public=True)
+    if not_modified is not None:
+        return not_modified
+    limit = settings.CIDR_MAX_NETWORKS
+    if wanted in STREAM_TYPES or wanted == 'text':
+        def _gen():
+            if wanted == 'csv':
+                yield ','.join(CIDR_FIELDS) + "\n"
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            for rec in lookup_cidr(network, limit):
+                if wanted == 'csv':
+                    writer.writerow(['' if rec.get(f) is None else rec[f] for f in CIDR_FIELDS])
+                    yield buf.getvalue()
+                    buf.seek(0)
+                    buf.truncate()
+                elif wanted == 'ndjson':
+                    yield app.json.dumps(rec) + "\n"
+                else:
+                    yield _cidr_text(rec) + "\n"
+
+        return Response(stream_with_context(_gen()), status=200, content_type=STREAM_TYPES.get(wanted, 'text/plain'))
+
+    with metrics.timer('geoip'):
+        nets = list(lookup_cidr(network, limit + 1))
+    data = dict(cidr=str(network), truncated=len(nets) > limit, networks=[dict(n) for n in nets[:limit]])
+    with metrics.timer('render'):
+        if wanted == 'yaml':
+            return Response(dump_yaml(data), status=200, content_type='text/yaml')
+        return jsonify(data)
+
+
 @app.route('/lookup', methods=['GET', 'POST'], defaults=dict(ip_addr=None, dtype=None, bformat=None))
 @app.route('/lookup/', methods=['GET', 'POST'], defaults=dict(ip_addr=None, dtype=None, bformat=None))
 @app.route('/lookup/<ip_addr>', methods=['GET', 'POST'], defaults=dict(dtype=None, bformat=None))
@@ -371,145 +747,489 @@ def geo_view(ip: Union[str, IPv4Address, IPv4Address], ua: str = None, **extra)
 @app.route('/lookup.<bformat>/', methods=['GET', 'POST'], defaults=dict(ip_addr=None, dtype=None))
 @app.route('/lookup.<bformat>/<ip_addr>', methods=['GET', 'POST'], defaults=dict(dtype=None))
 @app.route('/lookup.<bformat>/<ip_addr>/<dtype>', methods=['GET', 'POST'], defaults=dict())
+@profiled
 def view_lookup(ip_addr=None, dtype=None, bformat=None):
     frm = merge_frm(req=request)
-    ip = frm.get('ip', frm.get('address', frm.get('addr', frm.get('ip_address', ip_addr))))
-    iplist = frm.get('ips', frm.get('addresses', frm.get('addrs', frm.get('ip_addresses', []))))
+    ip, iplist = lookup_args(frm, ip_addr)
     ua = request.headers.get('User-Agent', 'N/A')
 
     wanted = wants_type() if 'format' in frm else wants_type(fmt=bformat)
 
-    if not empty(iplist, itr=True) and isinstance(iplist, str):
-        iplist = iplist.split(',')
-    
+    cidr = lookup_cidr_arg(frm, ip, dtype)
+    if cidr is not None:
+        return _cidr_response(cidr, wanted)
+
     if not empty(iplist, itr=True) and isinstance(iplist, (list, tuple)):
         if len(iplist) > settings.MAX_ADDRESSES:
-            ecode, emsg = "TOO_MANY_ADDRS", f"Too many addresses. You can only lookup {settings.MAX_ADDRESSES} addresses at a time."
-            if not empty(dtype) or wanted == 'text':
-                return Response(f"ERROR: {emsg} (code: {ecode})", status=402, content_type='text/plain')
-            edict = dict(error=True, code=ecode, message=emsg)
-            if wanted == 'yaml':
-                return Response(dump_yaml(edict), status=402, content_type='text/yaml')
-            return jsonify(edict), 402
+            emsg = f"Too many addresses. You can only lookup {settings.MAX_ADDRESSES} addresses at a time."
+            return error_response('text' if not empty(dtype) else wanted, 'TOO_MANY_ADDRS', emsg, 402)
 
-        if not empty(dtype) or wanted == 'text':
-            dtype = empty_if(dtype, frm.get('type', frm.get('dtype', 'all')))
-            _ln = "\n==========================================================\n"
-            res_txt = _ln.lstrip('\n')
-            for xip in iplist:
-                res_txt += get_flat(xip, ua=ua, dtype=dtype) + "\n" + _ln
-            return Response(res_txt, status=200, content_type='text/plain')
-        res_list = {xip: geo_view(xip, ua=ua) for xip in iplist}
+        not_modified = http_validate('lookup', iplist, wanted, lookup_dtype(frm, wanted, dtype), ua, public=True)
+        if not_modified is not None:
+            return not_modified
 
-        rdct = {k: _safe_dict(v) for k, v in res_list.items()}
-        if wanted == 'yaml':
-            return Response(dump_yaml(dict(addresses=rdct)), status=200, content_type='text/yaml')
-        return jsonify(rdct)
+        if empty(dtype) and wanted in STREAM_TYPES:
+            return _stream_lookup(iplist, ua, wanted)
+
+        # Plain text fields which don't show the hostname (e.g. ?type=country) don't need any reverse DNS lookups
+        flat_dtype = lookup_dtype(frm, wanted, dtype)
+        rdns = flat_dtype is None or bool(FLAT_ALIASES.get(flat_dtype.lower(), FLAT_DEFAULT).sources & FlatSource.RDNS)
+        res_list = lookup_many(iplist, ua=ua, rdns=rdns)
 
+        if flat_dtype is not None:
+            _ln = "\n==========================================================\n"
+            res_txt = [_ln.lstrip('\n')]
+            with metrics.timer('render'):
+                for xip, xres in res_list.items():
+                    res_txt += [_flat_result(xres, dtype=flat_dtype), "\n", _ln]
+            return Response(''.join(res_txt), status=200, content_type='text/plain')
+
+        with metrics.timer('serialize'):
+            rdct = {k: to_safe(v) for k, v in res_list.items()}
+        with metrics.timer('render'):
+            if wanted == 'yaml':
+                return Response(dump_yaml(dict(addresses=rdct)), status=200, content_type='text/yaml')
+            return jsonify(rdct)
+
+    public = not empty(ip)
     ip = get_ip() if empty(ip) else ip
     ip = get_ip_info(ip)
-    # ua = h.get('User-Agent', 'Empty User Agent')
-    
-    data = dict(geo_view(ip, ua=ua))
-
-    # wanted = wants_type()
+    not_modified = http_validate('lookup', ip, wanted, lookup_dtype(frm, wanted, dtype), ua, public=public)
+    if not_modified is not None:
+        return not_modified
+    if empty(dtype) and wanted in STREAM_TYPES:
+        return _stream_lookup([ip], ua, wanted)
     if not empty(dtype) or wanted == 'text':
-        dtype = empty_if(dtype, frm.get('type', frm.get('dtype', 'all')))
-        fres = get_flat(ip, ua=ua, dtype=dtype) + "\n"
+        # get_flat only looks up the sources the requested field needs - so the full record is never resolved first
+        fres = get_flat(ip, ua=ua, dtype=lookup_dtype(frm, wanted, dtype)) + "\n"
         return Response(fres, status=200, content_type='text/plain')
-    if wanted == 'yaml':
-        return Response(dump_yaml(data), status=200, content_type='text/yaml')
-    return jsonify(data)
-    # if want_json():
-    #     return jsonify(data)
-    # else:
-    #     return render_template('index.html', v4_host=cf['V4_HOST'], v6_host=cf['V6_HOST'], **data)
+
+    data = geo_view(ip, ua=ua)
+    with metrics.timer('serialize'):
+        data = dict(data)
+    with metrics.timer('render'):
+        if wanted == 'yaml':
+            return Response(dump_yaml(data), status=200, content_type='text/yaml')
+        return jsonify(data)
 
 
 @app.route('/api')
 @app.route('/api/')
 @app.route('/api.html')
 def view_api_docs():
-    tpl = settings.TEMPLATES_DIR / 'api.md'
-    md = markdown.Markdown(extensions=[TocExtension(title='Table of Contents'), FencedCodeExtension()])
-    with open(tpl, 'r') as fh:
-        htres = md.convert(fh.read())
-    # ctx = dict(v4_host=settings.V4_HOST, v6_host=settings.V6_HOST, main_host=settings.MAIN_HOST)
-    return render_template(
-        'mdpage.html', content=render_template_string(htres)
-    )
+    page = get_pages().api_docs(_tpl_add_hosts())
+    not_modified = httpcache.validate(page.etag, public=True, vary=('Accept-Encoding',))
+    if not_modified is not None:
+        return not_modified
+    if page.gzipped is not None and request.accept_encodings.quality('gzip') > 0:
+        res = Response(page.gzipped, status=200, content_type='text/html; charset=utf-8')
+        res.headers['Content-Encoding'] = 'gzip'
+    else:
+        res = Response(page.body, status=200, content_type='text/html; charset=utf-8')
+    res.vary.add('Accept-Encoding')
+    return res
 
 
 @app.route('/flat/', defaults=dict(dtype=None), methods=['GET', 'POST'])
 @app.route('/flat', defaults=dict(dtype=None), methods=['GET', 'POST'])
 @app.route('/flat/<dtype>', methods=['GET', 'POST'])
+@profiled
 def view_flat(dtype=None):
     h = request.headers
     ip = get_ip()
     ua = h.get('User-Agent', 'N/A')
+    not_modified = http_validate('flat', ip, 'text', empty_if(dtype, ''), ua)
+    if not_modified is not None:
+        return not_modified
     fres = get_flat(ip, ua=ua, dtype=dtype) + "\n"
     return Response(fres, status=200, mimetype='text/plain', content_type='text/plain')
 
 
-def get_flat(ip: str, ua: str = None, dtype: str = None, geodata: Union[GeoIPResult, DictObject] = None) -> str:
-    # h = request.headers
-    # ip = get_ip()
-    # ua = h.get('User-Agent', 'N/A')
-    ua = empty_if(ua, 'N/A')
-    dtype = empty_if(dtype, '')
-    if dtype.lower() in ['', 'none', 'ip', 'address', 'addr', 'ipaddr', 'ipaddress', 'ip_address']: return str(ip)
-    if dtype.lower() in ['ua', 'agent', 'useragent', 'user-agent', 'user_agent']: return str(ua)
-    data = get_geodata(ip) if empty(geodata, itr=True) else geodata
-    hostname = get_rdns(ip)
-    ip_type = 'ipv4' if ip_is_v4(ip) else 'ipv6'
-
-    if dtype.lower() in ['version', 'type', 'ipv', 'ipver', 'ipversion', 'ip_version', 'ip-version']: return str(ip_type)
-    if dtype.lower() in ['dns', 'rdns', 'reverse', 'reversedns', 'host', 'hostname', 'arpa', 'rev']: return str(hostname)
-    if dtype.lower() in ['country', 'region']: return str(data.country)
-    if dtype.lower() in ['country_code', 'region_code', 'country-code', 'region-code', 'code']: return str(data.country_code)
-    if dtype.lower() in ['city', 'area']: return str(data.city)
-    if dtype.lower() in ['asfull', 'fullas', 'asnfull', 'fullasn', 'ispfull', 'fullisp', 'as_full', 'full_as', 'full_asn'
-                         'isp_full', 'full_isp', 'asinfo', 'asninfo', 'as_info', 'asn_info', 'isp_info', 'ispinfo']:
-        return f"{data.as_name}\nAS{data.as_number}"
-    if dtype.lower() in ['as', 'asn', 'asnum', 'asnumber', 'as_number', 'isp_num', 'isp_number', 'isp_asn']: return str(data.as_number)
-    if dtype.lower() in ['asname', 'ispname', 'isp', 'as_name', 'isp_name']: return str(data.as_name)
-    if dtype.lower() in ['post', 'postal', 'postcode', 'post_code', 'zip', 'zipcode', 'zip_code']: return str(data.postcode)
-    if dtype.lower() in ['loc', 'locate', 'location', 'countrycity', 'citycountry', 'country_city', 'city_country']:
-        res = ""
-        if not empty(data.city): res += f"{data.city!s}, "
-        if not empty(data.postcode): res += f"{data.postcode!s}, "
-        if not empty(data.country): res += f"{data.country!s}"
-        return res.strip(', ')
-    if dtype.lower() in ['all', 'full', 'info', 'information']:
-        return f"IP: {ip}\nVersion: {ip_type}\nHostname: {hostname}\nUserAgent: {ua}\nCountry: {data.country}\n" \
-               f"CountryCode: {data.country_code}\nCity: {data.city}\nPostcode: {data.postcode}\nLat: {data.lat}\n" \
-               f"Long: {data.long}\nASNum: {data.as_number}\nASName: {data.as_name}\nNetwork: {data.network}\n"
-
-    if dtype.lower() in ['lat', 'latitude']: return str(data.lat)
-    if dtype.lower() in ['lon', 'long', 'longitude']: return str(data.long)
-    if dtype.lower() in ['latlon', 'latlong', 'latitudelongitude', 'pos', 'position', 'cord', 'coord',
-                         'coords', 'coordinate', 'coordinates',  'co-ordinates']:
-        return f"{data.lat:.4f}, {data.long:.4f}"
-
-    return str(ip)
+def _int_arg(frm: dict, key: str, default: int, minimum: int = 1, maximum: int = None) -> int:
+    val = int(frm.get(key, default))
+    if val < minimum or (maximum is not None and val > maximum):
+        raise ValueError(f"'{key}' must be between {minimum} and {maximum}" if maximum is not None else f"'{key}' must be at least {minimum}")
+    return val
+
 
+def _reverse_name(kind: str, network: Union[IPv4Network, IPv6Network, None]) -> Optional[str]:
+    """The AS name / country name for a reverse index ``kind``, from a lookup of an address in one of it's ``network`` s"""
+    if network is None:
+        return None
+    try:
+        if kind == 'asn':
+            return get_geoip(GeoType.ASN).asn(str(network.network_address)).autonomous_system_organization
+        return get_geoip(GeoType.CITY).city(str(network.network_address)).country.names.get('en')
+    except (geoip2.errors.AddressNotFoundError, GeoIPDatabaseNotFound, ValueError):
+        return None
+
+
+def _stream_networks(networks: Iterable[Union[IPv4Network, IPv6Network]], fmt: str) -> Response:
+    """Stream ``networks`` as plain text / ``ndjson`` / ``csv``, one network per line"""
+    def _gen():
+        if fmt == 'csv': yield "network,version\n"
+        for net in networks:
+            if fmt == 'csv': yield f"{net},{net.version}\n"
+            elif fmt == 'ndjson': yield app.json.dumps(dict(network=str(net), version=net.version)) + "\n"
+            else: yield f"{net}\n"
+
+    return Response(stream_with_context(_gen()), status=200, content_type=STREAM_TYPES.get(fmt, 'text/plain'))
+
+
+def reverse_view(kind: str, key_str: str, bformat: str = None):
+    """
+    Shared view for ``/asn/<number>`` and ``/country/<code>`` - lists the networks in an ASN / country from the reverse
+    indexes (see :mod:`myip.revindex`). JSON / YAML responses are paginated (``?page=`` / ``?per_page=``), while plain text,
+    ``ndjson`` and ``csv`` stream every network. ``?version=4`` / ``?version=6`` only returns IPv4 / IPv6 networks.
+    """
+    if not settings.REVERSE_INDEX:
+        abort(404)
+    frm = merge_frm(req=request)
+    wanted = wants_type() if 'format' in frm else wants_type(fmt=bformat)
+    try:
+        if kind == 'asn':
+            key_str = key_str.strip().upper()
+            key_str = key_str[2:] if key_str.startswith('AS') else key_str
+            if not key_str.isdigit() or int(key_str) > 0xFFFFFFFF: raise ValueError(f"Invalid AS number: {key_str}")
+            key = int(key_str)
+        else:
+            key_str = key_str.strip().upper()
+            if len(key_str) != 2 or not key_str.isalpha(): raise ValueError(f"Invalid country code: {key_str}")
+            key = country_key(key_str)
+        version = None if empty(frm.get('version')) else str(frm.get('version')).lower().lstrip('ipv')
+        version = None if version is None else {'4': 4, '6': 6}.get(version, -1)
+        if version == -1: raise ValueError("'version' must be 4 or 6")
+        page = _int_arg(frm, 'page', 1)
+        per_page = _int_arg(frm, 'per_page', settings.REVERSE_INDEX_PAGE_SIZE, maximum=settings.REVERSE_INDEX_MAX_PAGE_SIZE)
+    except ValueError as e:
+        return error_response(wanted, 'INVALID_QUERY', str(e), 400)
+    try:
+        idx = get_reverse_index().get(kind)
+    except IndexBuilding as e:
+        res = error_response(wanted, 'INDEX_BUILDING', str(e), 503)
+        res.headers['Retry-After'] = '30'
+        return res
+    except GeoIPDatabaseNotFound:
+        log.exception("Cannot serve the %s reverse index - GeoIP database not found", kind)
+        return error_response(wanted, 'DATABASE_MISSING', f"The {kind} database is not available.", 503)
+
+    streamed = wanted in STREAM_TYPES or wanted == 'text'
+    not_modified = httpcache.validate(httpcache.make_etag(
+        kind, key, wanted, version or '', '' if streamed else f"{page}/{per_page}", idx.build_epoch
+    ), public=True)
+    if not_modified is not None:
+        return not_modified
+    if streamed:
+        return _stream_networks(idx.networks(key, version)[1], wanted)
+
+    total, nets = idx.networks(key, version, offset=(page - 1) * per_page, limit=per_page)
+    nets = [str(n) for n in nets]
+    name = _reverse_name(kind, next(idx.networks(key, None, limit=1)[1], None))
+    data = dict(as_number=key, as_name=name) if kind == 'asn' else dict(country_code=key_str, country=name)
+    data.update(
+        total=total, page=page, per_page=per_page, pages=(total + per_page - 1) // per_page, networks=nets,
+        index_epoch=idx.build_epoch
+    )
+    with metrics.timer('render'):
+        if wanted == 'yaml':
+            return Response(dump_yaml(data), status=200, content_type='text/yaml')
+        return jsonify(data)
+
+
+@app.route('/asn/<asn>', methods=['GET', 'POST'], defaults=dict(bformat=None))
+@app.route('/asn.<bformat>/<asn>', methods=['GET', 'POST'])
+@profiled
+def view_asn(asn: str, bformat=None):
+    return reverse_view('asn', asn, bformat)
 
+
+@app.route('/country/<code>', methods=['GET', 'POST'], defaults=dict(bformat=None))
+@app.route('/country.<bformat>/<code>', methods=['GET', 'POST'])
+@profiled
+def view_country(code: str, bformat=None):
+    return reverse_view('country', code, bformat)
+
+
+def _ops_denied(what: str) -> Optional[Response]:
+    """Returns a ``403`` response if the client isn't allowed by ``settings.METRICS_ALLOW`` / ``METRICS_TOKEN``, otherwise ``None``"""
+    client = request.headers.get(settings.IP_HEADER) if settings.USE_IP_HEADER else None
+    client = client.split(',')[0].strip() if not empty(client) else request.remote_addr
+    auth = request.headers.get('Authorization', '')
+    token = auth[7:].strip() if auth.lower().startswith('bearer ') else None
+    if metrics.client_allowed(client, token):
+        return None
+    log.warning("Denied access to %s for client %s", what, client)
+    return Response(f"ERROR: You are not allowed to access the {what}.", status=403, content_type='text/plain')
+
+
+@app.route(settings.METRICS_PATH, methods=['GET'])
+def view_metrics():
+    """Prometheus metrics (see :mod:`myip.metrics`) - only for clients allowed by ``settings.METRICS_ALLOW`` / ``METRICS_TOKEN``"""
+    if not metrics.ENABLED:
+        abort(404)
+    denied = _ops_denied('metrics')
+    if denied is not None:
+        return denied
+    body, content_type = metrics.render_latest()
+    return Response(body, status=200, content_type=content_type)
+
+
+def view_status():
+    """
+    Ops status (JSON) for this worker - the loaded GeoIP databases and the epoch which GeoIP cache keys are currently
+    versioned with (see :func:`.geo_cache_key`), plus cache, rDNS, page and reverse index stats. Only for the clients
+    allowed to read the metrics.
+    """
+    denied = _ops_denied('status')
+    if denied is not None:
+        return denied
+    epoch = get_geoip_epoch()
+    data = DictObject(
+        pid=os.getpid(),
+        geoip=DictObject(
+            cache_epoch=epoch, cache_key_prefix=geo_cache_key('', epoch), cache_ttl=settings.GEOIP_CACHE_SEC,
+            **get_geoip_registry().info()
+        ),
+        cache=DictObject(get_cache_stats(), codec=settings.CACHE_CODEC),
+        geo_net_cache=get_geo_net_cache().stats() if settings.GEOIP_NET_CACHE else None,
+        rdns=get_resolver().stats(),
+        pages=get_pages().stats(),
+        reverse_index=get_reverse_index().info() if settings.REVERSE_INDEX else None,
+        assets=DictObject(built=get_assets().built, version=get_assets().version),
+    )
+    res = jsonify(data)
+    res.cache_control.no_store = True
+    return res
+
+
+if not empty(settings.STATUS_PATH):
+    app.add_url_rule(settings.STATUS_PATH, 'view_status', view_status, methods=['GET'])
+
+
+app.jinja_env.globals['assets'] = get_assets()
+
+
+@app.route(f"{settings.ASSETS_URL}/<path:filename>", methods=['GET'])
+def view_asset(filename: str):
+    """Built static assets (see :mod:`myip.assets`) - normally served by the webserver instead"""
+    return get_assets().response(filename)
+
+
+@app.after_request
+def _http_cache_headers(response: Response):
+    return httpcache.apply(response)
+
+
+@app.before_request
+def _metrics_start():
+    if metrics.ENABLED: g.myip_started = time.perf_counter()
+
+
+@app.after_request
+def _metrics_record(response: Response):
+    started = g.get('myip_started')
+    if started is not None:
+        endpoint = request.url_rule.endpoint if request.url_rule is not None else None
+        metrics.record_request(endpoint, response.mimetype, response.status_code, time.perf_counter() - started)
+    return response
+
+
+def _flat_result(res: GeoResult, dtype: str = None) -> str:
+    """Render a :class:`.GeoResult` from :func:`.lookup_many` in the same plain text format as :func:`.get_flat`"""
+    if not res.ip_valid:
+        return f"IP: {res.ip}\nError: {' '.join(res.messages)}\n"
+    if res.geo.get('error', False):
+        return f"IP: {res.ip}\nVersion: {res.ip_type}\nHostname: {res.hostname}\nError: {res.geo.message}\n"
+    return get_flat(res.ip, ua=res.ua, dtype=dtype, geodata=res.geo, hostname=res.hostname)
+
+
+class FlatSource(IntFlag):
+    """The data sources which a :func:`.get_flat` field depends on, combined as bit flags e.g. ``ASN | CITY``"""
+    NONE = 0
+    ASN = 1
+    CITY = 2
+    RDNS = 4
+    GEO = ASN | CITY
+
+
+@dataclass(frozen=True)
+class FlatField:
+    """A plain text field for :func:`.get_flat`, with the data sources it needs and the aliases it can be requested by"""
+    aliases: Tuple[str, ...]
+    sources: FlatSource
+    render: Callable[[DictObject], str]
+
+
+def _flat_loc(x: DictObject) -> str:
+    res = ""
+    if not empty(x.data.city): res += f"{x.data.city!s}, "
+    if not empty(x.data.postcode): res += f"{x.data.postcode!s}, "
+    if not empty(x.data.country): res += f"{x.data.country!s}"
+    return res.strip(', ')
+
+
+def _flat_all(x: DictObject) -> str:
+    d = x.data
+    return f"IP: {x.ip}\nVersion: {x.ip_type}\nHostname: {x.hostname}\nUserAgent: {x.ua}\nCountry: {d.country}\n" \
+           f"CountryCode: {d.country_code}\nCity: {d.city}\nPostcode: {d.postcode}\nLat: {d.lat}\n" \
+           f"Long: {d.long}\nASNum: {d.as_number}\nASName: {d.as_name}\nNetwork: {d.network}\n"
+
+
+FLAT_FIELDS: List[FlatField] = [
+    FlatField(('', 'none', 'ip', 'address', 'addr', 'ipaddr', 'ipaddress', 'ip_address'), FlatSource.NONE, lambda x: str(x.ip)),
+    FlatField(('ua', 'agent', 'useragent', 'user-agent', 'user_agent'), FlatSource.NONE, lambda x: str(x.ua)),
+    FlatField(('version', 'type', 'ipv', 'ipver', 'ipversion', 'ip_version', 'ip-version'), FlatSource.NONE, lambda x: str(x.ip_type)),
+    FlatField(('dns', 'rdns', 'reverse', 'reversedns', 'host', 'hostname', 'arpa', 'rev'), FlatSource.RDNS, lambda x: str(x.hostname)),
+    FlatField(('country', 'region'), FlatSource.CITY, lambda x: str(x.data.country)),
+    FlatField(
+        ('country_code', 'region_code', 'country-code', 'region-code', 'code'), FlatSource.CITY, lambda x: str(x.data.country_code)
+    ),
+    FlatField(('city', 'area'), FlatSource.CITY, lambda x: str(x.data.city)),
+    FlatField(
+        ('asfull', 'fullas', 'asnfull', 'fullasn', 'ispfull', 'fullisp', 'as_full', 'full_as', 'full_asn', 'isp_full', 'full_isp',
+         'asinfo', 'asninfo', 'as_info', 'asn_info', 'isp_info', 'ispinfo'),
+        FlatSource.ASN, lambda x: f"{x.data.as_name}\nAS{x.data.as_number}"
+    ),
+    FlatField(
+        ('as', 'asn', 'asnum', 'asnumber', 'as_number', 'isp_num', 'isp_number', 'isp_asn'), FlatSource.ASN,
+        lambda x: str(x.data.as_number)
+    ),
+    FlatField(('asname', 'ispname', 'isp', 'as_name', 'isp_name'), FlatSource.ASN, lambda x: str(x.data.as_name)),
+    FlatField(('post', 'postal', 'postcode', 'post_code', 'zip', 'zipcode', 'zip_code'), FlatSource.CITY, lambda x: str(x.data.postcode)),
+    FlatField(('loc', 'locate', 'location', 'countrycity', 'citycountry', 'country_city', 'city_country'), FlatSource.CITY, _flat_loc),
+    FlatField(('all', 'full', 'info', 'information'), FlatSource.GEO | FlatSource.RDNS, _flat_all),
+    FlatField(('lat', 'latitude'), FlatSource.CITY, lambda x: str(x.data.lat)),
+    FlatField(('lon', 'long', 'longitude'), FlatSource.CITY, lambda x: str(x.data.long)),
+    FlatField(
+        ('latlon', 'latlong', 'latitudelongitude', 'pos', 'position', 'cord', 'coord', 'coords', 'coordinate', 'coordinates',
+         'co-ordinates'),
+        FlatSource.CITY, lambda x: f"{x.data.lat:.4f}, {x.data.long:.4f}"
+    ),
+]
+"""The fields which can be requested from :func:`.get_flat` (and thus ``/flat/<dtype>`` + ``/lookup/<ip>/<dtype>``)"""
+
+
+def _build_flat_aliases(fields: List[FlatField]) -> Dict[str, FlatField]:
+    aliases = {}
+    for f in fields:
+        for a in f.aliases:
+            if a in aliases:
+                raise KeyError(f"Duplicate flat field alias {a!r}")
+            aliases[a] = f
+    return aliases
+
+
+FLAT_ALIASES: Dict[str, FlatField] = _build_flat_aliases(FLAT_FIELDS)
+"""A lookup table mapping every (lowercase) :attr:`.FlatField.aliases` entry to it's :class:`.FlatField`"""
+
+FLAT_DEFAULT: FlatField = FLAT_ALIASES['ip']
+"""The field which is returned by :func:`.get_flat` when the requested ``dtype`` doesn't match any alias"""
+
+
+def _geolocate_asn(ip: str) -> DictObject:
+    """
+    Look up just the ASN fields of :class:`.GeoIPResult` for ``ip``, without touching the GeoIP2 City database.
+    Raises :class:`geoip2.errors.AddressNotFoundError` if the address is invalid, or isn't in the ASN DB.
+    """
+    try:
+        res: geoip2.models.ASN = get_geoip(GeoType.ASN).asn(ip)
+    except (geoip2.errors.AddressNotFoundError, GeoIPDatabaseNotFound, ValueError) as e:
+        raise _not_found(ip, e)
+    return DictObject(
+        as_name=res.autonomous_system_organization, as_number=res.autonomous_system_number, network=res.network,
+        ip_address=res.ip_address
+    )
+
+
+def _geolocate_city(ip: str) -> DictObject:
+    """
+    Look up just the City/Country fields of :class:`.GeoIPResult` for ``ip``, without touching the GeoIP2 ASN database.
+    Raises :class:`geoip2.errors.AddressNotFoundError` if the address is invalid, or isn't in the City DB.
+    """
+    try:
+        res: geoip2.models.City = get_geoip(GeoType.CITY).city(ip)
+    except (geoip2.errors.AddressNotFoundError, GeoIPDatabaseNotFound, ValueError) as e:
+        raise _not_found(ip, e)
+    return DictObject(
+        country=res.country.names.get('en', None), country_code=res.country.iso_code, city=res.city.names.get('en', None),
+        postcode=res.postal.code, long=res.location.longitude, lat=res.location.latitude
+    )
+
+
+def get_flat(ip: str, ua: str = None, dtype: str = None, geodata: Union[GeoIPResult, DictObject] = None, hostname: str = None) -> str:
+    """
+    Returns a single piece of information ``dtype`` (e.g. ``country`` / ``asn`` / ``hostname``) about ``ip`` as plain text.
+    
+    Each field in :attr:`.FLAT_FIELDS` declares which data sources it needs (see :class:`.FlatSource`), and only
+    those sources are queried - e.g. ``country`` only reads the GeoIP2 City DB, and never triggers a reverse DNS lookup.
+    
+    If ``geodata`` and/or ``hostname`` are passed, they'll be used instead of looking them up.
+    
+    Invalid addresses, and addresses which aren't in the GeoIP2 database(s) the field needs, return the same error text
+    as batch lookups do (see :func:`._flat_result`).
+    """
+    fld = FLAT_ALIASES.get(empty_if(dtype, '').lower(), FLAT_DEFAULT)
+    src = fld.sources
+    x = DictObject(ip=ip, ua=empty_if(ua, 'N/A'), hostname=hostname, data=geodata)
+    try:
+        x.ip_type = 'ipv4' if ip_is_v4(ip) else 'ipv6'
+    except ValueError:
+        return f"IP: {ip}\nError: Invalid IP address detected\n"
+    if src & FlatSource.RDNS and hostname is None:
+        x.hostname = get_rdns(ip)
+    if src & FlatSource.GEO and empty(geodata, itr=True):
+        try:
+            x.data = _flat_geodata(ip, src)
+        except geoip2.errors.AddressNotFoundError:
+            x.data = None
+        if x.data is None:
+            return f"IP: {ip}\nVersion: {x.ip_type}\nHostname: {empty_if(x.hostname, '')}\n" \
+                   f"Error: IP address '{ip}' not found in GeoIP database.\n"
+    return fld.render(x)
+
+
+def _flat_geodata(ip: str, src: FlatSource) -> Optional[DictObject]:
+    """
+    The GeoIP data :func:`.get_flat` needs for the sources ``src`` - the cached data (from the GeoIP network cache or
+    the cache adapter) if there is any. Otherwise, fields needing both databases are looked up (and cached) by
+    :func:`.get_safe_geodata`, while fields from a single database only read that database.
+    """
+    if (src & FlatSource.GEO) == FlatSource.GEO:
+        return get_safe_geodata(ip)
+    data = _net_cached_geodata(ip)
+    data = _cached_geodata(ip) if data is None else data
+    if data is not None:
+        return data
+    with metrics.timer('geoip'):
+        return _geolocate_asn(ip) if src & FlatSource.ASN else _geolocate_city(ip)
+
+
+@profiled
 def _index(bformat=None):
     h = request.headers
     ip = get_ip()
     ua = h.get('User-Agent', 'Empty User Agent')
     q = merge_frm(req=request)
-    data = DictObject(geo_view(ip, ua=ua))
     wanted = wants_type() if 'format' in q else wants_type(fmt=bformat)
-    if wanted == 'json':
-        return jsonify(data)
+    not_modified = http_validate('index', ip, wanted, q.get('type', q.get('dtype', 'all')) if wanted == 'text' else None, ua)
+    if not_modified is not None:
+        return not_modified
+    if wanted in STREAM_TYPES:
+        # The same single record as /lookup.csv / /lookup.ndjson - rather than falling through to the HTML page
+        return _stream_lookup([ip], ua, wanted)
     if wanted == 'text':
         fres = get_flat(ip, ua=ua, dtype=q.get('type', q.get('dtype', 'all')))
         return Response(fres + "\n", status=200, content_type='text/plain')
-    if wanted == 'yaml':
-        return Response(dump_yaml(data), status=200, content_type='text/yaml')
-    # return render_template('index.html', v4_host=cf['V4_HOST'], v6_host=cf['V6_HOST'], main_host=settings.MAIN_HOST, **data)
-    return render_template('index.html', **data)
+    data = geo_view(ip, ua=ua, rdns_wait=wanted not in settings.RDNS_NOWAIT_FORMATS)
+    with metrics.timer('serialize'):
+        data = DictObject(data)
+    with metrics.timer('render'):
+        if wanted == 'json':
+            return jsonify(data)
+        if wanted == 'yaml':
+            return Response(dump_yaml(data), status=200, content_type='text/yaml')
+        # return render_template('index.html', v4_host=cf['V4_HOST'], v6_host=cf['V6_HOST'], main_host=settings.MAIN_HOST, **data)
+        return get_pages().index(_tpl_add_hosts(), **data)
 
 
 @app.route('/', methods=['GET', 'POST'], defaults=dict(bformat=None), strict_slashes=False)
@@ -0,0 +1,372 @@
+"""
+Static asset pipeline - ``python -m myip build-assets`` packs ``static/flags/*.gif`` into a single PNG sprite with a CSS
+index keyed by country code (``.myip-flag-se`` etc.), and writes it (along with ``static/app.js``) into
+``settings.ASSETS_DIR`` under fingerprinted filenames (e.g. ``app.3f9a0c1d2e.js``), plus pre-compressed ``.gz`` / ``.br``
+copies and a ``manifest.json`` mapping the source names to the built files.
+
+Once the assets are built, pages load the sprite + CSS instead of one ``<img>`` per flag, and :class:`.AssetManifest`
+serves the built files with ``Cache-Control: immutable`` (their names change whenever their content does), picking
+the pre-compressed copy by ``Accept-Encoding``. Ideally the webserver serves ``settings.ASSETS_URL`` straight from
+``ASSETS_DIR`` instead, so the workers never see asset requests - see the example configurations in the README.
+
+Until the assets are built, the templates fall back to the original ``/static/app.js`` and ``/static/flags/*.gif``.
+
+No imaging library is needed - the flag GIFs are decoded, and the sprite encoded as PNG, with the small codecs below.
+Brotli (``.br``) copies are only written if the ``brotli`` package is installed.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import struct
+import threading
+import time
+import warnings
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+from flask import Response, abort, request, send_file
+from markupsafe import Markup, escape
+from privex.helpers import DictObject
+
+from myip import settings
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+ASSET_SOURCES = ['app.js']
+"""Files in ``static/`` which are copied into the build under fingerprinted names"""
+
+COMPRESSIBLE = ('.js', '.css', '.svg', '.json', '.txt', '.html')
+"""Built files which get pre-compressed ``.gz`` / ``.br`` copies (images are already compressed)"""
+
+SPRITE_COLUMNS = 16
+FLAG_WIDTH, FLAG_HEIGHT = 16, 11
+"""The size of most of the flag GIFs - flags of any other size get their own ``width`` / ``height`` in the CSS"""
+
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+#######
+# Image codecs - just enough of GIF (first frame) and PNG (8-bit RGBA) for the flag sprite
+#######
+
+def _sub_blocks(data: bytes, pos: int) -> Tuple[bytes, int]:
+    """Read a chain of GIF data sub-blocks from ``pos``, returning their joined content and the position after them"""
+    out = bytearray()
+    while True:
+        size = data[pos]
+        pos += 1
+        if size == 0:
+            return bytes(out), pos
+        out += data[pos:pos + size]
+        pos += size
+
+
+def _lzw_decode(data: bytes, min_size: int, count: int) -> bytes:
+    """Decode GIF LZW image data into (up to ``count``) colour table indexes"""
+    clear = 1 << min_size
+    end, size = clear + 1, min_size + 1
+    base = [bytes([i]) for i in range(clear)] + [b'', b'']
+    table, out, prev = list(base), bytearray(), None
+    bits = nbits = 0
+    for byte in data:
+        bits |= byte << nbits
+        nbits += 8
+        while nbits >= size:
+            code = bits & ((1 << size) - 1)
+            bits >>= size
+            nbits -= size
+            if code == clear:
+                table, size, prev = list(base), min_size + 1, None
+                continue
+            if code == end:
+                return bytes(out[:count])
+            if code < len(table):
+                entry = table[code]
+                if prev is not None and len(table) < 4096:
+                    table.append(prev + entry[:1])
+            elif prev is not None:
+                entry = prev + prev[:1]
+                table.append(entry)
+            else:
+                raise ValueError("Invalid GIF LZW data")
+            out += entry
+            prev = entry
+            if len(table) == (1 << size) and size < 12:
+                size += 1
+    return bytes(out[:count])
+
+
+def _interlaced_rows(height: int) -> List[int]:
+    return [y for start, step in ((0, 8), (4, 8), (2, 4), (1, 2)) for y in range(start, height, step)]
+
+
+def decode_gif(data: bytes) -> Tuple[int, int, bytes]:
+    """Decode the first frame of a GIF image into ``(width, height, rgba)``"""
+    if data[:6] not in (b'GIF87a', b'GIF89a'):
+        raise ValueError("Not a GIF image")
+    width, height, flags = struct.unpack_from('<HHB', data, 6)
+    pos, palette, transparent = 13, None, None
+    if flags & 0x80:
+        palette, pos = data[pos:pos + 3 * (2 << (flags & 7))], pos + 3 * (2 << (flags & 7))
+    canvas = bytearray(width * height * 4)
+    while pos < len(data):
+        block = data[pos]
+        pos += 1
+        if block == 0x21:       # Extension - only the Graphic Control Extension (transparency) matters here
+            label = data[pos]
+            ext, pos = _sub_blocks(data, pos + 1)
+            if label == 0xF9 and len(ext) >= 4 and ext[0] & 1:
+                transparent = ext[3]
+        elif block == 0x2C:     # Image descriptor
+            left, top, iw, ih, iflags = struct.unpack_from('<HHHHB', data, pos)
+            pos += 9
+            colours = palette
+            if iflags & 0x80:
+                colours, pos = data[pos:pos + 3 * (2 << (iflags & 7))], pos + 3 * (2 << (iflags & 7))
+            if colours is None:
+                raise ValueError("GIF image has no colour table")
+            min_size = data[pos]
+            lzw, pos = _sub_blocks(data, pos + 1)
+            pixels = _lzw_decode(lzw, min_size, iw * ih)
+            rows = _interlaced_rows(ih) if iflags & 0x40 else range(ih)
+            for i, y in enumerate(rows):
+                if not 0 <= top + y < height: continue
+                for x in range(iw):
+                    ci = pixels[i * iw + x] if i * iw + x < len(pixels) else transparent
+                    if ci is None or ci == transparent or not 0 <= left + x < width: continue
+                    o = ((top + y) * width + left + x) * 4
+                    canvas[o:o + 4] = colours[ci * 3:ci * 3 + 3] + b'\xff'
+            return width, height, bytes(canvas)
+        elif block == 0x3B:     # Trailer
+            break
+        else:
+            raise ValueError(f"Invalid GIF block 0x{block:02x}")
+    return width, height, bytes(canvas)
+
+
+def encode_png(width: int, height: int, rgba: bytes) -> bytes:
+    """Encode 8-bit RGBA pixels as a PNG image"""
+    def chunk(kind: bytes, body: bytes) -> bytes:
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body) & 0xFFFFFFFF)
+
+    stride = width * 4
+    raw = b''.join(b'\x00' + rgba[y * stride:(y + 1) * stride] for y in range(height))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) + \
+        chunk(b'IDAT', zlib.compress(raw, 9)) + chunk(b'IEND', b'')
+
+
+#######
+# Build
+#######
+
+def build_sprite(flag_dir: Union[str, Path]) -> Tuple[bytes, Dict[str, Tuple[int, int, int, int]]]:
+    """
+    Pack every ``<code>.gif`` in ``flag_dir`` into one PNG sprite - returns the PNG, and ``{code: (x, y, width, height)}``
+    for each flag within it.
+    """
+    flags = []
+    for path in sorted(Path(flag_dir).glob('*.gif')):
+        try:
+            flags.append((path.stem.lower(), *decode_gif(path.read_bytes())))
+        except (ValueError, IndexError, struct.error) as e:
+            log.warning("Skipping flag %s - failed to decode it: %s", path, e)
+    cell_w = max([FLAG_WIDTH] + [f[1] for f in flags])
+    cell_h = max([FLAG_HEIGHT] + [f[2] for f in flags])
+    rows = (len(flags) + SPRITE_COLUMNS - 1) // SPRITE_COLUMNS
+    width, height = cell_w * SPRITE_COLUMNS, cell_h * max(rows, 1)
+    sheet, index = bytearray(width * height * 4), {}
+    for i, (code, fw, fh, rgba) in enumerate(flags):
+        x, y = (i % SPRITE_COLUMNS) * cell_w, (i // SPRITE_COLUMNS) * cell_h
+        for row in range(fh):
+            o = ((y + row) * width + x) * 4
+            sheet[o:o + fw * 4] = rgba[row * fw * 4:(row + 1) * fw * 4]
+        index[code] = (x, y, fw, fh)
+    return encode_png(width, height, bytes(sheet)), index
+
+
+def sprite_css(sprite_name: str, index: Dict[str, Tuple[int, int, int, int]]) -> str:
+    """The CSS index for a flag sprite - ``.myip-flag`` plus a ``.myip-flag-<code>`` class for each flag"""
+    lines = [
+        f".myip-flag{{display:inline-block;vertical-align:baseline;width:{FLAG_WIDTH}px;height:{FLAG_HEIGHT}px;"
+        f"background:url({sprite_name}) no-repeat}}"
+    ]
+    for code, (x, y, w, h) in sorted(index.items()):
+        size = ('' if w == FLAG_WIDTH else f";width:{w}px") + ('' if h == FLAG_HEIGHT else f";height:{h}px")
+        lines.append(f".myip-flag-{code}{{background-position:{-x}px {-y}px{size}}}")
+    return "\n".join(lines) + "\n"
+
+
+def fingerprint(name: str, data: bytes) -> str:
+    """``app.js`` -> ``app.<content hash>.js``"""
+    digest = hashlib.blake2b(data, digest_size=5).hexdigest()
+    stem, dot, ext = name.rpartition('.')
+    return f"{stem}.{digest}.{ext}" if dot else f"{name}.{digest}"
+
+
+def _write(out_dir: Path, name: str, data: bytes) -> Dict[str, int]:
+    """Write ``name`` (and it's compressed copies, where they're smaller) into ``out_dir`` - returns the size of each variant"""
+    sizes = {'identity': len(data)}
+    variants = [(name, data)]
+    if name.endswith(COMPRESSIBLE):
+        variants.append((name + '.gz', gzip.compress(data, compresslevel=9, mtime=0)))
+        if brotli is not None:
+            variants.append((name + '.br', brotli.compress(data, quality=11)))
+    for vname, vdata in variants:
+        if vname != name and len(vdata) >= len(data):
+            continue
+        tmp = out_dir / f".{vname}.{os.getpid()}.tmp"
+        tmp.write_bytes(vdata)
+        os.replace(tmp, out_dir / vname)
+        sizes[next((enc for enc, ext in ENCODINGS if name + ext == vname), 'identity')] = len(vdata)
+    return sizes
+
+
+def build_assets(static_dir: Union[str, Path] = None, out_dir: Union[str, Path] = None) -> DictObject:
+    """
+    Build the assets from ``static_dir`` (default: ``settings.STATIC_DIR``) into ``out_dir`` (default: ``settings.ASSETS_DIR``),
+    and write the manifest - returns the manifest, with the ``sizes`` of each built file's variants added.
+    Files from previous builds are removed once the new manifest is in place.
+    """
+    static_dir = Path(settings.STATIC_DIR if static_dir is None else static_dir)
+    out_dir = Path(settings.ASSETS_DIR if out_dir is None else out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if brotli is None:
+        warnings.warn("The 'brotli' package isn't installed - skipping .br copies of the assets", ImportWarning)
+    files, sizes = {}, {}
+
+    png, index = build_sprite(static_dir / 'flags')
+    files['flags.png'] = fingerprint('flags.png', png)
+    css = sprite_css(files['flags.png'], index).encode('utf-8')
+    files['flags.css'] = fingerprint('flags.css', css)
+    built = [(files['flags.png'], png), (files['flags.css'], css)]
+    for name in ASSET_SOURCES:
+        data = (static_dir / name).read_bytes()
+        files[name] = fingerprint(name, data)
+        built.append((files[name], data))
+    for name, data in built:
+        sizes[name] = _write(out_dir, name, data)
+
+    manifest = dict(files=files, flags=sorted(index.keys()), encodings={n: sorted(s.keys()) for n, s in sizes.items()})
+    manifest['version'] = hashlib.blake2b(json.dumps(manifest, sort_keys=True).encode(), digest_size=6).hexdigest()
+    tmp = out_dir / f".manifest.json.{os.getpid()}.tmp"
+    tmp.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+    os.replace(tmp, out_dir / 'manifest.json')
+    # Anything else in the build folder is from an older build - pages rendered from the new manifest no longer use it
+    keep = {'manifest.json'} | {n + ext for n in sizes for ext in ('', '.gz', '.br')}
+    for p in out_dir.iterdir():
+        if p.is_file() and p.name not in keep and not p.name.startswith('.'):
+            p.unlink()
+    return DictObject(manifest, sizes=sizes)
+
+
+#######
+# Serving
+#######
+
+class AssetManifest:
+    """
+    The manifest of the built assets in ``settings.ASSETS_DIR`` - used by the templates (as ``assets``) to link the
+    fingerprinted files, and by :meth:`.response` to serve them. The manifest file is re-read when it's rebuilt.
+
+        >>> assets.url('app.js')
+        '/static/dist/app.3f9a0c1d2e.js'
+        >>> assets.flag('SE', 'Sweden')
+        Markup('<i class="myip-flag myip-flag-se" role="img" aria-label="Sweden Flag" title="Sweden"></i>')
+
+    """
+    def __init__(self, assets_dir: Union[str, Path] = None, url: str = None, max_age: int = None, check_interval: float = 5.0):
+        self.assets_dir = Path(settings.ASSETS_DIR if assets_dir is None else assets_dir)
+        self.base_url = str(settings.ASSETS_URL if url is None else url).rstrip('/')
+        self.max_age = settings.ASSETS_MAX_AGE if max_age is None else max_age
+        self.check_interval = check_interval
+        self._data: dict = {}
+        self._flags: frozenset = frozenset()
+        self._served: Dict[str, List[str]] = {}
+        self._sig: Optional[Tuple[int, int]] = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def _load(self) -> dict:
+        now = time.monotonic()
+        if now < self._next_check:
+            return self._data
+        with self._lock:
+            self._next_check = now + self.check_interval
+            try:
+                st = os.stat(self.assets_dir / 'manifest.json')
+                sig = (st.st_ino, st.st_mtime_ns)
+            except FileNotFoundError:
+                sig = None
+            if sig != self._sig:
+                data = {} if sig is None else json.loads((self.assets_dir / 'manifest.json').read_text())
+                self._data, self._flags, self._served = data, frozenset(data.get('flags', [])), data.get('encodings', {})
+                self._sig = sig
+                log.info("Loaded asset manifest %s (version: %s)", self.assets_dir / 'manifest.json', data.get('version'))
+        return self._data
+
+    @property
+    def built(self) -> bool:
+        return len(self._load().get('files', {})) > 0
+
+    @property
+    def version(self) -> str:
+        return self._load().get('version', '')
+
+    def url(self, name: str) -> str:
+        """The URL of the asset ``name`` (e.g. ``app.js``) - the fingerprinted build if there is one, otherwise ``/static/<name>``"""
+        built = self._load().get('files', {}).get(name)
+        return f"/static/{name}" if built is None else f"{self.base_url}/{built}"
+
+    def flag(self, code: Optional[str], country: str = '') -> Markup:
+        """The HTML for the flag of the country ``code`` - from the sprite if it's built, otherwise the flag's own GIF"""
+        code = str(code or '').lower()
+        self._load()
+        if code in self._flags:
+            return Markup(f'<i class="myip-flag myip-flag-{escape(code)}" role="img" aria-label="{escape(country)} Flag" title="{escape(country)}"></i>')
+        return Markup(f'<img class="flag" src="/static/flags/{escape(code)}.gif" alt="{escape(country)} Flag" />')
+
+    def response(self, filename: str) -> Response:
+        """Serve the built file ``filename`` - the smallest pre-compressed copy the client accepts, cached as ``immutable``"""
+        self._load()
+        encodings = self._served.get(filename)
+        if encodings is None:
+            abort(404)
+        path, encoding = self.assets_dir / filename, None
+        for enc, ext in ENCODINGS:
+            if enc in encodings and request.accept_encodings.quality(enc) > 0:
+                path, encoding = self.assets_dir / (filename + ext), enc
+                break
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        res = send_file(path, mimetype=mimetype, etag=f"{filename}-{encoding or 'identity'}", max_age=self.max_age, conditional=True)
+        if encoding is not None:
+            res.headers['Content-Encoding'] = encoding
+        res.vary.add('Accept-Encoding')
+        res.cache_control.public = True
+        res.cache_control.immutable = True
+        return res
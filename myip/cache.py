@@ -0,0 +1,773 @@
+"""
+Cache adapters and helpers which build on top of the :mod:`privex.helpers.cache` adapters selected
+by :func:`myip.core.set_cache_adapter` - including :func:`.get_many` / :func:`.set_many`, which read / write many keys
+in a single round-trip where the adapter's backend supports it (Redis ``MGET`` + pipelines, Memcached ``get_multi``)
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import Counter, OrderedDict
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network, ip_address, ip_network
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple, Union
+
+from privex.helpers import CacheAdapter, DictObject, T, empty
+from privex.helpers.exceptions import CacheNotFound
+from privex.helpers.settings import DEFAULT_CACHE_TIMEOUT
+
+from myip import metrics, settings
+
+log = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LRUStore:
+    """
+    A bounded, thread-safe, in-process key/value store with per-key TTLs and least-recently-used eviction.
+
+    Once the store holds ``max_size`` keys, setting a new key evicts the least recently used key. Expired keys
+    are removed lazily, when they're next read.
+
+        >>> s = LRUStore(max_size=2, ttl=30)
+        >>> s.set('a', 1); s.set('b', 2); s.set('c', 3)
+        >>> s.get('a', 'nope'), s.get('c')
+        ('nope', 3)
+
+    """
+    def __init__(self, max_size: int = 10000, ttl: float = 30):
+        self.max_size, self.ttl = int(max_size), float(ttl)
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.misses, self.evictions, self.expirations = 0, 0, 0, 0
+
+    def get(self, key: str, default: Any = None) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            if item[0] < now:
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(float(ttl), self.ttl)
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def remove(self, *keys: str) -> int:
+        removed = 0
+        with self._lock:
+            for k in keys:
+                if self._data.pop(k, _MISSING) is not _MISSING:
+                    removed += 1
+        return removed
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> DictObject:
+        return DictObject(
+            size=len(self._data), max_size=self.max_size, ttl=self.ttl, hits=self.hits, misses=self.misses,
+            evictions=self.evictions, expirations=self.expirations
+        )
+
+
+class PrefixCache:
+    """
+    A bounded, thread-safe, in-process longest-prefix-match cache - values are stored against an IP network,
+    and :meth:`.get` returns the value of the most specific stored network which contains the given address.
+
+    Entries are kept in one hash table per prefix length, so a lookup costs one dict lookup per distinct prefix
+    length stored (most specific first), regardless of how many networks are stored. Entries expire after ``ttl``
+    seconds, and once the cache holds ``max_size`` networks, the least recently used network is evicted.
+
+        >>> pc = PrefixCache(max_size=1000, ttl=600)
+        >>> pc.set('185.130.44.0/22', 'privex')
+        >>> pc.get('185.130.45.17'), pc.get('2a07:e00::1', 'nope')
+        ('privex', 'nope')
+
+    """
+    def __init__(self, max_size: int = 100000, ttl: float = 600):
+        self.max_size, self.ttl = int(max_size), float(ttl)
+        self._data: "OrderedDict[Tuple[int, int, int], Tuple[float, Any]]" = OrderedDict()
+        self._lengths: Dict[int, Counter] = {4: Counter(), 6: Counter()}
+        self._probe: Dict[int, Tuple[int, ...]] = {4: (), 6: ()}
+        self._lock = threading.Lock()
+        self.hits, self.misses, self.evictions, self.expirations = 0, 0, 0, 0
+
+    def _count(self, version: int, prefixlen: int, n: int):
+        lengths = self._lengths[version]
+        lengths[prefixlen] += n
+        if lengths[prefixlen] <= 0:
+            del lengths[prefixlen]
+        self._probe[version] = tuple(sorted(lengths.keys(), reverse=True))
+
+    def _drop(self, key: Tuple[int, int, int]):
+        del self._data[key]
+        self._count(key[0], key[1], -1)
+
+    def get(self, ip: Union[str, IPv4Address, IPv6Address], default: Any = None) -> Any:
+        ip = ip_address(ip) if isinstance(ip, str) else ip
+        version, bits, num = ip.version, ip.max_prefixlen, int(ip)
+        now = time.monotonic()
+        with self._lock:
+            for plen in self._probe[version]:
+                key = (version, plen, num >> (bits - plen))
+                item = self._data.get(key, _MISSING)
+                if item is _MISSING:
+                    continue
+                if item[0] < now:
+                    self._drop(key)
+                    self.expirations += 1
+                    break
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+            return default
+
+    def set(self, network: Union[str, IPv4Network, IPv6Network], value: Any, ttl: Optional[float] = None):
+        net = ip_network(network, strict=False) if isinstance(network, str) else network
+        key = (net.version, net.prefixlen, int(net.network_address) >> (net.max_prefixlen - net.prefixlen))
+        expires = time.monotonic() + (self.ttl if ttl is None else float(ttl))
+        with self._lock:
+            if key not in self._data:
+                self._count(net.version, net.prefixlen, 1)
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._drop(next(iter(self._data)))
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._lengths = {4: Counter(), 6: Counter()}
+            self._probe = {4: (), 6: ()}
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> DictObject:
+        return DictObject(
+            size=len(self._data), max_size=self.max_size, ttl=self.ttl, hits=self.hits, misses=self.misses,
+            evictions=self.evictions, expirations=self.expirations,
+            prefix_lengths=DictObject(v4=list(self._probe[4]), v6=list(self._probe[6])),
+        )
+
+
+class LRUCache(CacheAdapter):
+    """
+    A cache adapter backed by a single bounded :class:`.LRUStore` - unlike :class:`privex.helpers.cache.MemoryCache`,
+    it never holds more than ``max_size`` keys, so it's safe to use in long-running batch jobs (e.g. ``myip enrich``)
+    which look up far more keys than would fit in memory.
+
+    Values are stored by reference, and no key is kept for longer than ``ttl`` seconds, no matter the timeout
+    passed to :meth:`.set`.
+
+        >>> c = LRUCache(max_size=2)
+        >>> c.set('a', 1); c.set('b', 2); c.set('c', 3)
+        >>> c.get('a', 'nope'), c.get('c')
+        ('nope', 3)
+
+    """
+    def __init__(self, max_size: int = 100000, ttl: float = 3600, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.store = LRUStore(max_size=max_size, ttl=ttl)
+
+    def get(self, key: str, default: Any = None, fail: bool = False) -> Any:
+        val = self.store.get(str(key), _MISSING)
+        if val is _MISSING:
+            if fail: raise CacheNotFound(f'Cache key "{key}" was not found.')
+            return default
+        return val
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = DEFAULT_CACHE_TIMEOUT):
+        self.store.set(str(key), value, timeout)
+        return value
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        res = {}
+        for k in keys:
+            val = self.store.get(str(k), _MISSING)
+            if val is not _MISSING: res[str(k)] = val
+        return res
+
+    def set_many(self, values: Dict[str, Any], timeout: Optional[int] = DEFAULT_CACHE_TIMEOUT):
+        for k, v in values.items():
+            self.store.set(str(k), v, timeout)
+
+    def remove(self, *key: str) -> bool:
+        return self.store.remove(*[str(k) for k in key]) > 0
+
+    def update_timeout(self, key: str, timeout: int = DEFAULT_CACHE_TIMEOUT) -> Any:
+        val = self.get(key, fail=True)
+        self.set(key, val, timeout)
+        return val
+
+    def stats(self) -> DictObject:
+        return self.store.stats()
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {len(self.store)}/{self.store.max_size} keys, ttl={self.store.ttl}s>"
+
+
+class LayeredCache(CacheAdapter):
+    """
+    A two-tier cache adapter - a small per-process :class:`.LRUStore` (L1) in front of a shared cache adapter
+    such as :class:`privex.helpers.cache.RedisCache` / :class:`privex.helpers.cache.MemcachedCache` (L2).
+
+    Reads check L1 first, and only fall through to L2 on an L1 miss, storing the L2 value in L1 for at most
+    ``l1_ttl`` seconds. Writes and removals go to both tiers, so L2 always remains the shared source of truth.
+
+    As L1 is per-process, another worker's write to L2 may not be seen until the L1 copy expires, so ``l1_ttl``
+    should be kept short (see ``settings.L1_CACHE_TTL``).
+
+    Values are stored in L1 by reference, so cached values should be treated as immutable.
+
+        >>> from privex.helpers.cache.RedisCache import RedisCache
+        >>> c = LayeredCache(RedisCache(use_pickle=True), l1_size=10000, l1_ttl=30)
+        >>> c.set('geoip:1.2.3.4', '{"country": "Sweden"}', 600)
+        >>> c.get('geoip:1.2.3.4')    # Returned straight from L1, without a Redis round-trip
+        '{"country": "Sweden"}'
+        >>> c.stats().l1.hits
+        1
+
+    """
+    METRICS_TIER = None
+    """Reads are counted per tier (``l1`` + the L2 adapter's tier) by :meth:`.get` itself - see :func:`myip.metrics.cache_tier`"""
+
+    def __init__(self, l2: CacheAdapter, l1_size: int = None, l1_ttl: float = None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.l2 = l2
+        # None if the L2 adapter counts it's own reads (e.g. CircuitBreakerCache)
+        self.l2_tier = metrics.cache_tier(l2)
+        self.l1 = LRUStore(
+            max_size=settings.L1_CACHE_SIZE if l1_size is None else l1_size,
+            ttl=settings.L1_CACHE_TTL if l1_ttl is None else l1_ttl
+        )
+        self.l2_hits, self.l2_misses, self.l2_errors = 0, 0, 0
+
+    def get(self, key: str, default: Any = None, fail: bool = False) -> Any:
+        key = str(key)
+        val = self.l1.get(key, _MISSING)
+        if val is not _MISSING:
+            metrics.cache_event('l1', 'hit')
+            return val
+        metrics.cache_event('l1', 'miss')
+        try:
+            val = self.l2.get(key, _MISSING)
+        except Exception:
+            self.l2_errors += 1
+            self._l2_event('error')
+            raise
+        if val is _MISSING or val is None:
+            self.l2_misses += 1
+            self._l2_event('miss')
+            if fail: raise CacheNotFound(f'Cache key "{key}" was not found.')
+            return default
+        self.l2_hits += 1
+        self._l2_event('hit')
+        self.l1.set(key, val)
+        return val
+
+    def _l2_event(self, result: str, amount: int = 1):
+        if self.l2_tier is not None: metrics.cache_event(self.l2_tier, result, amount)
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = DEFAULT_CACHE_TIMEOUT):
+        key = str(key)
+        self.l1.set(key, value, timeout)
+        return self.l2.set(key, value, timeout)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Bulk version of :meth:`.get` - the keys missing from L1 are fetched from L2 in one go (see :func:`.get_many`)"""
+        res, missing = {}, []
+        for k in dict.fromkeys(str(k) for k in keys):
+            val = self.l1.get(k, _MISSING)
+            if val is _MISSING:
+                missing.append(k)
+            else:
+                res[k] = val
+        metrics.cache_event('l1', 'hit', len(res))
+        metrics.cache_event('l1', 'miss', len(missing))
+        if len(missing) == 0:
+            return res
+        try:
+            found = get_many(self.l2, missing)
+        except Exception:
+            self.l2_errors += 1
+            self._l2_event('error')
+            raise
+        self.l2_hits += len(found)
+        self.l2_misses += len(missing) - len(found)
+        self._l2_event('hit', len(found))
+        self._l2_event('miss', len(missing) - len(found))
+        for k, val in found.items():
+            self.l1.set(k, val)
+        res.update(found)
+        return res
+
+    def set_many(self, values: Dict[str, Any], timeout: Optional[int] = DEFAULT_CACHE_TIMEOUT):
+        for k, v in values.items():
+            self.l1.set(str(k), v, timeout)
+        return set_many(self.l2, values, timeout)
+
+    def remove(self, *key: str) -> bool:
+        self.l1.remove(*[str(k) for k in key])
+        return self.l2.remove(*key)
+
+    def update_timeout(self, key: str, timeout: int = DEFAULT_CACHE_TIMEOUT) -> Any:
+        self.l1.remove(str(key))
+        return self.l2.update_timeout(key, timeout)
+
+    def connect(self, *args, **kwargs) -> Any:
+        return self.l2.connect(*args, **kwargs)
+
+    def close(self, *args, **kwargs) -> Any:
+        return self.l2.close(*args, **kwargs)
+
+    def stats(self) -> DictObject:
+        """Return the hit/miss counters for both tiers, e.g. ``stats().l1.hits`` / ``stats().l2.misses``"""
+        return DictObject(
+            l1=self.l1.stats(),
+            l2=DictObject(adapter=self.l2.__class__.__name__, hits=self.l2_hits, misses=self.l2_misses, errors=self.l2_errors),
+        )
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} l1={self.l1.max_size}/{self.l1.ttl}s l2={self.l2!r}>"
+
+
+class CircuitBreakerCache(CacheAdapter):
+    """
+    Wraps a shared cache adapter (Redis / Memcached) with a circuit breaker, so a cache server which dies or stalls
+    costs hit rate rather than latency.
+
+    While the breaker is **closed**, every operation goes to the ``backend`` adapter - with it's client's socket
+    timeouts kept tight (``settings.CACHE_TIMEOUT``), a stalled server can only hold up an operation for that long.
+    A failed operation is answered from the in-process ``fallback`` cache instead of raising, and after ``failures``
+    consecutive failures the breaker **opens**: every operation then goes straight to ``fallback`` without touching
+    the backend, while a background thread tries reading from the backend every ``retry`` seconds. Once a read
+    succeeds the breaker closes again, and the fallback cache is emptied.
+
+        >>> from privex.helpers.cache.RedisCache import RedisCache
+        >>> c = CircuitBreakerCache(RedisCache(use_pickle=True))
+        >>> c.set('geoip:1.2.3.4', b'...', 600)      # Redis is down - cached in-process instead
+        >>> c.stats().state
+        'open'
+
+    Reads are counted (:func:`myip.metrics.cache_event`) against the backend's tier while closed, and against
+    the ``fallback`` tier while open.
+    """
+    METRICS_TIER = None
+    """Reads are counted against the backend's tier or ``fallback`` by the breaker itself"""
+
+    CLOSED, OPEN = 'closed', 'open'
+    PROBE_KEY = 'myip:breaker:probe'
+
+    def __init__(
+        self, backend: CacheAdapter, fallback: CacheAdapter = None, failures: int = None, retry: float = None, *args, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.backend = backend
+        self.tier = metrics.cache_tier(backend) or 'cache'
+        self.fallback = LRUCache(max_size=settings.CACHE_FALLBACK_SIZE) if fallback is None else fallback
+        self.max_failures = settings.CACHE_BREAKER_FAILURES if failures is None else failures
+        self.retry = settings.CACHE_BREAKER_RETRY if retry is None else retry
+        self.state = self.CLOSED
+        self.failures, self.errors, self.trips = 0, 0, 0
+        self.opened_at: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self._lock = threading.Lock()
+        self._prober: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        metrics.breaker_state(self.tier, False)
+
+    @property
+    def closed(self) -> bool:
+        """``True`` while operations are going to the backend"""
+        return self.state == self.CLOSED
+
+    def _failed(self, op: str, e: Exception):
+        with self._lock:
+            self.failures += 1
+            self.errors += 1
+            self.last_error = f"{type(e).__name__}: {e!s}"
+            metrics.cache_event(self.tier, 'error')
+            if self.state == self.CLOSED and self.failures >= self.max_failures:
+                self._trip()
+                return
+        log.warning("Cache %s failed (%s) - using the in-process fallback cache", op, self.last_error)
+
+    def _trip(self):
+        self.state, self.opened_at = self.OPEN, time.time()
+        self.trips += 1
+        metrics.breaker_state(self.tier, True, tripped=True)
+        log.error(
+            "Cache circuit breaker opened after %d failures (last: %s) - using the in-process fallback cache, "
+            "and retrying %s every %ss", self.failures, self.last_error, self.backend.__class__.__name__, self.retry
+        )
+        if self._prober is None or not self._prober.is_alive():
+            self._prober = threading.Thread(target=self._probe, name='myip-cache-breaker', daemon=True)
+            self._prober.start()
+
+    def _probe(self):
+        """Runs in the background while the breaker is open - retries the backend until a read succeeds"""
+        while not self._stop.wait(self.retry):
+            try:
+                self.backend.get(self.PROBE_KEY)
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e!s}"
+                log.debug("Cache backend still unavailable: %s", self.last_error)
+                continue
+            self.reset()
+            return
+
+    def reset(self):
+        """Close the breaker - operations go back to the backend, and the fallback cache is emptied"""
+        with self._lock:
+            was_open, self.state, self.failures, self.opened_at = self.state == self.OPEN, self.CLOSED, 0, None
+        if isinstance(self.fallback, LRUCache):
+            self.fallback.store.clear()
+        metrics.breaker_state(self.tier, False)
+        if was_open:
+            log.warning("Cache circuit breaker closed - %s is reachable again", self.backend.__class__.__name__)
+
+    def _succeeded(self):
+        if self.failures: self.failures = 0
+
+    def get(self, key: str, default: Any = None, fail: bool = False) -> Any:
+        key, val, tier = str(key), _MISSING, 'fallback'
+        if self.state == self.CLOSED:
+            try:
+                val, tier = self.backend.get(key, _MISSING), self.tier
+                self._succeeded()
+            except Exception as e:
+                self._failed('read', e)
+        if tier == 'fallback':
+            val = self.fallback.get(key, _MISSING)
+        if val is _MISSING or val is None:
+            metrics.cache_event(tier, 'miss')
+            if fail: raise CacheNotFound(f'Cache key "{key}" was not found.')
+            return default
+        metrics.cache_event(tier, 'hit')
+        return val
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = DEFAULT_CACHE_TIMEOUT):
+        if self.state == self.CLOSED:
+            try:
+                res = self.backend.set(key, value, timeout)
+                self._succeeded()
+                return res
+            except Exception as e:
+                self._failed('write', e)
+        return self.fallback.set(key, value, timeout)
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        """Bulk version of :meth:`.get` - uses :func:`.get_many` on the backend, so it's still a single round-trip"""
+        keys = list(dict.fromkeys(str(k) for k in keys))
+        if self.state == self.CLOSED:
+            try:
+                found = get_many(self.backend, keys)
+                self._succeeded()
+                metrics.cache_event(self.tier, 'hit', len(found))
+                metrics.cache_event(self.tier, 'miss', len(keys) - len(found))
+                return found
+            except Exception as e:
+                self._failed('read', e)
+        found = self.fallback.get_many(keys)
+        metrics.cache_event('fallback', 'hit', len(found))
+        metrics.cache_event('fallback', 'miss', len(keys) - len(found))
+        return found
+
+    def set_many(self, values: Dict[str, Any], timeout: Optional[int] = DEFAULT_CACHE_TIMEOUT):
+        if self.state == self.CLOSED:
+            try:
+                set_many(self.backend, values, timeout)
+                self._succeeded()
+                return
+            except Exception as e:
+                self._failed('write', e)
+        self.fallback.set_many(values, timeout)
+
+    def remove(self, *key: str) -> bool:
+        removed = self.fallback.remove(*key)
+        if self.state == self.CLOSED:
+            try:
+                removed = self.backend.remove(*key) or removed
+                self._succeeded()
+            except Exception as e:
+                self._failed('remove', e)
+        return removed
+
+    def update_timeout(self, key: str, timeout: int = DEFAULT_CACHE_TIMEOUT) -> Any:
+        if self.state == self.CLOSED:
+            try:
+                res = self.backend.update_timeout(key, timeout)
+                self._succeeded()
+                return res
+            except CacheNotFound:
+                raise
+            except Exception as e:
+                self._failed('write', e)
+        return self.fallback.update_timeout(key, timeout)
+
+    def connect(self, *args, **kwargs) -> Any:
+        return self.backend.connect(*args, **kwargs)
+
+    def close(self, *args, **kwargs) -> Any:
+        self._stop.set()
+        return self.backend.close(*args, **kwargs)
+
+    def stats(self) -> DictObject:
+        """The breaker's state, failure counters and last error, plus the fallback cache's stats"""
+        return DictObject(
+            state=self.state, adapter=self.backend.__class__.__name__, failures=self.failures, errors=self.errors,
+            trips=self.trips, opened_at=self.opened_at, last_error=self.last_error,
+            fallback=self.fallback.stats() if hasattr(self.fallback, 'stats') else None,
+        )
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.state} backend={self.backend!r}>"
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result, self.error = None, None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key within this process - while one thread is running ``func`` for a key,
+    other threads calling :meth:`.do` with that key wait for it to finish, and get it's result (or exception) instead of
+    running ``func`` themselves. Used to stop a cache miss on a popular key from causing a stampede of identical lookups.
+
+        >>> sf = SingleFlight()
+        >>> sf.do('geoip:1.2.3.4', _load_geodata, '1.2.3.4')
+
+    If the running call takes longer than ``timeout`` seconds, waiting threads give up and run ``func`` themselves.
+    """
+    def __init__(self, timeout: float = 10.0):
+        self.timeout = timeout
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self.calls, self.shared = 0, 0
+
+    def do(self, key: str, func: Callable[..., T], *args, **kwargs) -> T:
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if flight.done.wait(self.timeout):
+                self.shared += 1
+                if flight.error is not None: raise flight.error
+                return flight.result
+            return func(*args, **kwargs)
+        self.calls += 1
+        try:
+            flight.result = func(*args, **kwargs)
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self) -> DictObject:
+        return DictObject(calls=self.calls, shared=self.shared, inflight=len(self._flights))
+
+
+def _unwrap(adapter: CacheAdapter) -> Optional[CacheAdapter]:
+    """
+    The adapter inside :class:`.LayeredCache` / :class:`.CircuitBreakerCache` wrappers - or ``None`` if there's an open
+    circuit breaker in the way, so the backend shouldn't be used directly
+    """
+    while isinstance(adapter, (LayeredCache, CircuitBreakerCache)):
+        if isinstance(adapter, CircuitBreakerCache) and not adapter.closed:
+            return None
+        adapter = adapter.l2 if isinstance(adapter, LayeredCache) else adapter.backend
+    return adapter
+
+
+def cache_breaker(adapter: CacheAdapter) -> Optional[CircuitBreakerCache]:
+    """Returns the :class:`.CircuitBreakerCache` in ``adapter`` (looking through :class:`.LayeredCache`), or ``None``"""
+    while isinstance(adapter, LayeredCache):
+        adapter = adapter.l2
+    return adapter if isinstance(adapter, CircuitBreakerCache) else None
+
+
+def redis_client(adapter: CacheAdapter) -> Optional[Any]:
+    """
+    Returns the :class:`redis.Redis` client behind ``adapter`` (looking through :class:`.LayeredCache` /
+    :class:`.CircuitBreakerCache`), or ``None`` - including while the circuit breaker is open
+    """
+    adapter = _unwrap(adapter)
+    if adapter is None or 'redis' not in adapter.__class__.__name__.lower():
+        return None
+    return getattr(adapter, 'redis', None)
+
+
+def memcached_client(adapter: CacheAdapter) -> Optional[Any]:
+    """
+    Returns the :class:`pylibmc.Client` behind ``adapter`` (looking through :class:`.LayeredCache` /
+    :class:`.CircuitBreakerCache`), or ``None`` - including while the circuit breaker is open
+    """
+    adapter = _unwrap(adapter)
+    if adapter is None or 'memcached' not in adapter.__class__.__name__.lower():
+        return None
+    return getattr(adapter, 'mcache', None)
+
+
+def _encode(adapter: CacheAdapter, value: Any) -> Any:
+    return pickle.dumps(value) if getattr(adapter, 'use_pickle', False) else value
+
+
+def _decode(adapter: CacheAdapter, raw: Any) -> Any:
+    return pickle.loads(raw) if getattr(adapter, 'use_pickle', False) else raw
+
+
+def get_many(adapter: CacheAdapter, keys: Iterable[str]) -> Dict[str, Any]:
+    """
+    Fetch multiple keys from ``adapter`` in as few round-trips as it allows - returns a dict of the keys which were found
+    (keys which are missing or expired are left out):
+
+      - Adapters with their own ``get_many`` (:class:`.LayeredCache` / :class:`.LRUCache`) use it
+      - ``RedisCache`` fetches every key with a single ``MGET``
+      - ``MemcachedCache`` fetches every key with a single ``get_multi``
+      - Any other adapter (e.g. ``MemoryCache``) reads each key with ``adapter.get``
+
+        >>> get_many(get_cache(), ['geoip:185.130.44.1', 'geoip:8.8.8.8'])
+        {'geoip:185.130.44.1': '{"city": "Stockholm", ...}'}
+
+    """
+    keys = list(dict.fromkeys(str(k) for k in keys))
+    if len(keys) == 0:
+        return {}
+    own = getattr(adapter, 'get_many', None)
+    if own is not None:
+        return own(keys)
+    client = redis_client(adapter)
+    if client is not None:
+        return {k: _decode(adapter, v) for k, v in zip(keys, client.mget(keys)) if not empty(v)}
+    client = memcached_client(adapter)
+    if client is not None:
+        return {k: _decode(adapter, v) for k, v in client.get_multi(keys).items() if not empty(v)}
+    res = {}
+    for k in keys:
+        val = adapter.get(k, _MISSING)
+        if val is not _MISSING and val is not None: res[k] = val
+    return res
+
+
+def set_many(adapter: CacheAdapter, values: Dict[str, Any], timeout: Optional[int] = DEFAULT_CACHE_TIMEOUT):
+    """
+    Store multiple keys (``{key: value}``) in ``adapter`` with the same ``timeout``, in as few round-trips as it allows -
+    a single (non-transactional) pipeline for Redis, ``set_multi`` for Memcached, and ``adapter.set`` per key otherwise.
+    """
+    if len(values) == 0:
+        return
+    own = getattr(adapter, 'set_many', None)
+    if own is not None:
+        return own(values, timeout)
+    client = redis_client(adapter)
+    if client is not None:
+        pipe = client.pipeline(transaction=False)
+        for k, v in values.items():
+            pipe.set(str(k), _encode(adapter, v), ex=timeout)
+        pipe.execute()
+        return
+    client = memcached_client(adapter)
+    if client is not None:
+        failed = client.set_multi({str(k): _encode(adapter, v) for k, v in values.items()}, time=timeout or 0)
+        if failed: log.warning("Failed to store %d of %d keys in Memcached", len(failed), len(values))
+        return
+    for k, v in values.items():
+        adapter.set(str(k), v, timeout)
+
+
+class CacheLock:
+    """
+    A short-lived lock shared by every worker process, held in Redis (``SET key token NX PX``) - so only one worker
+    runs an expensive lookup for a key at once. When the cache adapter isn't Redis backed, :meth:`.acquire` always
+    succeeds, leaving only the in-process coalescing.
+
+    Locks expire by themselves after ``ttl`` seconds, so a worker which dies while holding one can't block the key.
+    """
+    def __init__(self, cache: Union[CacheAdapter, Callable[[], CacheAdapter]], ttl: float = None):
+        self._cache = cache
+        self.ttl = settings.CACHE_LOCK_SEC if ttl is None else ttl
+
+    @staticmethod
+    def lock_key(key: str) -> str:
+        return f"myip:lock:{key}"
+
+    @property
+    def client(self) -> Optional[Any]:
+        return redis_client(self._cache() if callable(self._cache) else self._cache)
+
+    def acquire(self, key: str) -> Optional[str]:
+        """
+        Try to take the lock for ``key`` without blocking - returns a token to pass to :meth:`.release` if the lock was
+        taken (or there's no shared lock to take), or ``None`` if another worker holds it.
+        """
+        client = self.client if self.ttl > 0 else None
+        token = f"{os.getpid()}:{threading.get_ident()}:{time.time()}"
+        if client is None:
+            return token
+        try:
+            return token if client.set(self.lock_key(key), token, nx=True, px=int(self.ttl * 1000)) else None
+        except Exception:
+            log.exception("Failed to take cache lock for key %s - carrying on without it", key)
+            return token
+
+    def release(self, key: str, token: str):
+        client = self.client if self.ttl > 0 else None
+        if client is None:
+            return
+        try:
+            lkey = self.lock_key(key)
+            val = client.get(lkey)
+            if val is not None and (val.decode() if isinstance(val, bytes) else val) == token:
+                client.delete(lkey)
+        except Exception:
+            log.exception("Failed to release cache lock for key %s", key)
@@ -0,0 +1,299 @@
+"""
+Compact binary encoding for the GeoIP and Reverse DNS values cached in Redis / Memcached.
+
+GeoIP data used to be cached as ``json.dumps`` text (which the cache adapter then pickles) - every entry repeating
+all ten field names, and every read running ``pickle.loads`` + ``json.loads``. With ``settings.CACHE_CODEC = 'binary'``
+values are instead packed into a fixed-schema, versioned layout with :func:`.encode_geo` / :func:`.encode_rdns`:
+
+**GeoIP** (about a third of the size of the JSON text)::
+
+    tag      B     GEO_V1 (latitude / longitude as int32 x 10^-4) or GEO_V1_F64 (as float64)
+    flags    H     bits 0-9: field present (not None), in GEO_FIELDS order - bits 10+: the FLAG_* inline flags
+    country  B     index of the country code in COUNTRIES (or 0xFF)
+    asn      I     as_number
+    long/lat ii/dd
+    lengths  BBBBBB  byte lengths of the country name, city, postcode, AS name, ip_address and network in the tail
+    prefix   B     network prefix length
+    tail           the UTF-8 strings, the packed ip_address and network address bytes, then the country code
+                   (only if it isn't in COUNTRIES)
+
+The country is stored as an index into the :attr:`.COUNTRIES` code table, which also holds the country's English
+name - the name only goes into the tail when it differs from the table (or the code isn't in it). Addresses and networks
+are stored as their packed 4 / 16 bytes. Values which don't fit the schema (unexpected fields, strings over 255 bytes,
+ASNs over 32 bits etc.) are simply encoded as JSON, as before.
+
+**Reverse DNS**: ``RDNS_V1`` + ``fresh_until`` (uint32) + the UTF-8 hostname, or the single byte ``RDNS_NEGATIVE_V1``
+for failed lookups.
+
+:func:`.decode_geo` / :func:`.decode_rdns` read both the binary layouts and the older formats (JSON text for GeoIP data,
+``(hostname, fresh_until)`` tuples / plain strings for rDNS), so switching encodings doesn't need the cache flushing.
+The tables and layouts must never change once released - add a new tag (e.g. ``GEO_V2``) instead.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import json
+import math
+import socket
+import struct
+from typing import Any, Dict, Optional, Tuple
+
+from privex.helpers import DictObject
+
+from myip import settings
+
+GEO_V1 = 0xA1
+"""Tag byte of version 1 GeoIP values, with the coordinates stored as int32 (degrees x 10^4)"""
+GEO_V1_F64 = 0xA2
+"""Tag byte of version 1 GeoIP values, with the coordinates stored as float64 (they aren't exact at 4 decimal places)"""
+RDNS_V1 = 0xB1
+"""Tag byte of version 1 rDNS hostname values"""
+RDNS_NEGATIVE_V1 = 0xB0
+"""Tag byte of version 1 negative (failed lookup) rDNS values"""
+
+GEO_FIELDS = ('country', 'country_code', 'city', 'postcode', 'as_number', 'as_name', 'ip_address', 'network', 'long', 'lat')
+"""The fields of the safe form GeoIP data (:func:`myip.app._safe_geo`), in the order they're returned"""
+
+FLAG_COUNTRY = 1 << 10
+"""The country name is in the tail (it isn't the :attr:`.COUNTRIES` name for the country code)"""
+FLAG_CODE = 1 << 11
+"""The country code is in the tail (it isn't in :attr:`.COUNTRIES`) - it's the last thing in the tail"""
+FLAG_IP_STR = 1 << 12
+"""``ip_address`` is stored as text (it isn't in the canonical form of a packed address)"""
+FLAG_NET_STR = 1 << 13
+"""``network`` is stored as text (it isn't in the canonical form of a packed network)"""
+
+_HEAD = {GEO_V1: struct.Struct('<BHBIiiBBBBBBB'), GEO_V1_F64: struct.Struct('<BHBIddBBBBBBB')}
+_RDNS = struct.Struct('<BI')
+_SCALE = 10000
+_NO_CODE = 0xFF
+
+_COUNTRY_TABLE = """
+AD Andorra|AE United Arab Emirates|AF Afghanistan|AG Antigua and Barbuda|AI Anguilla|AL Albania|AM Armenia|AO Angola
+AP Asia/Pacific Region|AQ Antarctica|AR Argentina|AS American Samoa|AT Austria|AU Australia|AW Aruba|AX Åland
+AZ Azerbaijan|BA Bosnia and Herzegovina|BB Barbados|BD Bangladesh|BE Belgium|BF Burkina Faso|BG Bulgaria|BH Bahrain
+BI Burundi|BJ Benin|BL Saint Barthélemy|BM Bermuda|BN Brunei|BO Bolivia|BQ Bonaire, Sint Eustatius, and Saba|BR Brazil
+BS Bahamas|BT Bhutan|BV Bouvet Island|BW Botswana|BY Belarus|BZ Belize|CA Canada|CC Cocos [Keeling] Islands|CD DR Congo
+CF Central African Republic|CG Congo Republic|CH Switzerland|CI Ivory Coast|CK Cook Islands|CL Chile|CM Cameroon|CN China
+CO Colombia|CR Costa Rica|CU Cuba|CV Cabo Verde|CW Curaçao|CX Christmas Island|CY Cyprus|CZ Czechia|DE Germany
+DJ Djibouti|DK Denmark|DM Dominica|DO Dominican Republic|DZ Algeria|EC Ecuador|EE Estonia|EG Egypt|EH Western Sahara
+ER Eritrea|ES Spain|ET Ethiopia|EU Europe|FI Finland|FJ Fiji|FK Falkland Islands|FM Federated States of Micronesia
+FO Faroe Islands|FR France|GA Gabon|GB United Kingdom|GD Grenada|GE Georgia|GF French Guiana|GG Guernsey|GH Ghana
+GI Gibraltar|GL Greenland|GM Gambia|GN Guinea|GP Guadeloupe|GQ Equatorial Guinea|GR Greece
+GS South Georgia and the South Sandwich Islands|GT Guatemala|GU Guam|GW Guinea-Bissau|GY Guyana|HK Hong Kong
+HM Heard Island and McDonald Islands|HN Honduras|HR Croatia|HT Haiti|HU Hungary|ID Indonesia|IE Ireland|IL Israel
+IM Isle of Man|IN India|IO British Indian Ocean Territory|IQ Iraq|IR Iran|IS Iceland|IT Italy|JE Jersey|JM Jamaica
+JO Hashemite Kingdom of Jordan|JP Japan|KE Kenya|KG Kyrgyzstan|KH Cambodia|KI Kiribati|KM Comoros|KN St Kitts and Nevis
+KP North Korea|KR South Korea|KW Kuwait|KY Cayman Islands|KZ Kazakhstan|LA Laos|LB Lebanon|LC Saint Lucia
+LI Liechtenstein|LK Sri Lanka|LR Liberia|LS Lesotho|LT Republic of Lithuania|LU Luxembourg|LV Latvia|LY Libya
+MA Morocco|MC Monaco|MD Republic of Moldova|ME Montenegro|MF Saint Martin|MG Madagascar|MH Marshall Islands
+MK North Macedonia|ML Mali|MM Myanmar|MN Mongolia|MO Macao|MP Northern Mariana Islands|MQ Martinique|MR Mauritania
+MS Montserrat|MT Malta|MU Mauritius|MV Maldives|MW Malawi|MX Mexico|MY Malaysia|MZ Mozambique|NA Namibia
+NC New Caledonia|NE Niger|NF Norfolk Island|NG Nigeria|NI Nicaragua|NL Netherlands|NO Norway|NP Nepal|NR Nauru|NU Niue
+NZ New Zealand|OM Oman|PA Panama|PE Peru|PF French Polynesia|PG Papua New Guinea|PH Philippines|PK Pakistan|PL Poland
+PM Saint Pierre and Miquelon|PN Pitcairn Islands|PR Puerto Rico|PS Palestine|PT Portugal|PW Palau|PY Paraguay|QA Qatar
+RE Réunion|RO Romania|RS Serbia|RU Russia|RW Rwanda|SA Saudi Arabia|SB Solomon Islands|SC Seychelles|SD Sudan|SE Sweden
+SG Singapore|SH Saint Helena|SI Slovenia|SJ Svalbard and Jan Mayen|SK Slovakia|SL Sierra Leone|SM San Marino|SN Senegal
+SO Somalia|SR Suriname|SS South Sudan|ST São Tomé and Príncipe|SV El Salvador|SX Sint Maarten|SY Syria|SZ Eswatini
+TC Turks and Caicos Islands|TD Chad|TF French Southern Territories|TG Togo|TH Thailand|TJ Tajikistan|TK Tokelau
+TL Timor-Leste|TM Turkmenistan|TN Tunisia|TO Tonga|TR Turkey|TT Trinidad and Tobago|TV Tuvalu|TW Taiwan|TZ Tanzania
+UA Ukraine|UG Uganda|UM U.S. Minor Outlying Islands|US United States|UY Uruguay|UZ Uzbekistan|VA Vatican City
+VC St Vincent and Grenadines|VE Venezuela|VG British Virgin Islands|VI U.S. Virgin Islands|VN Vietnam|VU Vanuatu
+WF Wallis and Futuna|WS Samoa|XK Kosovo|YE Yemen|YT Mayotte|ZA South Africa|ZM Zambia|ZW Zimbabwe
+"""
+
+COUNTRIES: Tuple[Tuple[str, str], ...] = tuple(
+    (c[:2], c[3:]) for c in _COUNTRY_TABLE.replace('\n', '|').strip('|').split('|')
+)
+"""
+The country code table - ``(ISO code, English name as used by the GeoLite2 databases)``, indexed by the ``country``
+byte of GeoIP values. Append-only: entries must never be reordered or removed.
+"""
+_CODE_INDEX: Dict[str, int] = {code: i for i, (code, _) in enumerate(COUNTRIES)}
+
+
+def _ntop(packed: bytes) -> str:
+    return socket.inet_ntop(socket.AF_INET6 if len(packed) == 16 else socket.AF_INET, packed)
+
+
+def _pton(addr: str) -> Optional[bytes]:
+    """Pack ``addr``, or ``None`` if it can't be - or wouldn't unpack back into exactly the same string"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packed = socket.inet_pton(family, addr)
+        except (OSError, ValueError, TypeError):
+            continue
+        return packed if _ntop(packed) == addr else None
+    return None
+
+
+def _scaled(v: float) -> Optional[int]:
+    """``v`` x 10^4 as an int32, if it round-trips exactly (GeoLite2 coordinates have 4 decimal places)"""
+    if math.isnan(v) or math.isinf(v):
+        return None
+    n = round(v * _SCALE)
+    if n / _SCALE != v or -0x80000000 > n or n > 0x7FFFFFFF or (n == 0 and math.copysign(1, v) < 0):
+        return None
+    return n
+
+
+def encode_geo(data: Dict[str, Any]) -> Any:
+    """
+    Encode the safe form GeoIP data ``data`` for caching, in the format selected by ``settings.CACHE_CODEC``
+    (see the module docstring). Data which doesn't fit the binary schema is encoded as JSON text.
+
+        >>> raw = encode_geo(get_safe_geodata('185.130.44.1'))
+        >>> len(raw), decode_geo(raw).city
+        (57, 'Stockholm')
+
+    """
+    if settings.CACHE_CODEC != 'binary':
+        return json.dumps(data)
+    try:
+        return _encode_geo(data)
+    except (ValueError, TypeError, AttributeError, struct.error, UnicodeError):
+        return json.dumps(data)
+
+
+def _encode_geo(data: Dict[str, Any]) -> bytes:
+    if tuple(data.keys()) != GEO_FIELDS:
+        raise ValueError('GeoIP data has unexpected fields')
+    country, code, city, postcode, asn, as_name, ip, net, lon, lat = (data[k] for k in GEO_FIELDS)
+    flags = sum(1 << i for i, k in enumerate(GEO_FIELDS) if data[k] is not None)
+
+    idx = _NO_CODE if code is None else _CODE_INDEX.get(code, _NO_CODE)
+    if code is not None and idx == _NO_CODE:
+        flags |= FLAG_CODE
+    if country is not None and (idx == _NO_CODE or COUNTRIES[idx][1] != country):
+        flags |= FLAG_COUNTRY
+
+    if asn is not None and (type(asn) is not int or not 0 <= asn <= 0xFFFFFFFF):
+        raise ValueError('as_number is not a uint32')
+
+    tag, coords = GEO_V1, (0, 0)
+    if lon is not None or lat is not None:
+        if any(v is not None and type(v) is not float for v in (lon, lat)):
+            raise ValueError('Coordinates must be floats')
+        coords = tuple(0 if v is None else _scaled(v) for v in (lon, lat))
+        if None in coords:
+            tag, coords = GEO_V1_F64, tuple(0.0 if v is None else v for v in (lon, lat))
+
+    ip_b, net_b, prefix = b'', b'', 0
+    if ip is not None:
+        ip_b = _pton(ip)
+        if ip_b is None:
+            ip_b, flags = ip.encode('utf-8'), flags | FLAG_IP_STR
+    if net is not None:
+        addr, _, plen = net.partition('/')
+        net_b = _pton(addr) if plen.isdigit() and str(int(plen)) == plen and int(plen) <= 128 else None
+        if net_b is None:
+            net_b, flags = net.encode('utf-8'), flags | FLAG_NET_STR
+        else:
+            prefix = int(plen)
+
+    strs = [
+        country.encode('utf-8') if flags & FLAG_COUNTRY else b'',
+        b'' if city is None else city.encode('utf-8'),
+        b'' if postcode is None else postcode.encode('utf-8'),
+        b'' if as_name is None else as_name.encode('utf-8'),
+    ]
+    head = _HEAD[tag].pack(
+        tag, flags, idx, asn or 0, *coords, *(len(s) for s in strs), len(ip_b), len(net_b), prefix
+    )
+    return head + b''.join(strs) + ip_b + net_b + (code.encode('utf-8') if flags & FLAG_CODE else b'')
+
+
+def decode_geo(raw: Any) -> Optional[DictObject]:
+    """
+    Decode a cached GeoIP value into it's safe form :class:`.DictObject` - ``raw`` can be in the binary layout,
+    or JSON text (cached before the binary encoding, or with ``CACHE_CODEC=json``). Returns ``None`` for empty values.
+    """
+    if not raw:
+        return None
+    if isinstance(raw, (bytearray, memoryview)):
+        raw = bytes(raw)
+    if isinstance(raw, bytes) and raw[0] in _HEAD:
+        return _decode_geo(raw)
+    return DictObject(json.loads(raw))
+
+
+def _decode_geo(raw: bytes) -> DictObject:
+    head = _HEAD[raw[0]]
+    _, flags, idx, asn, lon, lat, l_country, l_city, l_post, l_asname, l_ip, l_net, prefix = head.unpack_from(raw)
+    pos = head.size
+    country = raw[pos:pos + l_country].decode('utf-8'); pos += l_country
+    city = raw[pos:pos + l_city].decode('utf-8'); pos += l_city
+    postcode = raw[pos:pos + l_post].decode('utf-8'); pos += l_post
+    as_name = raw[pos:pos + l_asname].decode('utf-8'); pos += l_asname
+    ip_b = raw[pos:pos + l_ip]; pos += l_ip
+    net_b = raw[pos:pos + l_net]; pos += l_net
+
+    # Bits 0-9 of the flags say which GEO_FIELDS are present - (1 << n) is field n
+    code = None
+    if flags & FLAG_CODE:
+        code = raw[pos:].decode('utf-8')
+    elif flags & (1 << 1):
+        code = COUNTRIES[idx][0]
+    if flags & (1 << 0) and not flags & FLAG_COUNTRY:
+        country = COUNTRIES[idx][1]
+    if raw[0] == GEO_V1:
+        lon, lat = lon / _SCALE, lat / _SCALE
+
+    return DictObject(
+        country=country if flags & (1 << 0) else None,
+        country_code=code,
+        city=city if flags & (1 << 2) else None,
+        postcode=postcode if flags & (1 << 3) else None,
+        as_number=asn if flags & (1 << 4) else None,
+        as_name=as_name if flags & (1 << 5) else None,
+        ip_address=(ip_b.decode('utf-8') if flags & FLAG_IP_STR else _ntop(ip_b)) if flags & (1 << 6) else None,
+        network=(
+            net_b.decode('utf-8') if flags & FLAG_NET_STR else f"{_ntop(net_b)}/{prefix}"
+        ) if flags & (1 << 7) else None,
+        long=lon if flags & (1 << 8) else None,
+        lat=lat if flags & (1 << 9) else None,
+    )
+
+
+def encode_rdns(host: str, fresh_until: Optional[float] = None) -> Any:
+    """
+    Encode a Reverse DNS cache value - ``host`` is :attr:`myip.rdns.NEGATIVE` (``''``) for failed lookups,
+    otherwise the hostname, which is fresh until the UNIX time ``fresh_until`` (``None`` = never goes stale).
+    """
+    if settings.CACHE_CODEC != 'binary':
+        return host if host == '' else (host, fresh_until)
+    if host == '':
+        return bytes((RDNS_NEGATIVE_V1,))
+    fresh = 0xFFFFFFFF if fresh_until is None else min(int(math.ceil(fresh_until)), 0xFFFFFFFF)
+    return _RDNS.pack(RDNS_V1, fresh) + host.encode('utf-8')
+
+
+def decode_rdns(raw: Any) -> Tuple[Optional[str], Optional[float]]:
+    """
+    Decode a cached Reverse DNS value into ``(hostname, fresh_until)`` - the hostname is ``''`` for negative entries
+    or ``None`` if ``raw`` is ``None``, and ``fresh_until`` is ``None`` for entries which never go stale (negative
+    entries, and plain string hostnames cached before stale-while-revalidate). Reads both the binary layout and
+    the older ``(hostname, fresh_until)`` tuples.
+    """
+    if isinstance(raw, (bytes, bytearray)) and len(raw) > 0:
+        if raw[0] == RDNS_V1:
+            return bytes(raw[_RDNS.size:]).decode('utf-8'), float(_RDNS.unpack_from(raw)[1])
+        if raw[0] == RDNS_NEGATIVE_V1:
+            return '', None
+    if isinstance(raw, (tuple, list)):
+        return raw[0], raw[1]
+    return raw, None
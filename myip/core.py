@@ -23,18 +23,28 @@ import sys
 import warnings
 # from pathlib import Path
 from ipaddress import IPv4Address, IPv6Address
-from typing import Any, ContextManager, Iterable, List, Mapping, Type, Union
+from typing import Any, Dict, Iterable, List, Mapping, Type, Union
 
 import geoip2.database
 import yaml
 from flask import Flask, Request, request
 from privex.loghelper import LogHelper
-from privex.helpers import CacheAdapter, DictDataClass, DictObject, Dictable, K, T, ip_is_v6, ip_is_v4, empty, empty_if, r_cache, stringify
-from privex.helpers.geoip import geoip_manager
+from privex.helpers import CacheAdapter, DictDataClass, DictObject, Dictable, K, T, ip_is_v6, ip_is_v4, empty, empty_if, stringify
 from privex.helpers.cache import adapter_get, adapter_set, MemoryCache
+from privex.helpers.exceptions import GeoIPDatabaseNotFound
 
 import accept_types
-from myip import settings
+from myip import metrics, settings
+from myip.assets import AssetManifest
+from myip.cache import (
+    CircuitBreakerCache, LayeredCache, LRUCache, PrefixCache, SingleFlight, cache_breaker, get_many as cache_get_many,
+    set_many as cache_set_many
+)
+from myip.geodb import GeoIPRegistry
+from myip.pages import PageRenderer
+from myip.rdns import RDNSResolver
+from myip.shmcache import SharedMemoryCache
+from myip.revindex import ReverseIndexes
 from myip.settings import RichHandler
 from enum import Enum
 from flask_cors import CORS
@@ -98,6 +108,13 @@ _STORE = {}
 """This dictionary stores instances of various connection classes, such as Redis and GeoIP2"""
 
 
+SHM_ADAPTER_NAMES = ['shm', 'shared', 'sharedmemory', 'sharedmemorycache']
+"""``CACHE_ADAPTER`` names which select :class:`myip.shmcache.SharedMemoryCache`"""
+
+_LOCAL_ADAPTERS = (MemoryCache, LayeredCache, LRUCache, SharedMemoryCache)
+"""Adapters which are never wrapped with a circuit breaker / L1 cache - they're either in-process, or already wrapped"""
+
+
 def set_cache_adapter(adapter: Union[str, CacheAdapter] = None, reset=False) -> CacheAdapter:
     if not reset and settings.CACHE_ADAPTER_SET:
         log.debug(" [core.set_cache_adapter] CACHE_ADAPTER_SET is True + reset is False. Returning "
@@ -146,9 +163,19 @@ def set_cache_adapter(adapter: Union[str, CacheAdapter] = None, reset=False) ->
     else:
         log.debug(" [core.set_cache_adapter] Setting Cache Adapter using user specified string: %s", adapter)
     
+        if isinstance(adapter, str) and adapter.lower() in SHM_ADAPTER_NAMES:
+            adapter = SharedMemoryCache()
         res = adapter_set(adapter)
         log.debug(" [core.set_cache_adapter] Got cache adapter from adapter_set(%s): %s", repr(adapter), repr(res))
 
+    if settings.CACHE_BREAKER and not isinstance(res, _LOCAL_ADAPTERS + (CircuitBreakerCache,)):
+        log.debug(" [core.set_cache_adapter] Wrapping cache adapter %s with a circuit breaker (CircuitBreakerCache)", repr(res))
+        res = adapter_set(CircuitBreakerCache(res))
+
+    if settings.L1_CACHE_ENABLED and not isinstance(res, _LOCAL_ADAPTERS):
+        log.debug(" [core.set_cache_adapter] Wrapping cache adapter %s with in-process L1 cache (LayeredCache)", repr(res))
+        res = adapter_set(LayeredCache(res))
+
     settings.CACHE_ADAPTER_SET = True
     return res
 
@@ -165,7 +192,45 @@ def get_cache(default: Union[str, CacheAdapter] = None, reset=False) -> CacheAda
         log.debug(" [core.get_cache] Adapter is: %s", repr(adp))
         return adp
     return set_cache_adapter(default, reset=reset)
-    
+
+
+def get_cache_stats() -> DictObject:
+    """
+    Return the hit/miss counters for the current cache adapter, if it's a :class:`myip.cache.LayeredCache` - otherwise
+    returns a :class:`.DictObject` containing just the adapter class name (plus the table occupancy for a
+    :class:`myip.shmcache.SharedMemoryCache`). If there's a circuit breaker in front of the shared cache, it's state
+    is included as ``breaker`` (see :meth:`myip.cache.CircuitBreakerCache.stats`).
+    """
+    adp = get_cache()
+    res = adp.stats() if isinstance(adp, LayeredCache) else DictObject(adapter=adp.__class__.__name__)
+    if isinstance(adp, SharedMemoryCache):
+        res.update(adp.stats())
+    breaker = cache_breaker(adp)
+    if breaker is not None:
+        res.breaker = breaker.stats()
+    return res
+
+
+def get_cache_many(keys: Iterable[str], default: Any = None) -> Dict[str, Any]:
+    """
+    Retrieve multiple keys from the cache adapter in a single round-trip (see :func:`myip.cache.get_many`), returning
+    a :class:`.dict` mapping each key to it's cached value - or ``default`` if the key wasn't found / was expired.
+
+        >>> get_cache_many(['geoip:185.130.44.1', 'geoip:8.8.8.8'])
+        {'geoip:185.130.44.1': b'\xa1\xff\x03\xd9...', 'geoip:8.8.8.8': None}
+
+    """
+    return metrics.cache_get_many(get_cache(), keys, default, fetch=cache_get_many)
+
+
+def set_cache_many(values: Dict[str, Any], timeout: int):
+    """
+    Store multiple keys (``{key: value}``) in the cache adapter with the same ``timeout``, in as few round-trips as the
+    adapter allows (see :func:`myip.cache.set_many`)
+    """
+    with metrics.timer('cache'):
+        cache_set_many(get_cache(), values, timeout)
+
 
 # def get_redis() -> redis.Redis:
 #     """Initialise or obtain a Redis instance from _STORE"""
@@ -183,23 +248,84 @@ class GeoType(Enum):
     CITY = 'city'
 
 
-def get_geoip(gtype: GeoType = GeoType.CITY) -> ContextManager[geoip2.database.Reader]:
+def get_geoip_registry() -> GeoIPRegistry:
+    """Initialise or obtain the :class:`myip.geodb.GeoIPRegistry` instance from _STORE"""
+    if 'geoip' not in _STORE:
+        _STORE['geoip'] = GeoIPRegistry()
+    return _STORE['geoip']
+
+
+def get_geo_net_cache() -> PrefixCache:
+    """
+    Initialise or obtain the in-process GeoIP network cache (a :class:`myip.cache.PrefixCache`) from _STORE,
+    which is cleared whenever a GeoIP database is reloaded.
     """
-    Initialise or obtain a GeoIP2 Reader instance from _STORE
+    if 'geonet' not in _STORE:
+        pc = PrefixCache(max_size=settings.GEOIP_NET_CACHE_SIZE, ttl=settings.GEOIP_CACHE_SEC)
+        get_geoip_registry().reload_hooks.append(lambda geo_type, db: pc.clear())
+        _STORE['geonet'] = pc
+    return _STORE['geonet']
+
+
+def get_single_flight() -> SingleFlight:
+    """Initialise or obtain the :class:`myip.cache.SingleFlight` used to coalesce concurrent GeoIP lookups from _STORE"""
+    if 'flight' not in _STORE:
+        _STORE['flight'] = SingleFlight()
+    return _STORE['flight']
+
+
+def get_assets() -> AssetManifest:
+    """Initialise or obtain the :class:`myip.assets.AssetManifest` (built static assets, see ``build-assets``) from _STORE"""
+    if 'assets' not in _STORE:
+        _STORE['assets'] = AssetManifest()
+    return _STORE['assets']
+
+
+def get_pages() -> PageRenderer:
+    """Initialise or obtain the :class:`myip.pages.PageRenderer` instance (precompiled / cached HTML pages) from _STORE"""
+    if 'pages' not in _STORE:
+        _STORE['pages'] = PageRenderer(app, assets=get_assets())
+    return _STORE['pages']
+
+
+def get_reverse_index() -> ReverseIndexes:
+    """Initialise or obtain the :class:`myip.revindex.ReverseIndexes` (ASN / country to network indexes) from _STORE"""
+    if 'revindex' not in _STORE:
+        _STORE['revindex'] = ReverseIndexes(get_geoip_registry())
+    return _STORE['revindex']
+
+
+def get_geoip(gtype: Union[GeoType, str] = GeoType.CITY) -> geoip2.database.Reader:
+    """
+    Obtain the shared GeoIP2 Reader instance for a database from :func:`.get_geoip_registry`.
+    
+    The reader is shared by every thread in the process, so it shouldn't be used as a context manager (which would close it).
+    
+        >>> get_geoip(GeoType.ASN).asn('185.130.44.1').autonomous_system_organization
+        'Privex Inc.'
     
     :param GeoType gtype: The type of GeoIP2 database to load (ASN/City/Country), e.g. ``GeoType.ASN``
     :return geoip2.database.Reader G2Reader: An instance of :class:`geoip2.database.Reader` for looking up IPv4/v6 addresses.
 
     """
-    gtype = str(gtype.value)
-    
-    # gtype = str(gtype.value)
-    
-    # l = f'geoip_{gtype}'
-    # if l not in _STORE:
-    # _STORE[l] = geoip_manager(join(GEOIP_PATH, gtype))
-    return geoip_manager(gtype)
-    # return _STORE[l]
+    return get_geoip_registry().get(str(gtype.value if isinstance(gtype, GeoType) else gtype))
+
+
+def get_geoip_epoch(*gtypes: Union[GeoType, str]) -> str:
+    """
+    Returns the build epochs of the GeoIP2 databases ``gtypes`` (default: the ASN + City databases, which lookups
+    use) joined into one string, e.g. ``'1615420800-1615334400'`` - which changes whenever one of them is updated.
+
+    Databases which can't be found are included as ``0``.
+    """
+    reg = get_geoip_registry()
+    epochs = []
+    for gt in (gtypes if len(gtypes) > 0 else (GeoType.ASN, GeoType.CITY)):
+        try:
+            epochs.append(str(reg.build_epoch(str(gt.value if isinstance(gt, GeoType) else gt))))
+        except GeoIPDatabaseNotFound:
+            epochs.append('0')
+    return '-'.join(epochs)
 
 
 def get_ip() -> str:
@@ -222,6 +348,7 @@ def get_ip() -> str:
 
 
 def get_rdns_base(ip: Union[str, IPv4Address, IPv6Address, Any], fallback: T = None, fail=False) -> Union[str, T]:
+    """Resolve the reverse DNS for ``ip`` directly in the current thread - bypassing the cache and :func:`.get_resolver`"""
     ip = str(stringify(ip))
     try:
         return str(socket.gethostbyaddr(ip)[0])
@@ -231,9 +358,46 @@ def get_rdns_base(ip: Union[str, IPv4Address, IPv6Address, Any], fallback: T = N
         return fallback
 
 
-@r_cache(lambda ip, fallback="", fail=False: f"myip:rdns:{ip!s}:{fail!r}", cache_time=settings.RDNS_CACHE_SEC)
-def get_rdns(ip: Union[str, IPv4Address, IPv6Address, Any], fallback: T = "", fail=False) -> Union[str, T]:
-    return get_rdns_base(ip, fallback, fail=fail)
+def get_resolver() -> RDNSResolver:
+    """Initialise or obtain the :class:`myip.rdns.RDNSResolver` instance from _STORE"""
+    if 'rdns' not in _STORE:
+        _STORE['rdns'] = RDNSResolver(cache=get_cache)
+    return _STORE['rdns']
+
+
+def set_resolver(resolver: RDNSResolver) -> RDNSResolver:
+    """Replace the :class:`myip.rdns.RDNSResolver` used by :func:`.get_rdns` - e.g. with one using a stub resolve function"""
+    old = _STORE.get('rdns')
+    if old is not None and old is not resolver: old.close()
+    _STORE['rdns'] = resolver
+    return resolver
+
+
+def reset_store(*keys: str):
+    """
+    Forget the instances held in _STORE (all of them, or just ``keys``) without closing them - for use in a freshly
+    forked worker process, so it opens it's own GeoIP readers / thread pools instead of using ones inherited from it's parent.
+    """
+    for k in (keys if len(keys) > 0 else list(_STORE.keys())):
+        _STORE.pop(k, None)
+
+
+def get_rdns(ip: Union[str, IPv4Address, IPv6Address, Any], fallback: T = "", fail=False, wait=True) -> Union[str, T]:
+    """
+    Get the reverse DNS hostname for ``ip`` via :func:`.get_resolver` - waiting at most ``settings.RDNS_TIMEOUT`` seconds.
+    
+    With ``wait=False``, returns the cached hostname (or ``fallback``) without waiting for a lookup.
+    """
+    return get_resolver().resolve(stringify(ip), fallback=fallback, fail=fail, wait=wait)
+
+
+def get_rdns_many(ips: Iterable[Union[str, IPv4Address, IPv6Address, Any]], fallback: T = "", wait=True) -> Dict[str, Union[str, T]]:
+    """
+    Batch version of :func:`.get_rdns` - returns a dict mapping each address to it's hostname (or ``fallback``), reading
+    the cached hostnames in one go, and resolving the rest concurrently within a single ``settings.RDNS_TIMEOUT`` deadline
+    (see :meth:`myip.rdns.RDNSResolver.resolve_many`).
+    """
+    return get_resolver().resolve_many((stringify(ip) for ip in ips), fallback=fallback, timeout=None if wait else 0.0)
 
 
 CONTENT_TYPES = dict(
@@ -245,8 +409,10 @@ CONTENT_TYPES = dict(
           'application/x-html', 'application/xhtml', 'application/xhtml+xml',
           'web', 'page', 'webpage'],
     yaml=['yml', 'yaml', 'x-yml', 'x-yaml', 'text/yaml', 'text/vnd.yaml', 'text/yml', 'application/yaml', 'application/yml',
-          'text/x-yaml', 'text/x-yml', 'application/vnd.yaml', 'application/x-yaml', 'application/x-yml']
-    
+          'text/x-yaml', 'text/x-yml', 'application/vnd.yaml', 'application/x-yaml', 'application/x-yml'],
+    ndjson=['ndjson', 'jsonl', 'jsonlines', 'application/x-ndjson', 'application/ndjson', 'application/jsonl',
+            'application/x-jsonlines'],
+    csv=['csv', 'text/csv', 'application/csv', 'text/x-csv'],
 )
 
 
@@ -0,0 +1,227 @@
+"""
+Offline bulk enrichment - ``python -m myip enrich`` reads IP addresses (one per line) from a file or stdin, and writes
+the GeoIP (and optionally reverse DNS) data for each address as NDJSON or CSV, spreading the lookups across a pool
+of worker processes, each with it's own memory-mapped GeoIP2 readers.
+
+Examples::
+
+    # Enrich the client IPs in an nginx access log (the first whitespace separated column), using every CPU core
+    python -m myip enrich -c 0 /var/log/nginx/access.log > enriched.ndjson
+
+    # CSV output with reverse DNS, in whatever order the results come back in (faster with many workers)
+    zcat ips.gz | python -m myip enrich --format csv --rdns --unordered -o enriched.csv
+
+Input is read lazily in chunks, and at most ``--max-inflight`` chunks are queued / being looked up at any one time,
+so memory use doesn't depend on the size of the input. Throughput is reported to stderr every ``--progress`` seconds.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from privex.helpers import DictObject
+
+from myip.app import CSV_FIELDS, GeoResult, csv_row, lookup_many
+from myip.cache import LRUCache
+from myip.core import reset_store, set_cache_adapter
+from myip.serializer import to_safe
+
+FORMATS = ['ndjson', 'csv']
+
+_OPTS = DictObject()
+"""The enrichment options for the current worker process, set by :func:`._init_worker`"""
+
+
+def _init_worker(opts: dict):
+    """
+    Runs once in each worker process - drops any GeoIP readers / rDNS thread pool inherited from the parent process,
+    and sets up the cache: a bounded per-process :class:`.LRUCache` by default, or fresh connections to the configured
+    cache adapter (e.g. Redis) with ``--shared-cache``.
+    """
+    _OPTS.clear()
+    _OPTS.update(opts)
+    reset_store('geoip', 'geonet', 'rdns')
+    set_cache_adapter(None if opts['shared_cache'] else LRUCache(max_size=opts['cache_size']), reset=True)
+
+
+def _extract(line: str, column: Optional[int], delimiter: Optional[str]) -> Optional[str]:
+    line = line.strip()
+    if line == '' or line.startswith('#'):
+        return None
+    if column is None:
+        return line
+    cols = line.split(delimiter)
+    return cols[column].strip() if len(cols) > column else None
+
+
+def _record(res: GeoResult) -> DictObject:
+    """
+    The output record for ``res`` - the same as ``to_safe(res)`` minus ``ua`` / ``raw_data``, but built directly, as
+    :attr:`.GeoResult.geo` is already safe (see :meth:`.GeoResult.set_geo`), and walking the dataclass is the slowest
+    part of enriching an address.
+    """
+    return DictObject(
+        ip=res.ip, hostname=res.hostname, error=res.error, messages=list(res.messages), ip_valid=res.ip_valid,
+        ip_type=res.ip_type, geo=to_safe(res.geo) if not isinstance(res.geo, dict) else res.geo
+    )
+
+
+def enrich_chunk(lines: List[str]) -> Tuple[str, int, int]:
+    """
+    Runs in a worker process - looks up each address in ``lines`` with :func:`myip.app.lookup_many`, and returns a tuple
+    of ``(output, addresses, errors)``, where ``output`` is the formatted output for the chunk (one line per address,
+    in the same order as ``lines``).
+    """
+    ips = [ip for ip in (_extract(ln, _OPTS.column, _OPTS.delimiter) for ln in lines) if ip is not None]
+    results = lookup_many(ips, rdns=_OPTS.rdns)
+    out, errors = io.StringIO(), 0
+    writer = csv.writer(out) if _OPTS.format == 'csv' else None
+    for ip in ips:
+        rec = _record(results[ip])
+        if rec.error or not rec.ip_valid: errors += 1
+        if writer is None:
+            out.write(json.dumps(rec) + '\n')
+        else:
+            writer.writerow(csv_row(rec))
+    return out.getvalue(), len(ips), errors
+
+
+def _chunks(stream: TextIO, size: int) -> Iterator[List[str]]:
+    while True:
+        chunk = list(islice(stream, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class Progress:
+    """Counts the enriched addresses, and reports the throughput to ``out`` at most every ``interval`` seconds"""
+    def __init__(self, interval: float = 5.0, out: TextIO = sys.stderr, quiet=False):
+        self.interval, self.out, self.quiet = interval, out, quiet
+        self.started = self.last_report = time.monotonic()
+        self.addresses, self.errors, self.chunks = 0, 0, 0
+
+    def add(self, addresses: int, errors: int):
+        self.addresses += addresses
+        self.errors += errors
+        self.chunks += 1
+        if self.interval > 0 and time.monotonic() - self.last_report >= self.interval:
+            self.report()
+
+    def report(self, final=False):
+        self.last_report = time.monotonic()
+        if self.quiet: return
+        taken = max(self.last_report - self.started, 1e-9)
+        print(f"[enrich] {'Finished - ' if final else ''}{self.addresses:,} addresses ({self.errors:,} errors / not found) "
+              f"in {taken:.1f}s - {self.addresses / taken:,.0f} addresses/sec", file=self.out, flush=True)
+
+
+def enrich(
+    stream: Iterable[str], out: TextIO, fmt: str = 'ndjson', rdns=False, workers: int = None, chunk_size: int = 1000,
+    max_inflight: int = None, ordered=True, column: int = None, delimiter: str = None, shared_cache=False,
+    cache_size: int = 100000, progress: Progress = None
+) -> Progress:
+    """
+    Enrich the addresses from ``stream`` (an iterable of lines, e.g. an open file) using a pool of ``workers``
+    processes, writing the results to ``out``. Returns the :class:`.Progress` counters.
+
+    The input is split into chunks of ``chunk_size`` lines, and at most ``max_inflight`` chunks (default: ``workers * 2``)
+    are pending at once. With ``ordered=False``, each chunk is written as soon as it's done, rather than in input order.
+    """
+    workers = (os.cpu_count() or 1) if workers is None else max(int(workers), 1)
+    max_inflight = workers * 2 if max_inflight is None else max(int(max_inflight), 1)
+    progress = Progress() if progress is None else progress
+    opts = dict(format=fmt, rdns=rdns, column=column, delimiter=delimiter, shared_cache=shared_cache, cache_size=cache_size)
+
+    if fmt == 'csv':
+        csv.writer(out).writerow(CSV_FIELDS)
+
+    def _write(fut: Future):
+        text, count, errors = fut.result()
+        out.write(text)
+        progress.add(count, errors)
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(opts,)) as pool:
+        for chunk in _chunks(iter(stream), chunk_size):
+            while len(pending) >= max_inflight:
+                if ordered:
+                    _write(pending.popleft())
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in [f for f in pending if f in done]:
+                    pending.remove(fut)
+                    _write(fut)
+            pending.append(pool.submit(enrich_chunk, chunk))
+        while len(pending) > 0:
+            _write(pending.popleft())
+    out.flush()
+    return progress
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='python -m myip enrich', description=__doc__.split('Copyright::')[0], formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('input', nargs='?', default='-', help="File to read addresses from, one per line (default: '-' for stdin)")
+    parser.add_argument('-o', '--output', default='-', help="File to write the results to (default: '-' for stdout)")
+    parser.add_argument('-f', '--format', choices=FORMATS, default='ndjson', help='Output format (default: ndjson)')
+    parser.add_argument('--rdns', action='store_true', help='Look up the reverse DNS hostname of each address (slow!)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('-s', '--chunk-size', type=int, default=1000, help='Addresses sent to a worker at a time (default: 1000)')
+    parser.add_argument('--max-inflight', type=int, default=None, help='Maximum chunks pending at once (default: workers * 2)')
+    parser.add_argument('-u', '--unordered', action='store_true', help="Write results as soon as they're ready, instead of in input order")
+    parser.add_argument('-c', '--column', type=int, default=None,
+                        help='Take the address from this (0-indexed) column of each line, instead of using the whole line')
+    parser.add_argument('-d', '--delimiter', default=None, help='Column delimiter for --column (default: any whitespace)')
+    parser.add_argument('--shared-cache', action='store_true',
+                        help='Use the configured cache adapter (e.g. Redis) instead of a bounded per-process cache')
+    parser.add_argument('--cache-size', type=int, default=100000, help='Max keys in the per-process cache (default: 100000)')
+    parser.add_argument('-p', '--progress', type=float, default=5.0, help='Report throughput every N seconds, 0 to disable (default: 5)')
+    parser.add_argument('-q', '--quiet', action='store_true', help="Don't report throughput to stderr")
+    return parser
+
+
+def main(argv: List[str] = None) -> int:
+    args = build_parser().parse_args(argv)
+    stream = sys.stdin if args.input == '-' else open(args.input, 'r', errors='replace')
+    out = sys.stdout if args.output == '-' else open(args.output, 'w', newline='' if args.format == 'csv' else None)
+    progress = Progress(interval=args.progress, quiet=args.quiet)
+    try:
+        enrich(
+            stream, out, fmt=args.format, rdns=args.rdns, workers=args.workers, chunk_size=args.chunk_size,
+            max_inflight=args.max_inflight, ordered=not args.unordered, column=args.column, delimiter=args.delimiter,
+            shared_cache=args.shared_cache, cache_size=args.cache_size, progress=progress
+        )
+    except KeyboardInterrupt:
+        progress.report(final=True)
+        return 130
+    finally:
+        if stream is not sys.stdin: stream.close()
+        if out is not sys.stdout: out.close()
+    progress.report(final=True)
+    return 0
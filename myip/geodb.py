@@ -0,0 +1,232 @@
+"""
+GeoIP2 database reader registry - opens each GeoIP2 ``.mmdb`` database once per process (memory-mapped by default),
+and swaps in a new reader when the database file is replaced on disk (e.g. by ``update_geoip.sh``).
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+import geoip2.database
+import maxminddb
+from privex.helpers import DictObject
+from privex.helpers import settings as pvx_settings
+from privex.helpers.exceptions import GeoIPDatabaseNotFound
+
+from myip import metrics, settings
+from myip.mmdbtree import SearchTree
+
+log = logging.getLogger(__name__)
+
+GEOIP_MODES = {
+    'auto': maxminddb.MODE_AUTO, 'mmap_ext': maxminddb.MODE_MMAP_EXT, 'mmap': maxminddb.MODE_MMAP,
+    'file': maxminddb.MODE_FILE, 'memory': maxminddb.MODE_MEMORY,
+}
+"""Maps the values accepted by ``settings.GEOIP_MODE`` to :mod:`maxminddb` open modes"""
+
+FileSig = Tuple[int, int, int, int]
+
+
+def file_sig(path: Union[str, Path]) -> FileSig:
+    """Returns a ``(device, inode, size, mtime_ns)`` tuple for ``path``, which changes whenever the file is replaced"""
+    st = os.stat(path)
+    return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+
+@dataclass(frozen=True)
+class LoadedDB:
+    """An open GeoIP2 reader, along with the path and :func:`.file_sig` of the file it was opened from"""
+    reader: geoip2.database.Reader
+    path: Path
+    sig: FileSig
+    loaded_at: float
+    build_epoch: int = 0
+
+
+class GeoIPRegistry:
+    """
+    Holds one :class:`geoip2.database.Reader` per GeoIP2 database (``asn`` / ``city`` / ``country``), opened on first
+    use, and shared by every thread in the process.
+
+    Readers are opened with ``settings.GEOIP_MODE`` - by default ``auto``, which memory-maps the database (using the
+    ``libmaxminddb`` C extension if it's installed), so every gunicorn worker shares the same page cache, rather than
+    each worker holding it's own copy of the database.
+
+    At most every ``check_interval`` seconds, :meth:`.get` stats the database file, and if it's been replaced
+    (a different inode / size / mtime), opens the new file and swaps it in. The old reader is never closed
+    explicitly - requests which already hold it carry on using it, and it's freed once the last of them finishes.
+    If the new file can't be opened, the error is logged and the old reader is kept. Functions appended to
+    :attr:`.reload_hooks` are called with ``(geo_type, new_db)`` after each reload, e.g. to clear caches.
+
+    Database updates must replace the file (write to a temporary file, then rename it over the old one - as ``rsync``
+    and ``geoipupdate`` do), rather than overwriting it in-place, as that would change the data under existing readers.
+
+        >>> reg = GeoIPRegistry()
+        >>> reg.get('city').city('185.130.44.1').city.names['en']
+        'Stockholm'
+
+    """
+    def __init__(
+        self, db_dir: Union[str, Path] = None, names: Dict[str, str] = None, mode: str = None, check_interval: float = None,
+        search_paths: Iterable[Union[str, Path]] = None
+    ):
+        self.db_dir = Path(settings.GEOIP_PATH if db_dir is None else db_dir)
+        self.names = dict(
+            asn=settings.GEOASN_NAME, city=settings.GEOCITY_NAME, country=settings.GEOCOUNTRY_NAME
+        ) if names is None else dict(names)
+        mode = str(settings.GEOIP_MODE if mode is None else mode).lower()
+        if mode not in GEOIP_MODES:
+            raise ValueError(f"Invalid GeoIP mode '{mode}' - must be one of: {', '.join(GEOIP_MODES.keys())}")
+        self.mode, self.mode_name = GEOIP_MODES[mode], mode
+        self.check_interval = float(settings.GEOIP_RELOAD_INTERVAL if check_interval is None else check_interval)
+        self.search_paths = [Path(p) for p in (pvx_settings.search_geoip if search_paths is None else search_paths)]
+        self._dbs: Dict[str, LoadedDB] = {}
+        self._next_check: Dict[str, float] = {}
+        self._failed: Dict[str, FileSig] = {}
+        self._trees: Dict[str, Tuple[FileSig, SearchTree]] = {}
+        self._lock = threading.Lock()
+        self.reloads, self.reload_errors = 0, 0
+        self.reload_hooks: List[Callable[[str, LoadedDB], Any]] = []
+
+    def find(self, geo_type: str) -> Path:
+        """
+        Returns the path to the database file for ``geo_type`` - from :attr:`.db_dir` (``settings.GEOIP_PATH``) if it
+        exists there, otherwise the first of :attr:`.search_paths` which contains it.
+        """
+        if geo_type not in self.names:
+            raise AttributeError(f"GeoIP database type must be one of: {', '.join(self.names.keys())}")
+        name = self.names[geo_type]
+        for p in [self.db_dir] + self.search_paths:
+            if (p / name).exists():
+                return p / name
+        raise GeoIPDatabaseNotFound(f"Failed to locate GeoIP {geo_type.capitalize()} ({name}) in {self.db_dir} or {self.search_paths}")
+
+    def _open(self, geo_type: str, path: Path = None) -> LoadedDB:
+        path = self.find(geo_type) if path is None else path
+        sig = file_sig(path)
+        reader = geoip2.database.Reader(str(path), mode=self.mode)
+        build_epoch = reader.metadata().build_epoch
+        log.debug("Opened GeoIP %s database %s (mode: %s)", geo_type, path, self.mode_name)
+        metrics.geoip_loaded(geo_type, build_epoch, reloaded=geo_type in self._dbs)
+        return LoadedDB(reader=reader, path=path, sig=sig, loaded_at=time.time(), build_epoch=build_epoch)
+
+    def get(self, geo_type: str) -> geoip2.database.Reader:
+        """Returns the (shared) reader for the ``geo_type`` database (``asn`` / ``city`` / ``country``), opening it if needed"""
+        db = self._dbs.get(geo_type)
+        if db is None:
+            with self._lock:
+                db = self._dbs.get(geo_type)
+                if db is None:
+                    db = self._dbs[geo_type] = self._open(geo_type)
+                    self._next_check[geo_type] = time.monotonic() + self.check_interval
+            return db.reader
+        if self.check_interval > 0 and time.monotonic() >= self._next_check.get(geo_type, 0):
+            db = self._check(geo_type, db)
+        return db.reader
+
+    def _check(self, geo_type: str, db: LoadedDB) -> LoadedDB:
+        # Only one thread checks for a new file at a time - other threads just carry on with the current reader
+        if not self._lock.acquire(blocking=False):
+            return db
+        try:
+            self._next_check[geo_type] = time.monotonic() + self.check_interval
+            return self._reload(geo_type, db)
+        finally:
+            self._lock.release()
+
+    def _reload(self, geo_type: str, db: Optional[LoadedDB], force=False) -> Optional[LoadedDB]:
+        sig = None
+        try:
+            path = self.find(geo_type)
+            sig = file_sig(path)
+            if not force and db is not None and path == db.path and sig == db.sig:
+                return db
+            # Don't keep re-trying (and logging) a file which already failed to load, until it's replaced again
+            if not force and self._failed.get(geo_type) == sig:
+                return db
+            new_db = self._open(geo_type, path)
+        except Exception:
+            log.exception("Failed to load new GeoIP %s database - keeping the currently loaded database", geo_type)
+            self.reload_errors += 1
+            if sig is not None: self._failed[geo_type] = sig
+            return db
+        self._failed.pop(geo_type, None)
+        self._dbs[geo_type] = new_db
+        self.reloads += 1
+        for hook in self.reload_hooks:
+            try:
+                hook(geo_type, new_db)
+            except Exception:
+                log.exception("Error while calling GeoIP reload hook %r", hook)
+        log.info("Reloaded GeoIP %s database from %s (build epoch: %s)", geo_type, new_db.path, new_db.build_epoch)
+        return new_db
+
+    def build_epoch(self, geo_type: str) -> int:
+        """Returns the build epoch (from the MMDB metadata) of the ``geo_type`` database, opening it if needed"""
+        self.get(geo_type)
+        return self._dbs[geo_type].build_epoch
+
+    def tree(self, geo_type: str) -> SearchTree:
+        """
+        Returns a :class:`myip.mmdbtree.SearchTree` for the currently loaded ``geo_type`` database (used to walk every
+        network in a range), opening it if needed - and re-opening it whenever the database is reloaded.
+        """
+        self.get(geo_type)
+        db = self._dbs[geo_type]
+        cached = self._trees.get(geo_type)
+        if cached is not None and cached[0] == db.sig:
+            return cached[1]
+        tree = SearchTree(db.path)
+        self._trees[geo_type] = (db.sig, tree)
+        return tree
+
+    def reload(self, *geo_types: str, force=False) -> int:
+        """
+        Check the loaded databases (or just ``geo_types``) for a replaced file right away, re-opening any which have
+        changed (or all of them, with ``force=True``). Returns the number of databases which were reloaded.
+        """
+        reloaded = 0
+        with self._lock:
+            for gt in (geo_types if len(geo_types) > 0 else list(self._dbs.keys())):
+                db = self._dbs.get(gt)
+                if self._reload(gt, db, force=force) is not db: reloaded += 1
+                self._next_check[gt] = time.monotonic() + self.check_interval
+        return reloaded
+
+    def info(self) -> DictObject:
+        """Returns the path, build epoch and load time of each loaded database, plus the reload counters"""
+        dbs = DictObject()
+        for gt, db in list(self._dbs.items()):
+            meta = db.reader.metadata()
+            dbs[gt] = DictObject(
+                path=str(db.path), database_type=meta.database_type, build_epoch=meta.build_epoch, loaded_at=db.loaded_at
+            )
+        return DictObject(mode=self.mode_name, check_interval=self.check_interval, reloads=self.reloads,
+                          reload_errors=self.reload_errors, databases=dbs)
+
+    def close(self):
+        with self._lock:
+            for db in self._dbs.values():
+                db.reader.close()
+            self._dbs.clear()
+            self._trees.clear()
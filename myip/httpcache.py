@@ -0,0 +1,100 @@
+"""
+HTTP caching for the lookup views - ``ETag``, ``Cache-Control`` and ``Vary`` headers, and ``304 Not Modified``
+responses to conditional (``If-None-Match``) requests.
+
+A view works out everything its response depends on - the address(es), the negotiated output format, the requested
+fields, the GeoIP2 database build epoch (see :func:`myip.core.get_geoip_epoch`), and the ``User-Agent`` if the
+response echoes it - and passes it to :func:`.validate` *before* doing any GeoIP / rDNS work::
+
+    >>> not_modified = validate(make_etag('lookup', ip, wanted, dtype, get_geoip_epoch()), public=True)
+    >>> if not_modified is not None:
+    ...     return not_modified
+
+The headers are added to the view's response (``200`` / ``304`` only) by :func:`.apply`, which is called from an
+``after_request`` hook in :mod:`myip.app`. ETags are weak (``W/"..."``), as a response may contain a hostname from
+a more recent Reverse DNS lookup, while being equivalent to the previous one.
+
+  * Lookups of an explicitly requested address are ``public, max-age=settings.HTTP_CACHE_MAX_AGE``, so a CDN / proxy
+    can serve repeat requests. They ``Vary`` on ``Accept`` (the output format can be negotiated), and ``User-Agent``
+    when the response echoes the client's user agent (full JSON / YAML / NDJSON records, and the ``all`` / ``ua``
+    plain text fields).
+  * Responses about the client's own IP are ``private`` - only the client itself may cache them.
+  * Requests other than ``GET`` / ``HEAD`` (i.e. batch ``POST`` lookups) are never given validators.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import hashlib
+from typing import Any, Iterable, Optional
+
+from flask import Response, g, request
+
+from myip import settings
+
+CACHEABLE_METHODS = ('GET', 'HEAD')
+
+
+def make_etag(*parts: Any) -> str:
+    """Returns an (unquoted) ETag value for a response which depends on ``parts``"""
+    return hashlib.blake2b('\0'.join(str(p) for p in parts).encode('utf-8', 'surrogateescape'), digest_size=12).hexdigest()
+
+
+def cache_control(public: bool) -> str:
+    """Returns the ``Cache-Control`` header value for a ``public`` (explicit address) or private (client's own IP) response"""
+    if public:
+        return f"public, max-age={settings.HTTP_CACHE_MAX_AGE}"
+    if settings.HTTP_CACHE_CLIENT_MAX_AGE > 0:
+        return f"private, max-age={settings.HTTP_CACHE_CLIENT_MAX_AGE}"
+    return "private, no-cache"
+
+
+def enabled() -> bool:
+    """Whether the current request can be given validators (``settings.HTTP_CACHE`` is on, and it's a GET / HEAD request)"""
+    return settings.HTTP_CACHE and request.method in CACHEABLE_METHODS
+
+
+def matches(etag: str) -> bool:
+    """Returns ``True`` if the current request's ``If-None-Match`` header matches ``etag``"""
+    return enabled() and request.if_none_match.contains_weak(etag)
+
+
+def validate(etag: str, public: bool, vary: Iterable[str] = ('Accept',)) -> Optional[Response]:
+    """
+    Set the ``ETag`` / ``Cache-Control`` / ``Vary`` headers which :func:`.apply` adds to the current request's response.
+
+    Returns a ``304 Not Modified`` response if the request's ``If-None-Match`` header matches ``etag`` - the view
+    should return it straight away - otherwise ``None``.
+    """
+    if not enabled():
+        return None
+    g.myip_http_cache = (etag, cache_control(public), tuple(vary))
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304)
+    return None
+
+
+def apply(response: Response) -> Response:
+    """Add the headers set by :func:`.validate` to ``response`` (only if it's a ``200`` or ``304``)"""
+    hdrs = g.get('myip_http_cache')
+    if hdrs is None or response.status_code not in (200, 304):
+        return response
+    etag, cc, vary = hdrs
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = cc
+    for v in vary:
+        response.vary.add(v)
+    return response
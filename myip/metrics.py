@@ -0,0 +1,297 @@
+"""
+Prometheus metrics - request counts (by route, negotiated output format and status), per-stage latency histograms
+(cache, GeoIP, rDNS, serialization and rendering), cache hit / miss / error counters per cache tier, rDNS timeouts,
+the build epoch of each loaded GeoIP2 database, the build time / size of the reverse indexes, and the state of the
+cache circuit breaker. Served in the Prometheus text format at ``settings.METRICS_PATH``.
+
+Under gunicorn, each worker process has it's own counters - so that a scrape (which hits a single worker) sees the
+totals for every worker, set ``METRICS_DIR`` to a directory shared by all of the workers (``run.sh`` / ``dkr/init.sh``
+do this by default, clearing it on startup). Each worker then writes it's metrics into memory-mapped files in that
+directory, which are aggregated on each scrape (see ``prometheus_client.multiprocess``).
+
+Instrumentation is kept cheap on the hot path - label children are resolved once and re-used, and when metrics are
+disabled (or ``prometheus_client`` isn't installed), every function here returns straight away.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import hmac
+import logging
+import os
+import warnings
+from contextlib import nullcontext
+from ipaddress import ip_address, ip_network
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from privex.helpers import empty
+
+from myip import settings
+
+log = logging.getLogger(__name__)
+
+ENABLED = settings.METRICS_ENABLED
+
+if ENABLED and settings.METRICS_DIR is not None:
+    # prometheus_client decides whether to use multiprocess (file backed) values when it's imported
+    settings.METRICS_DIR.mkdir(parents=True, exist_ok=True)
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = str(settings.METRICS_DIR)
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+    from prometheus_client import multiprocess
+except ImportError as pce:
+    if ENABLED:
+        warnings.warn(f"Failed to import prometheus_client - metrics are disabled. Reason: {type(pce)} - {pce!s}", ImportWarning)
+    ENABLED = False
+
+STAGES = ('cache', 'geoip', 'rdns', 'serialize', 'render')
+"""
+The stages timed by ``myip_stage_duration_seconds``:
+
+  * ``cache`` - reads and writes to the cache adapter (Redis / Memcached / memory)
+  * ``geoip`` - GeoIP2 database lookups (cache misses)
+  * ``rdns`` - time spent waiting for Reverse DNS lookups which weren't cached
+  * ``serialize`` - converting results into their safe (JSON serializable) form
+  * ``render`` - formatting the response (JSON / YAML / HTML template / plain text)
+
+"""
+
+FORMATS = {
+    'application/json': 'json', 'text/yaml': 'yaml', 'text/plain': 'text', 'text/html': 'html',
+    'application/x-ndjson': 'ndjson', 'text/csv': 'csv',
+}
+"""Maps response mimetypes to the ``format`` label of ``myip_requests_total`` - anything else is counted as ``other``"""
+
+STAGE_BUCKETS = (.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0)
+REQUEST_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+if ENABLED:
+    REQUESTS = Counter('myip_requests', 'Requests by route, negotiated output format and HTTP status', ['endpoint', 'format', 'status'])
+    REQUEST_SECONDS = Histogram(
+        'myip_request_duration_seconds', 'Time taken by the view (until streaming starts, for streamed formats)',
+        ['endpoint'], buckets=REQUEST_BUCKETS
+    )
+    STAGE_SECONDS = Histogram('myip_stage_duration_seconds', 'Time spent in each stage of a request', ['stage'], buckets=STAGE_BUCKETS)
+    CACHE_REQUESTS = Counter('myip_cache_requests', 'Cache reads by tier and result (hit / miss / error)', ['tier', 'result'])
+    RDNS_LOOKUPS = Counter('myip_rdns_lookups', 'Reverse DNS lookups by result (found / failed)', ['result'])
+    RDNS_TIMEOUTS = Counter('myip_rdns_timeouts', 'Reverse DNS lookups which a request stopped waiting for')
+    GEOIP_BUILD_EPOCH = Gauge(
+        'myip_geoip_build_epoch', 'Build epoch (unix time) of the loaded GeoIP2 database', ['database'], multiprocess_mode='max'
+    )
+    GEOIP_RELOADS = Counter('myip_geoip_reloads', 'GeoIP2 databases re-opened after being replaced on disk', ['database'])
+    INDEX_BUILD_SECONDS = Gauge(
+        'myip_reverse_index_build_seconds', 'Time taken to build the loaded ASN / country reverse index', ['index'], multiprocess_mode='max'
+    )
+    INDEX_NETWORKS = Gauge('myip_reverse_index_networks', 'Networks in the loaded reverse index', ['index'], multiprocess_mode='max')
+    INDEX_BYTES = Gauge('myip_reverse_index_bytes', 'Size of the loaded (memory-mapped) reverse index file', ['index'], multiprocess_mode='max')
+    CACHE_BREAKER_OPEN = Gauge(
+        'myip_cache_breaker_open', 'Worker processes whose cache circuit breaker is open (using the in-process fallback cache)',
+        ['tier'], multiprocess_mode='livesum'
+    )
+    CACHE_BREAKER_TRIPS = Counter('myip_cache_breaker_trips', 'Times a cache circuit breaker opened', ['tier'])
+
+    _STAGE = {s: STAGE_SECONDS.labels(stage=s) for s in STAGES}
+    _RDNS_RESULTS = {r: RDNS_LOOKUPS.labels(result=r) for r in ['found', 'failed']}
+
+_CACHE_EVENTS: Dict[Tuple[str, str], Any] = {}
+_TIERS: Dict[type, Optional[str]] = {}
+_MISSING = object()
+
+
+class _Timer:
+    """Observes the time spent inside a ``with`` block into a stage histogram - cheaper than a ``@contextmanager``"""
+    __slots__ = ('child', 'started')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(perf_counter() - self.started)
+
+
+_NOOP = nullcontext()
+
+
+def timer(stage: str):
+    """
+    Time the ``with`` block as ``stage`` (one of :attr:`.STAGES`)
+
+        >>> with timer('render'):
+        ...     res = jsonify(data)
+
+    """
+    return _Timer(_STAGE[stage]) if ENABLED else _NOOP
+
+
+def observe(stage: str, started: float):
+    """Record the time since ``started`` (a :func:`time.perf_counter` value) as ``stage``"""
+    if ENABLED: _STAGE[stage].observe(perf_counter() - started)
+
+
+def cache_event(tier: str, result: str, amount: int = 1):
+    """Count ``amount`` cache reads against ``tier`` (e.g. ``l1`` / ``redis``) with ``result`` (``hit`` / ``miss`` / ``error``)"""
+    if not ENABLED or amount <= 0: return
+    child = _CACHE_EVENTS.get((tier, result))
+    if child is None:
+        child = _CACHE_EVENTS[(tier, result)] = CACHE_REQUESTS.labels(tier=tier, result=result)
+    child.inc(amount)
+
+
+def cache_tier(adapter: Any) -> Optional[str]:
+    """
+    The ``tier`` label for a cache adapter - ``RedisCache`` = ``redis``, ``MemcachedCache`` = ``memcached`` etc. Adapters
+    which count their own reads per tier (i.e. :class:`myip.cache.LayeredCache`) set ``METRICS_TIER = None``.
+    """
+    cls = type(adapter)
+    tier = _TIERS.get(cls, _MISSING)
+    if tier is _MISSING:
+        tier = getattr(cls, 'METRICS_TIER', _MISSING)
+        if tier is _MISSING:
+            tier = cls.__name__.lower().replace('cache', '').replace('adapter', '') or 'cache'
+        _TIERS[cls] = tier
+    return tier
+
+
+def cache_get(adapter: Any, key: str, default: Any = None) -> Any:
+    """``adapter.get(key, default)``, timed as the ``cache`` stage, and counted as a hit / miss / error against it's tier"""
+    if not ENABLED:
+        return adapter.get(key, default)
+    tier, started = cache_tier(adapter), perf_counter()
+    try:
+        val = adapter.get(key, _MISSING)
+    except Exception:
+        if tier is not None: cache_event(tier, 'error')
+        raise
+    finally:
+        _STAGE['cache'].observe(perf_counter() - started)
+    if val is _MISSING or val is None:
+        if tier is not None: cache_event(tier, 'miss')
+        return default
+    if tier is not None: cache_event(tier, 'hit')
+    return val
+
+
+def cache_get_many(
+    adapter: Any, keys: Iterable[str], default: Any = None, fetch: Callable[[Any, List[str]], Dict[str, Any]] = None
+) -> Dict[str, Any]:
+    """
+    Same as :func:`.cache_get` for multiple keys - the reads are timed as a single ``cache`` stage observation.
+
+    ``fetch(adapter, keys)`` does the actual reads, returning the keys which were found (e.g. :func:`myip.cache.get_many`,
+    which fetches them in a single round-trip) - by default, each key is read with ``adapter.get``.
+    """
+    keys = list(dict.fromkeys(str(k) for k in keys))
+    if fetch is None:
+        fetch = _fetch_each
+    if not ENABLED:
+        found = fetch(adapter, keys)
+        return {k: found.get(k, default) for k in keys}
+    tier, started = cache_tier(adapter), perf_counter()
+    try:
+        found = fetch(adapter, keys)
+    except Exception:
+        if tier is not None: cache_event(tier, 'error')
+        raise
+    finally:
+        _STAGE['cache'].observe(perf_counter() - started)
+    if tier is not None:
+        cache_event(tier, 'hit', len(found))
+        cache_event(tier, 'miss', len(keys) - len(found))
+    return {k: found.get(k, default) for k in keys}
+
+
+def _fetch_each(adapter: Any, keys: List[str]) -> Dict[str, Any]:
+    res = {}
+    for k in keys:
+        val = adapter.get(k, _MISSING)
+        if val is not _MISSING and val is not None:
+            res[k] = val
+    return res
+
+
+def breaker_state(tier: str, is_open: bool, tripped=False):
+    """Record whether the cache circuit breaker in front of ``tier`` is open - and count a trip if it just opened"""
+    if not ENABLED: return
+    CACHE_BREAKER_OPEN.labels(tier=tier).set(1 if is_open else 0)
+    if tripped: CACHE_BREAKER_TRIPS.labels(tier=tier).inc()
+
+
+def rdns_lookup(found: bool):
+    if ENABLED: _RDNS_RESULTS['found' if found else 'failed'].inc()
+
+
+def rdns_timeout(amount: int = 1):
+    if ENABLED and amount > 0: RDNS_TIMEOUTS.inc(amount)
+
+
+def geoip_loaded(database: str, build_epoch: int, reloaded=False):
+    """Record the build epoch of a newly opened GeoIP2 ``database`` (``asn`` / ``city`` / ``country``)"""
+    if not ENABLED: return
+    GEOIP_BUILD_EPOCH.labels(database=database).set(build_epoch)
+    if reloaded: GEOIP_RELOADS.labels(database=database).inc()
+
+
+def index_loaded(index: str, build_seconds: float, networks: int, size: int):
+    """Record the build time, network count and file size of a newly loaded reverse ``index`` (``asn`` / ``country``)"""
+    if not ENABLED: return
+    INDEX_BUILD_SECONDS.labels(index=index).set(build_seconds)
+    INDEX_NETWORKS.labels(index=index).set(networks)
+    INDEX_BYTES.labels(index=index).set(size)
+
+
+def record_request(endpoint: Optional[str], mimetype: Optional[str], status: int, seconds: float):
+    if not ENABLED: return
+    endpoint = endpoint or 'none'
+    REQUESTS.labels(endpoint=endpoint, format=FORMATS.get(mimetype, 'other'), status=str(status)).inc()
+    REQUEST_SECONDS.labels(endpoint=endpoint).observe(seconds)
+
+
+_ALLOW = [ip_network(n, strict=False) for n in settings.METRICS_ALLOW if n not in ['', '*']]
+_ALLOW_ALL = '*' in settings.METRICS_ALLOW
+
+
+def client_allowed(ip: Optional[str], token: Optional[str] = None) -> bool:
+    """
+    Returns ``True`` if a client may read the metrics - either ``token`` matches ``settings.METRICS_TOKEN``, or the
+    client ``ip`` is within one of the networks in ``settings.METRICS_ALLOW``
+    """
+    if not empty(settings.METRICS_TOKEN) and not empty(token) and hmac.compare_digest(str(token), settings.METRICS_TOKEN):
+        return True
+    if _ALLOW_ALL:
+        return True
+    try:
+        ipo = ip_address(str(ip).strip())
+    except ValueError:
+        return False
+    if ipo.version == 6 and ipo.ipv4_mapped is not None:
+        ipo = ipo.ipv4_mapped
+    return any(ipo in n for n in _ALLOW)
+
+
+def render_latest() -> Tuple[bytes, str]:
+    """Returns the current metrics (aggregated across every worker process, when ``METRICS_DIR`` is set) and their content type"""
+    if settings.METRICS_DIR is not None:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
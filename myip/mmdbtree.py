@@ -0,0 +1,210 @@
+"""
+Direct access to the binary search tree of a MaxMind DB (``.mmdb``) file - used to walk every network in a GeoIP2
+database (or just the networks inside a CIDR range) in a single traversal, which the ``geoip2`` / ``maxminddb`` readers
+don't offer (they can only look up one address at a time, or iterate over the whole database). :func:`.overlay`
+combines the walks of several databases (e.g. City + ASN) into the networks which have the same data in all of them.
+
+The file is memory-mapped, and data records are decoded with :class:`maxminddb.decoder.Decoder` - each distinct
+record is only decoded once per walk, as many networks share the same record.
+
+    >>> tree = SearchTree('/usr/share/GeoIP/GeoLite2-ASN.mmdb')
+    >>> for net, rec in tree.walk('185.130.44.0/22'):
+    ...     print(net, rec['autonomous_system_number'])
+    185.130.44.0/22 210083
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import mmap
+import struct
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network, ip_network, summarize_address_range
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from maxminddb.decoder import Decoder
+from maxminddb.errors import InvalidDatabaseError
+
+METADATA_MARKER = b'\xab\xcd\xefMaxMind.com'
+METADATA_MAX_SIZE = 128 * 1024
+IPV4_MAX = 0xFFFFFFFF
+
+Network = Union[IPv4Network, IPv6Network]
+RawNetwork = Tuple[int, int, int, int]
+"""``(version, address, prefixlen, pointer)`` - a network found by :meth:`.SearchTree.walk_raw`, and it's data record pointer"""
+
+
+class SearchTree:
+    """
+    A memory-mapped MaxMind DB file, exposing it's search tree - see :meth:`.walk` and :meth:`.walk_raw`.
+
+    The file is opened separately from the ``geoip2`` reader, so (like the reader) it keeps the file it was opened from
+    mapped even if it's replaced on disk.
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path, 'rb') as fh:
+            self._buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        start = self._buf.rfind(METADATA_MARKER, max(0, len(self._buf) - METADATA_MAX_SIZE))
+        if start < 0:
+            raise InvalidDatabaseError(f"Could not find the MaxMind DB metadata in {self.path}")
+        start += len(METADATA_MARKER)
+        self.metadata: Dict[str, Any] = Decoder(self._buf, start).decode(start)[0]
+        self.node_count: int = self.metadata['node_count']
+        self.record_size: int = self.metadata['record_size']
+        self.ip_version: int = self.metadata['ip_version']
+        self.build_epoch: int = self.metadata['build_epoch']
+        if self.record_size not in (24, 28, 32):
+            raise InvalidDatabaseError(f"Unknown record size {self.record_size} in {self.path}")
+        self.search_tree_size = self.node_count * self.record_size // 4
+        self._decoder = Decoder(self._buf, self.search_tree_size + 16)
+        self.bits = 128 if self.ip_version == 6 else 32
+        self.ipv4_start = 0
+        if self.ip_version == 6:
+            for _ in range(96):
+                if self.ipv4_start >= self.node_count: break
+                self.ipv4_start = self.read_node(self.ipv4_start)[0]
+
+    def read_node(self, node: int) -> Tuple[int, int]:
+        """Returns the left (0 bit) and right (1 bit) records of ``node``"""
+        buf, rs = self._buf, self.record_size
+        if rs == 32:
+            return struct.unpack_from('>II', buf, node * 8)
+        if rs == 24:
+            o = node * 6
+            return int.from_bytes(buf[o:o + 3], 'big'), int.from_bytes(buf[o + 3:o + 6], 'big')
+        o = node * 7
+        mid = buf[o + 3]
+        return ((mid & 0xF0) << 20) | int.from_bytes(buf[o:o + 3], 'big'), ((mid & 0x0F) << 24) | int.from_bytes(buf[o + 4:o + 7], 'big')
+
+    def record(self, pointer: int) -> Any:
+        """Decode the data record which a search tree record ``pointer`` (above :attr:`.node_count`) points to"""
+        return self._decoder.decode(pointer - self.node_count + self.search_tree_size)[0]
+
+    def _tree_prefix(self, network: Optional[Union[str, Network]]) -> Tuple[int, int]:
+        """Returns ``(address, prefixlen)`` of ``network`` in the tree's address space (IPv4 lives under ``::/96`` in IPv6 trees)"""
+        if network is None:
+            return 0, 0
+        net = ip_network(network, strict=False)
+        if net.version == 4 and self.bits == 128:
+            return int(net.network_address), net.prefixlen + 96
+        if net.version == 6 and self.bits == 32:
+            raise ValueError(f"Cannot look up IPv6 network {net} in an IPv4-only database")
+        return int(net.network_address), net.prefixlen
+
+    def _raw(self, acc: int, depth: int, pointer: int) -> RawNetwork:
+        addr = acc << (self.bits - depth)
+        if self.bits == 32:
+            return 4, addr, depth, pointer
+        if depth >= 96 and addr <= IPV4_MAX:
+            return 4, addr, depth - 96, pointer
+        return 6, addr, depth, pointer
+
+    def walk_raw(self, network: Union[str, Network] = None) -> Iterator[RawNetwork]:
+        """
+        Yields ``(version, address, prefixlen, pointer)`` for every network with data in the tree (or inside ``network``),
+        in ascending address order - ``pointer`` can be passed to :meth:`.record`, and is the same for every network
+        which shares the same data record.
+
+        If ``network`` is inside a single (larger) network in the database, that network is yielded instead.
+        IPv4 networks are only yielded once - not again under the IPv6 ranges which alias IPv4 (``::ffff:0:0/96`` etc.)
+        """
+        addr, plen = self._tree_prefix(network)
+        node, count = 0, self.node_count
+        for depth in range(plen):
+            if node >= count:
+                if node > count:
+                    # The whole range is inside one network - return that network
+                    yield self._raw(addr >> (self.bits - depth), depth, node)
+                return
+            node = self.read_node(node)[(addr >> (self.bits - 1 - depth)) & 1]
+        stack = [(node, plen, addr >> (self.bits - plen) if plen > 0 else 0)]
+        ipv4_start, read_node = self.ipv4_start, self.read_node
+        while stack:
+            node, depth, acc = stack.pop()
+            if node > count:
+                yield self._raw(acc, depth, node)
+                continue
+            if node == count or (acc != 0 and node == ipv4_start and self.bits == 128):
+                continue
+            left, right = read_node(node)
+            acc <<= 1
+            stack.append((right, depth + 1, acc | 1))
+            stack.append((left, depth + 1, acc))
+
+    def walk(self, network: Union[str, Network] = None, transform: Callable[[Any], Any] = None) -> Iterator[Tuple[Network, Any]]:
+        """
+        Yields ``(network, record)`` for every network in the tree (or inside ``network``) - see :meth:`.walk_raw`.
+        Records are passed through ``transform`` if it's given, and each distinct record is only decoded once.
+        """
+        decoded: Dict[int, Any] = {}
+        for version, addr, plen, pointer in self.walk_raw(network):
+            rec = decoded.get(pointer, decoded)
+            if rec is decoded:
+                rec = decoded[pointer] = self.record(pointer) if transform is None else transform(self.record(pointer))
+            yield (IPv4Network((addr, plen)) if version == 4 else IPv6Network((addr, plen))), rec
+
+    def close(self):
+        self._buf.close()
+
+
+def overlay(*walks: Iterable[Tuple[Network, Any]], within: Union[str, Network] = None) -> Iterator[Tuple[Network, Tuple[Any, ...]]]:
+    """
+    Combine several :meth:`.SearchTree.walk` s (each in ascending address order, without overlapping networks) - yields
+    ``(network, records)`` for each network where the combination of records is the same, with ``records`` holding
+    each walk's record for that network (``None`` for walks without one). Addresses with no records are skipped, and
+    if ``within`` is set, networks are clipped to it (walks of a range inside a larger network return the larger network).
+
+        >>> for net, (city, asn) in overlay(city_tree.walk('185.130.44.0/22'), asn_tree.walk('185.130.44.0/22')):
+        ...     print(net, city['city']['names']['en'], asn['autonomous_system_number'])
+        185.130.44.0/23 Stockholm 210083
+        185.130.46.0/24 Amsterdam 210083
+        185.130.47.0/24 Amsterdam 210083
+
+    """
+    within = None if within is None else ip_network(within, strict=False)
+    lo, hi = (0, 2 ** 128) if within is None else (int(within.network_address), int(within.broadcast_address))
+
+    def _ranges(walk):
+        for net, rec in walk:
+            if within is not None and net.version != within.version:
+                continue
+            start, end = max(lo, int(net.network_address)), min(hi, int(net.broadcast_address))
+            if start <= end:
+                yield net.version, start, end, rec
+
+    iters = [_ranges(w) for w in walks]
+    heads: List[Optional[tuple]] = [next(it, None) for it in iters]
+    pos: Optional[Tuple[int, int]] = None
+    while True:
+        live = [h for h in heads if h is not None]
+        if len(live) == 0:
+            return
+        # The next segment starts at the lowest range start (at or after the end of the last segment)
+        ver, start = min((h[0], h[1] if pos is None or (h[0], h[1]) > pos else pos[1]) for h in live)
+        end, recs = None, []
+        for h in heads:
+            active = h is not None and h[0] == ver and h[1] <= start
+            recs.append(h[3] if active else None)
+            if h is not None and h[0] == ver:
+                edge = h[2] if active else h[1] - 1
+                end = edge if end is None else min(end, edge)
+        addr_cls = IPv4Address if ver == 4 else IPv6Address
+        yield from ((net, tuple(recs)) for net in summarize_address_range(addr_cls(start), addr_cls(end)))
+        pos = (ver, end + 1)
+        for i, h in enumerate(heads):
+            if h is not None and h[0] == ver and h[2] <= end:
+                heads[i] = next(iters[i], None)
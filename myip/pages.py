@@ -0,0 +1,184 @@
+"""
+Precompiled, cached rendering of the HTML pages - the ``/api`` docs and the static parts of the index page.
+
+``templates/api.md`` is converted from Markdown into a Jinja2 template object once, and only re-converted when the
+file changes. Rendered pages only vary by the host variables from :func:`myip.app._tpl_add_hosts`, so each host
+variant's output is kept in a bounded :class:`myip.cache.LRUStore` (``settings.PAGE_CACHE_SIZE`` variants, as the
+``Host`` header comes from the client), along with a gzip-compressed copy of the body and it's ETag.
+
+The index page is per-visitor, but only the ``_client_info.html`` table in it is - :meth:`.PageRenderer.index` renders
+the rest of ``index.html`` once per host variant (with a marker in place of the table), and then just renders the
+table into the gap for each request.
+
+With ``settings.PAGE_CACHE`` disabled, the Markdown is still precompiled, but pages are rendered on every request.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import gzip
+import hashlib
+import logging
+import os
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import markdown
+from flask import Flask, render_template
+from jinja2 import Template
+from markdown.extensions.fenced_code import FencedCodeExtension
+from markdown.extensions.toc import TocExtension
+from markupsafe import Markup
+from privex.helpers import DictObject
+
+from myip import settings
+from myip.assets import AssetManifest
+from myip.cache import LRUStore
+
+log = logging.getLogger(__name__)
+
+CLIENT_MARKER = '<!-- myip:client-info:6c1f0e2a -->'
+"""Placeholder for the per-visitor ``_client_info.html`` table, while rendering the static parts of ``index.html``"""
+
+INDEX_TEMPLATES = ('index.html', 'base.html', '_client_info.html')
+"""The templates which the index page is rendered from"""
+
+
+@dataclass(frozen=True)
+class RenderedPage:
+    """A rendered page - the body, a gzip-compressed copy of it (``None`` if compression is disabled), and it's ETag"""
+    body: bytes
+    gzipped: Optional[bytes]
+    etag: str
+
+    @classmethod
+    def from_text(cls, text: str, gzip_level: int = None) -> "RenderedPage":
+        body = text.encode('utf-8')
+        gzip_level = settings.PAGE_GZIP_LEVEL if gzip_level is None else gzip_level
+        return cls(
+            body=body, gzipped=gzip.compress(body, compresslevel=gzip_level, mtime=0) if gzip_level > 0 else None,
+            etag=hashlib.blake2b(body, digest_size=12).hexdigest()
+        )
+
+
+class MarkdownTemplate:
+    """
+    A Markdown file (with Jinja2 tags, e.g. ``{{ host }}``) converted to HTML, and compiled into a :class:`jinja2.Template`
+    with the environment of ``app``. :meth:`.template` re-compiles it whenever the file is replaced or modified.
+    """
+    def __init__(self, app: Flask, path: Union[str, Path]):
+        self.app, self.path = app, Path(path)
+        self.version = 0
+        self._sig: Optional[Tuple[int, int]] = None
+        self._tpl: Optional[Template] = None
+        self._lock = threading.Lock()
+
+    def compile(self) -> Template:
+        md = markdown.Markdown(extensions=[TocExtension(title='Table of Contents'), FencedCodeExtension()])
+        with open(self.path, 'r') as fh:
+            return self.app.jinja_env.from_string(md.convert(fh.read()))
+
+    def template(self) -> Tuple[Template, int]:
+        """Returns the compiled template, and it's version number (which is increased each time it's re-compiled)"""
+        st = os.stat(self.path)
+        sig = (st.st_ino, st.st_mtime_ns)
+        if sig != self._sig:
+            with self._lock:
+                if sig != self._sig:
+                    self._tpl = self.compile()
+                    self._sig = sig
+                    self.version += 1
+                    log.debug("Compiled Markdown template %s (version %d)", self.path, self.version)
+        return self._tpl, self.version
+
+
+class PageRenderer:
+    """
+    Renders the ``/api`` docs (:meth:`.api_docs`) and the index page (:meth:`.index`), caching the parts which only
+    depend on the host variables (``host`` / ``v4_host`` / ``v6_host`` / ``main_host``). Must be called within
+    a request context.
+
+    If ``assets`` (the :class:`myip.assets.AssetManifest`) is given, pages are re-rendered whenever the assets are rebuilt.
+    """
+    def __init__(self, app: Flask, max_size: int = None, enabled: bool = None, assets: Optional[AssetManifest] = None):
+        self.app, self.assets = app, assets
+        self.enabled = settings.PAGE_CACHE if enabled is None else enabled
+        self.store = LRUStore(max_size=settings.PAGE_CACHE_SIZE if max_size is None else max_size, ttl=settings.DAY)
+        self.api_md = MarkdownTemplate(app, settings.TEMPLATES_DIR / 'api.md')
+        self._digests = {}
+
+    def _templates_version(self, *names: str) -> str:
+        # Jinja2 returns a new template object whenever it auto-reloads a changed template file
+        return '-'.join(str(id(self.app.jinja_env.get_template(n))) for n in names)
+
+    def templates_digest(self, *names: str) -> str:
+        """
+        A version of the templates ``names`` which is the same in every worker process (and on every server) - a hash of
+        their source, only re-hashed when Jinja2 reloads a changed template. Used in HTTP ETags, where the per-process
+        :meth:`._templates_version` can't be.
+        """
+        res = []
+        for n in names:
+            tpl = self.app.jinja_env.get_template(n)
+            tpl_digest = self._digests.get(n)
+            if tpl_digest is None or tpl_digest[0] is not tpl:
+                src = Path(tpl.filename).read_bytes() if tpl.filename else str(id(tpl)).encode()
+                tpl_digest = self._digests[n] = (tpl, hashlib.blake2b(src, digest_size=6).hexdigest())
+            res.append(tpl_digest[1])
+        return '-'.join(res)
+
+    def index_version(self) -> str:
+        """The :meth:`.templates_digest` of the index page's templates (:attr:`.INDEX_TEMPLATES`)"""
+        return self.templates_digest(*INDEX_TEMPLATES)
+
+    def _cache_key(self, page: str, version: str, hosts: dict) -> str:
+        if self.assets is not None:
+            version = f"{version}-{self.assets.version}"
+        return f"{page}:{version}:" + '|'.join(f"{k}={hosts[k]}" for k in sorted(hosts.keys()))
+
+    def api_docs(self, hosts: dict) -> RenderedPage:
+        """Returns the rendered ``/api`` docs page for the host variables ``hosts``"""
+        tpl, version = self.api_md.template()
+        key = self._cache_key('api', f"{version}-{self._templates_version('mdpage.html', 'base.html')}", hosts)
+        page = self.store.get(key) if self.enabled else None
+        if page is None:
+            ctx = dict(hosts)
+            self.app.update_template_context(ctx)
+            page = RenderedPage.from_text(render_template('mdpage.html', content=tpl.render(ctx)))
+            if self.enabled: self.store.set(key, page)
+        return page
+
+    def index_parts(self, hosts: dict) -> Tuple[str, str]:
+        """Returns the parts of the rendered ``index.html`` page before and after the ``_client_info.html`` table"""
+        key = self._cache_key('index', self._templates_version('index.html', 'base.html'), hosts)
+        parts = self.store.get(key) if self.enabled else None
+        if parts is None:
+            head, marker, tail = render_template('index.html', client_info=Markup(CLIENT_MARKER)).partition(CLIENT_MARKER)
+            if marker == '':
+                raise ValueError("index.html doesn't contain the client_info placeholder")
+            parts = (head, tail)
+            if self.enabled: self.store.set(key, parts)
+        return parts
+
+    def index(self, hosts: dict, **data) -> str:
+        """Renders the index page for the visitor ``data`` (see :class:`myip.app.GeoResult`) - the same as ``render_template('index.html', **data)``"""
+        head, tail = self.index_parts(hosts)
+        return head + self.app.jinja_env.get_template('_client_info.html').render(data) + tail
+
+    def stats(self) -> DictObject:
+        return self.store.stats()
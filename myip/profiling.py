@@ -0,0 +1,225 @@
+"""
+On-demand request profiling - profiles individual requests to the lookup views (``view_lookup``, ``_index`` and
+``view_flat``) in a live worker, without attaching a profiler to the process. Off by default.
+
+A request is profiled when either:
+
+  * It sends the ``settings.PROFILE_HEADER`` header (default ``X-Profile``) containing ``settings.PROFILE_SECRET``
+  * ``settings.PROFILE_SAMPLE_EVERY`` is set to ``N`` - every N'th request (per worker process) is profiled
+
+Reports are written into ``settings.PROFILE_DIR`` (``<LOG_DIR>/profiles`` by default), in one of two modes:
+
+  * ``collapsed`` - the request's thread is sampled every ``settings.PROFILE_INTERVAL`` seconds, and the stacks are
+    written in the collapsed (``frame;frame;frame count``) format, which can be loaded straight into
+    `speedscope <https://www.speedscope.app>`_ or ``flamegraph.pl`` to get a flame graph.
+  * ``cprofile`` - the request runs under :mod:`cProfile`, and the stats are written as a ``.prof`` file
+    (open with ``python -m pstats`` or ``snakeviz``).
+
+The report's file name is returned in the ``X-Profile-Report`` response header. On-demand requests can also send
+``X-Profile-Mode: cprofile`` to pick the mode, and ``X-Profile-Return: true`` to get the report back as the response
+body, instead of the normal response::
+
+    curl -H 'X-Profile: MY_SECRET' -H 'X-Profile-Return: true' 'http://127.0.0.1:5151/lookup/?ips=1.1.1.1,8.8.8.8' > lookup.collapsed
+
+Streamed responses (``ndjson`` / ``csv``) are only profiled until the view returns - not while the body is streamed.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import cProfile
+import functools
+import hmac
+import io
+import itertools
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from types import FrameType
+from typing import Callable, Optional, Tuple
+
+from flask import Response, current_app, g, request
+from privex.helpers import empty, is_true
+
+from myip import settings
+
+log = logging.getLogger(__name__)
+
+MODES = ['collapsed', 'cprofile']
+
+ACTIVE = (not empty(settings.PROFILE_SECRET) or settings.PROFILE_SAMPLE_EVERY > 0)
+"""Whether profiling can happen at all - when ``False``, :func:`.profiled` views are called directly"""
+
+_counter = itertools.count(1)
+_report_counter = itertools.count(1)
+_cprofile_lock = threading.Lock()
+
+
+class StackSampler:
+    """
+    Samples the stack of one thread every ``interval`` seconds from a background thread, counting each distinct stack
+    (from ``root`` - the frame which started profiling - downwards) for output in the collapsed stack format.
+
+        >>> s = StackSampler(threading.get_ident(), sys._getframe())
+        >>> s.start(); do_work(); s.stop()
+        >>> print(s.collapsed())
+        myip.app:view_lookup;myip.app:lookup_many;myip.app:get_safe_geodata 12
+        ...
+
+    Samples can only be taken when the sampling thread holds the GIL, so the effective interval may be longer
+    than ``interval`` (see :func:`sys.getswitchinterval`).
+    """
+    def __init__(self, thread_id: int, root: FrameType = None, interval: float = None):
+        self.thread_id, self.root = thread_id, root
+        self.interval = settings.PROFILE_INTERVAL if interval is None else interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def frame_name(frame: FrameType) -> str:
+        return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        stack = []
+        while frame is not None:
+            stack.append(self.frame_name(frame))
+            if frame is self.root:
+                break
+            frame = frame.f_back
+        if len(stack) > 0:
+            self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='myip-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def collapsed(self) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def wanted() -> Tuple[Optional[str], bool]:
+    """
+    Returns ``(mode, on_demand)`` for the current request - ``mode`` is ``None`` if the request shouldn't be profiled,
+    and ``on_demand`` is ``True`` if it was requested by sending ``settings.PROFILE_SECRET``.
+    """
+    secret = request.headers.get(settings.PROFILE_HEADER) if not empty(settings.PROFILE_SECRET) else None
+    if secret is not None and hmac.compare_digest(secret.encode(), settings.PROFILE_SECRET.encode()):
+        mode = request.headers.get('X-Profile-Mode', settings.PROFILE_MODE).lower()
+        return (mode if mode in MODES else settings.PROFILE_MODE), True
+    if settings.PROFILE_SAMPLE_EVERY > 0 and next(_counter) % settings.PROFILE_SAMPLE_EVERY == 0:
+        return settings.PROFILE_MODE, False
+    return None, False
+
+
+def _prune(directory: Path, keep: int):
+    """Delete the oldest reports in ``directory``, so that at most ``keep`` are left"""
+    reports = sorted(directory.glob('*.*'), key=lambda p: p.stat().st_mtime)
+    for p in reports[:max(len(reports) - keep, 0)]:
+        try:
+            p.unlink()
+        except OSError:
+            pass
+
+
+def write_report(name: str, mode: str, sampler: StackSampler = None, profiler: cProfile.Profile = None) -> Path:
+    """Write a collapsed stacks (``.collapsed``) or cProfile (``.prof``) report into ``settings.PROFILE_DIR``"""
+    directory = settings.PROFILE_DIR
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{os.getpid()}-{next(_report_counter)}.{'prof' if mode == 'cprofile' else 'collapsed'}"
+    if mode == 'cprofile':
+        profiler.dump_stats(str(path))
+    else:
+        path.write_text(sampler.collapsed())
+    if settings.PROFILE_KEEP > 0:
+        _prune(directory, settings.PROFILE_KEEP)
+    return path
+
+
+def _report_text(mode: str, sampler: StackSampler = None, profiler: cProfile.Profile = None) -> str:
+    if mode != 'cprofile':
+        return sampler.collapsed()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(60)
+    return out.getvalue()
+
+
+def profiled(view: Callable) -> Callable:
+    """
+    Decorator for Flask views - profiles the view when :func:`.wanted` says the current request should be, writing
+    the report with :func:`.write_report`. Views are called directly when profiling is disabled (see :attr:`.ACTIVE`).
+    """
+    name = view.__name__.strip('_')
+
+    @functools.wraps(view)
+    def _wrapper(*args, **kwargs):
+        if not ACTIVE:
+            return view(*args, **kwargs)
+        mode, on_demand = wanted()
+        if mode is None:
+            return view(*args, **kwargs)
+        sampler, profiler = None, None
+        if mode == 'cprofile':
+            # Only one cProfile profiler can be active at once on newer Pythons - just skip profiling if one's running
+            if not _cprofile_lock.acquire(blocking=False):
+                log.info("Not profiling %s - another request is already being profiled with cProfile", request.path)
+                return view(*args, **kwargs)
+            try:
+                profiler = cProfile.Profile()
+                res = profiler.runcall(view, *args, **kwargs)
+            finally:
+                _cprofile_lock.release()
+        else:
+            sampler = StackSampler(threading.get_ident(), sys._getframe())
+            sampler.start()
+            try:
+                res = view(*args, **kwargs)
+            finally:
+                sampler.stop()
+        try:
+            path = write_report(name, mode, sampler=sampler, profiler=profiler)
+        except Exception:
+            log.exception("Failed to write profiling report for %s", request.path)
+            path = None
+        log.info("Profiled %s (%s) - report: %s", request.full_path, mode, path)
+        if on_demand and is_true(request.headers.get('X-Profile-Return', False)):
+            res = Response(_report_text(mode, sampler=sampler, profiler=profiler), status=200, content_type='text/plain')
+        res = current_app.make_response(res)
+        if path is not None: res.headers['X-Profile-Report'] = path.name
+        # Profiled responses (which may be the report itself) must never get the lookup's ETag / public Cache-Control
+        # from myip.httpcache.apply, or a CDN could cache the report and serve it for that URL
+        g.pop('myip_http_cache', None)
+        res.headers['Cache-Control'] = 'no-store'
+        return res
+
+    return _wrapper
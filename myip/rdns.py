@@ -0,0 +1,335 @@
+"""
+Reverse DNS (rDNS) resolver - runs PTR lookups on a bounded thread pool with per-lookup deadlines,
+caching both successful and failed lookups (failures with a much shorter TTL), and refreshing expired
+hostnames in the background while still serving them (stale-while-revalidate).
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from privex.helpers import CacheAdapter, DictObject, T
+
+from myip import metrics, settings
+from myip.cache import CacheLock, LRUStore, get_many
+from myip.codec import decode_rdns, encode_rdns
+
+log = logging.getLogger(__name__)
+
+NEGATIVE = ''
+"""The value stored in the cache for addresses which failed to resolve (a negative cache entry)"""
+
+_NO_WAIT: ContextVar[bool] = ContextVar('myip_rdns_no_wait', default=False)
+
+
+class RDNSNotFound(socket.herror):
+    """Raised by :meth:`.RDNSResolver.resolve` with ``fail=True`` when an address doesn't have a (resolvable) PTR record"""
+
+
+def gethostbyaddr(ip: str) -> str:
+    """The default resolve function used by :class:`.RDNSResolver` - returns the PTR hostname for ``ip``"""
+    return str(socket.gethostbyaddr(ip)[0])
+
+
+class RDNSResolver:
+    """
+    Resolves the reverse DNS hostname for IP addresses using a bounded thread pool, so a slow PTR zone can only ever
+    block a request for ``timeout`` seconds, rather than for however long the system resolver takes.
+
+    Results are cached under ``myip:rdns:<ip>`` - successful lookups for ``cache_time`` seconds, and failed lookups
+    for ``negative_cache_time`` seconds. Concurrent lookups for the same address share a single in-flight lookup,
+    and with ``lock_time`` set (``settings.CACHE_LOCK_SEC``), so do lookups in other worker processes (see
+    :class:`myip.cache.CacheLock`).
+
+    Successful lookups are cached as ``(hostname, fresh_until)`` (packed by :func:`myip.codec.encode_rdns`), and kept
+    for ``stale_time`` more seconds after ``cache_time`` - a hostname which is past ``fresh_until`` is still returned
+    straight away, while a single background lookup refreshes it, so popular addresses never all expire and wait on
+    DNS at once.
+
+    A lookup which misses it's deadline keeps running in the background, and it's result is cached once it finishes,
+    so the next request for that address gets the hostname straight from the cache. Passing ``wait=False`` to
+    :meth:`.resolve` uses that behaviour directly - returning the cached hostname (or ``fallback``) immediately,
+    and filling in the cache in the background.
+
+    The function used to resolve addresses can be swapped out, e.g. to use a local stub resolver::
+
+        >>> from privex.helpers.cache import MemoryCache
+        >>> stub = {'185.130.44.1': 'ns1.privex.io'}
+        >>> def resolve_stub(ip):
+        ...     return stub[ip]      # Any exception means the address couldn't be resolved
+        >>> r = RDNSResolver(resolve_func=resolve_stub, cache=MemoryCache())
+        >>> r.resolve('185.130.44.1')
+        'ns1.privex.io'
+        >>> r.resolve('10.1.2.3', fallback='unknown')
+        'unknown'
+
+    """
+    def __init__(
+        self, resolve_func: Callable[[str], str] = gethostbyaddr, cache: Union[CacheAdapter, Callable[[], CacheAdapter]] = None,
+        max_workers: int = None, timeout: float = None, cache_time: int = None, negative_cache_time: int = None,
+        max_pending: int = None, stale_time: int = None, lock_time: float = None
+    ):
+        self.resolve_func = resolve_func
+        self._cache = cache
+        self.max_workers = settings.RDNS_WORKERS if max_workers is None else max_workers
+        self.timeout = settings.RDNS_TIMEOUT if timeout is None else timeout
+        self.cache_time = settings.RDNS_CACHE_SEC if cache_time is None else cache_time
+        self.negative_cache_time = settings.RDNS_NEGATIVE_CACHE_SEC if negative_cache_time is None else negative_cache_time
+        self.max_pending = settings.RDNS_MAX_PENDING if max_pending is None else max_pending
+        self.stale_time = settings.RDNS_STALE_SEC if stale_time is None else stale_time
+        self.lock = CacheLock(lambda: self.cache, ttl=lock_time)
+        # Addresses refreshed recently - a worker's L1 cache can keep returning the stale entry for a while after it's refreshed
+        self._refreshed = LRUStore(max_size=10000, ttl=settings.L1_CACHE_TTL + 1)
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.RLock()
+        self.lookups, self.cache_hits, self.negative_hits, self.failures, self.timeouts, self.dropped = 0, 0, 0, 0, 0, 0
+        self.stale_hits, self.lock_waits = 0, 0
+
+    @property
+    def cache(self) -> CacheAdapter:
+        if self._cache is None:
+            from myip.core import get_cache
+            return get_cache()
+        return self._cache() if callable(self._cache) else self._cache
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='myip-rdns')
+        return self._pool
+
+    @staticmethod
+    @contextmanager
+    def no_wait():
+        """
+        Within this context (the current thread / asyncio task), :meth:`.resolve` and :meth:`.resolve_many` never wait
+        for a lookup, as if called with ``wait=False`` / ``timeout=0`` - used by :mod:`myip.aioapp`, which waits for
+        lookups on the event loop before running the (synchronous) Flask views.
+        """
+        token = _NO_WAIT.set(True)
+        try:
+            yield
+        finally:
+            _NO_WAIT.reset(token)
+
+    @staticmethod
+    def cache_key(ip: str) -> str:
+        return f"myip:rdns:{ip}"
+
+    def _wait_for_lock(self, ip: str) -> Optional[str]:
+        """Another worker holds the lock for ``ip`` - wait (up to the lock's TTL) for it to cache a fresh result"""
+        self.lock_waits += 1
+        deadline = time.monotonic() + self.lock.ttl
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            host, stale = self.cached(ip)
+            if host is not None and not stale:
+                return host
+        return None
+
+    def _lookup(self, ip: str, refresh=False) -> str:
+        """
+        Runs inside the thread pool - resolves ``ip`` and caches the result (or a negative entry if it failed).
+        If another worker is already resolving ``ip``, waits for it's result instead - or with ``refresh=True``
+        (refreshing a stale entry), just leaves it to them.
+        """
+        key = self.cache_key(ip)
+        token = self.lock.acquire(key)
+        if token is None:
+            host = self.get_cached(ip) if refresh else self._wait_for_lock(ip)
+            if host is not None:
+                return host
+        self.lookups += 1
+        started = time.monotonic()
+        try:
+            host = str(self.resolve_func(ip))
+        except Exception as e:
+            log.info('Could not resolve IP %s due to exception %s %s (took %.3fs)', ip, type(e), str(e), time.monotonic() - started)
+            self.failures += 1
+            host = NEGATIVE
+        metrics.rdns_lookup(host != NEGATIVE)
+        try:
+            if host == NEGATIVE:
+                self.cache.set(key, encode_rdns(NEGATIVE), self.negative_cache_time)
+            else:
+                self.cache.set(key, encode_rdns(host, time.time() + self.cache_time), self.cache_time + self.stale_time)
+        except Exception:
+            log.exception('Failed to cache rDNS result for IP %s', ip)
+        finally:
+            if token is not None: self.lock.release(key, token)
+        return host
+
+    def _done(self, ip: str, fut: Future):
+        with self._lock:
+            if self._inflight.get(ip) is fut:
+                del self._inflight[ip]
+
+    def submit(self, ip: str, refresh=False) -> Optional[Future]:
+        """
+        Start resolving ``ip`` in the background (or join the lookup already in flight for it), returning it's
+        :class:`concurrent.futures.Future` - or ``None`` if there are already ``max_pending`` lookups in flight.
+        Pass ``refresh=True`` when refreshing a stale entry (see :meth:`._lookup`).
+        """
+        ip = str(ip)
+        with self._lock:
+            fut = self._inflight.get(ip)
+            if fut is not None:
+                return fut
+            if len(self._inflight) >= self.max_pending:
+                self.dropped += 1
+                log.warning('Not resolving IP %s - there are already %d rDNS lookups in flight', ip, len(self._inflight))
+                return None
+            fut = self._inflight[ip] = self.pool.submit(self._lookup, ip, refresh)
+        fut.add_done_callback(lambda f: self._done(ip, f))
+        return fut
+
+    def cached(self, ip: str) -> Tuple[Optional[str], bool]:
+        """
+        Returns ``(hostname, stale)`` for ``ip`` from the cache - the hostname is :attr:`.NEGATIVE` if it's cached as
+        a failure, or ``None`` if it isn't cached, and ``stale`` is ``True`` if it's past it's ``fresh_until`` time.
+        """
+        host, fresh_until = decode_rdns(metrics.cache_get(self.cache, self.cache_key(ip)))
+        # Negative entries (and entries cached before stale-while-revalidate) have no fresh_until - they're always fresh
+        return host, fresh_until is not None and time.time() >= fresh_until
+
+    def cached_many(self, ips: Iterable[str]) -> Dict[str, Tuple[Optional[str], bool]]:
+        """Bulk version of :meth:`.cached` - every address's cache entry is fetched in one go (see :func:`myip.cache.get_many`)"""
+        ips = list(dict.fromkeys(str(x) for x in ips))
+        vals = metrics.cache_get_many(self.cache, [self.cache_key(ip) for ip in ips], fetch=get_many)
+        res, now = {}, time.time()
+        for ip in ips:
+            host, fresh_until = decode_rdns(vals[self.cache_key(ip)])
+            res[ip] = host, fresh_until is not None and now >= fresh_until
+        return res
+
+    def get_cached(self, ip: str) -> Optional[str]:
+        """Returns the cached hostname for ``ip`` - :attr:`.NEGATIVE` if it's cached as a failure, or ``None`` if it isn't cached"""
+        return self.cached(ip)[0]
+
+    def _cache_hit(self, ip: str, host: str, stale: bool):
+        self.cache_hits += 1
+        if host == NEGATIVE: self.negative_hits += 1
+        if stale:
+            self.stale_hits += 1
+            self.refresh(ip)
+
+    def refresh(self, ip: str):
+        """Refresh the stale cached hostname for ``ip`` in the background, unless it was already refreshed recently"""
+        if self._refreshed.get(ip) is None:
+            self._refreshed.set(ip, True)
+            self.submit(ip, refresh=True)
+
+    def _result(self, ip: str, host: Optional[str], fallback: T, fail: bool) -> Union[str, T]:
+        if host is None or host == NEGATIVE:
+            if fail: raise RDNSNotFound(f"Could not resolve reverse DNS for IP address '{ip}'")
+            return fallback
+        return host
+
+    def resolve(self, ip: Any, fallback: T = "", fail=False, timeout: float = None, wait=True) -> Union[str, T]:
+        """
+        Return the reverse DNS hostname for ``ip`` - or ``fallback`` if it couldn't be resolved within ``timeout`` seconds
+        (default: :attr:`.timeout`). With ``fail=True``, :class:`.RDNSNotFound` is raised instead of returning ``fallback``.
+
+        With ``wait=False``, never blocks on a lookup - returns the cached hostname if there is one, otherwise starts
+        resolving ``ip`` in the background (so it's cached for later requests) and returns ``fallback`` immediately.
+        """
+        ip = str(ip)
+        host, stale = self.cached(ip)
+        if host is not None:
+            self._cache_hit(ip, host, stale)
+            return self._result(ip, host, fallback, fail)
+        fut = self.submit(ip)
+        if fut is None or not wait or _NO_WAIT.get():
+            return self._result(ip, None, fallback, fail)
+        started = time.perf_counter()
+        try:
+            host = fut.result(timeout=self.timeout if timeout is None else timeout)
+        except FutureTimeout:
+            self.timeouts += 1
+            metrics.rdns_timeout()
+            log.info('Timed out waiting for reverse DNS of IP %s - leaving the lookup running in the background', ip)
+            host = None
+        metrics.observe('rdns', started)
+        return self._result(ip, host, fallback, fail)
+
+    def prefetch(self, ips: Iterable[Any]) -> List[Future]:
+        """
+        Start resolving (in the background) each address in ``ips`` which isn't already cached, so a later :meth:`.resolve`
+        / :meth:`.resolve_many` call for them only has to wait for whatever time is left. Returns the futures of the
+        lookups which were started (or joined) - stale entries are refreshed too, but aren't waited for.
+        """
+        futs = []
+        for ip, (host, stale) in self.cached_many(ips).items():
+            if host is None:
+                fut = self.submit(ip)
+                if fut is not None: futs.append(fut)
+            elif stale:
+                self.refresh(ip)
+        return futs
+
+    def resolve_many(self, ips: Iterable[Any], fallback: T = "", timeout: float = None) -> Dict[str, Union[str, T]]:
+        """
+        Resolve multiple addresses concurrently, returning a dict mapping each address to it's hostname (or ``fallback``).
+
+        All lookups share a single deadline of ``timeout`` seconds (default: :attr:`.timeout`), so a batch takes at most
+        ``timeout`` seconds no matter how many addresses it contains. The cached hostnames are read in one go
+        (see :meth:`.cached_many`).
+        """
+        res, futs = {}, {}
+        for ip, (host, stale) in self.cached_many(ips).items():
+            if host is not None:
+                self._cache_hit(ip, host, stale)
+                res[ip] = self._result(ip, host, fallback, False)
+                continue
+            futs[ip] = self.submit(ip)
+        deadline = time.monotonic() + (0.0 if _NO_WAIT.get() else self.timeout if timeout is None else timeout)
+        started, timeouts = time.perf_counter(), 0
+        for ip, fut in futs.items():
+            host = None
+            if fut is not None:
+                try:
+                    host = fut.result(timeout=max(0.0, deadline - time.monotonic()))
+                except FutureTimeout:
+                    timeouts += 1
+            res[ip] = self._result(ip, host, fallback, False)
+        if len(futs) > 0:
+            self.timeouts += timeouts
+            metrics.rdns_timeout(timeouts)
+            metrics.observe('rdns', started)
+        return res
+
+    def stats(self) -> DictObject:
+        return DictObject(
+            lookups=self.lookups, cache_hits=self.cache_hits, negative_hits=self.negative_hits, failures=self.failures,
+            timeouts=self.timeouts, dropped=self.dropped, inflight=len(self._inflight), workers=self.max_workers,
+            stale_hits=self.stale_hits, lock_waits=self.lock_waits,
+        )
+
+    def close(self, wait=False):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+            self._pool = None
@@ -0,0 +1,313 @@
+"""
+Reverse indexes from an ASN / country to the networks which the GeoIP2 databases place in it - the data behind
+``/asn/<number>`` and ``/country/<code>``.
+
+An index is built by walking every network in the ASN (or City) database's search tree once (see
+:class:`myip.mmdbtree.SearchTree`), and is written to ``settings.REVERSE_INDEX_DIR`` as a compact binary file, named
+after the database build epoch (e.g. ``asn-1615420800.idx``). The file is memory-mapped rather than loaded, so every
+gunicorn worker shares the same page cache, and looking up a key is a binary search over the file's directory.
+
+File layout (little-endian)::
+
+    header      magic (8s) | db build epoch (Q) | keys (I) | networks (I) | build seconds (d) | built at (d) | build RSS KB (Q)
+    directory   one entry per key, sorted by key: key (I) | first record (I) | IPv4 records (I) | IPv6 records (I)
+    records     prefix length (B) | network address (16s, big-endian) - each key's IPv4 networks, then it's IPv6 networks
+
+When the database is updated, :class:`.ReverseIndexes` builds the index for the new build epoch in a background thread
+(only one worker process builds it - the others wait for the file to appear), while the previous index carries on being
+served. Indexes can also be built ahead of time with ``python -m myip build-index``.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import fcntl
+import logging
+import mmap
+import os
+import resource
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from ipaddress import IPv4Network, IPv6Network
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple, Union
+
+from privex.helpers import DictObject
+
+from myip import metrics, settings
+from myip.geodb import GeoIPRegistry
+from myip.mmdbtree import SearchTree
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'MYIPRIX1'
+HEADER = struct.Struct('<8sQIIddQ')
+DIRENT = struct.Struct('<IIII')
+RECORD_SIZE = 17
+
+
+def _asn_key(rec: Any) -> Optional[int]:
+    return rec.get('autonomous_system_number') if isinstance(rec, dict) else None
+
+
+def _country_key(rec: Any) -> Optional[int]:
+    code = rec.get('country', {}).get('iso_code') if isinstance(rec, dict) else None
+    return country_key(code) if code else None
+
+
+def country_key(code: str) -> int:
+    """Converts a country code (e.g. ``SE``) into it's index key"""
+    code = str(code).strip().upper().encode('ascii')
+    if not 0 < len(code) <= 4:
+        raise ValueError(f"Invalid country code: {code!r}")
+    return int.from_bytes(code, 'big')
+
+
+@dataclass(frozen=True)
+class IndexKind:
+    """A type of reverse index - the GeoIP2 database it's built from, and the function which returns a record's key"""
+    name: str
+    database: str
+    key_func: Callable[[Any], Optional[int]]
+
+
+INDEX_KINDS = {
+    'asn': IndexKind('asn', 'asn', _asn_key),
+    'country': IndexKind('country', 'city', _country_key),
+}
+
+
+class IndexBuilding(Exception):
+    """Raised when an index is needed, but it's still being built for the first time"""
+
+
+def index_path(index_dir: Union[str, Path], kind: str, build_epoch: int) -> Path:
+    return Path(index_dir) / f"{kind}-{build_epoch}.idx"
+
+
+def build_index(kind: str, db_path: Union[str, Path], index_dir: Union[str, Path] = None) -> Path:
+    """
+    Build the ``kind`` (``asn`` / ``country``) index from the database at ``db_path`` - returns the path to the index,
+    which is written to a temporary file first, then renamed into place.
+    """
+    spec = INDEX_KINDS[kind]
+    index_dir = Path(settings.REVERSE_INDEX_DIR if index_dir is None else index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    started, rss_before = time.monotonic(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tree = SearchTree(db_path)
+    keys: Dict[int, Optional[int]] = {}
+    v4: Dict[int, bytearray] = {}
+    v6: Dict[int, bytearray] = {}
+    try:
+        for version, addr, plen, pointer in tree.walk_raw():
+            key = keys.get(pointer, -1)
+            if key == -1:
+                key = keys[pointer] = spec.key_func(tree.record(pointer))
+            if key is None:
+                continue
+            recs = (v4 if version == 4 else v6).get(key)
+            if recs is None:
+                recs = (v4 if version == 4 else v6)[key] = bytearray()
+            recs.append(plen)
+            recs += addr.to_bytes(16, 'big')
+    finally:
+        tree.close()
+
+    all_keys = sorted(set(v4.keys()) | set(v6.keys()))
+    directory, total = bytearray(), 0
+    for key in all_keys:
+        n4, n6 = len(v4.get(key, b'')) // RECORD_SIZE, len(v6.get(key, b'')) // RECORD_SIZE
+        directory += DIRENT.pack(key, total, n4, n6)
+        total += n4 + n6
+    build_secs = time.monotonic() - started
+    rss_kb = max(0, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before)
+
+    path = index_path(index_dir, kind, tree.build_epoch)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as fh:
+        fh.write(HEADER.pack(MAGIC, tree.build_epoch, len(all_keys), total, build_secs, time.time(), rss_kb))
+        fh.write(directory)
+        for key in all_keys:
+            fh.write(v4.get(key, b''))
+            fh.write(v6.get(key, b''))
+    os.replace(tmp_path, path)
+    log.info(
+        "Built %s reverse index %s in %.2f seconds - %d networks, %d keys, %d bytes (peak RSS +%d KB)",
+        kind, path, build_secs, total, len(all_keys), path.stat().st_size, rss_kb
+    )
+    return path
+
+
+class ReverseIndex:
+    """A memory-mapped reverse index file - see :meth:`.networks`"""
+    def __init__(self, kind: str, path: Union[str, Path]):
+        self.kind, self.path = kind, Path(path)
+        with open(self.path, 'rb') as fh:
+            self._buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.build_epoch, self.key_count, self.network_count, self.build_secs, self.built_at, self.build_rss_kb = \
+            HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a reverse index file")
+        self.size = len(self._buf)
+        self._records_at = HEADER.size + DIRENT.size * self.key_count
+
+    def entry(self, key: int) -> Tuple[int, int, int]:
+        """Returns ``(first record, IPv4 count, IPv6 count)`` for ``key`` - ``(0, 0, 0)`` if it has no networks"""
+        lo, hi = 0, self.key_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mkey, start, n4, n6 = DIRENT.unpack_from(self._buf, HEADER.size + mid * DIRENT.size)
+            if mkey == key:
+                return start, n4, n6
+            if mkey < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return 0, 0, 0
+
+    def count(self, key: int, version: int = None) -> int:
+        start, n4, n6 = self.entry(key)
+        return n4 if version == 4 else (n6 if version == 6 else n4 + n6)
+
+    def networks(
+        self, key: int, version: int = None, offset: int = 0, limit: int = None
+    ) -> Tuple[int, Iterator[Union[IPv4Network, IPv6Network]]]:
+        """
+        Returns ``(total, networks)`` - the amount of networks for ``key`` (only IPv4 / IPv6 ones if ``version`` is set),
+        and an iterator over them (IPv4 first, then in address order), starting at ``offset``, up to ``limit`` networks.
+        """
+        start, n4, n6 = self.entry(key)
+        if version == 4:
+            first, total = start, n4
+        elif version == 6:
+            first, total = start + n4, n6
+        else:
+            first, total = start, n4 + n6
+        offset = min(max(0, offset), total)
+        end = total if limit is None else min(total, offset + max(0, limit))
+        return total, self._iter(first + offset, first + end, start + n4)
+
+    def _iter(self, first: int, end: int, v6_from: int) -> Iterator[Union[IPv4Network, IPv6Network]]:
+        buf, base = self._buf, self._records_at
+        for i in range(first, end):
+            o = base + i * RECORD_SIZE
+            addr = int.from_bytes(buf[o + 1:o + RECORD_SIZE], 'big')
+            yield IPv4Network((addr, buf[o])) if i < v6_from else IPv6Network((addr, buf[o]))
+
+    def info(self) -> DictObject:
+        return DictObject(
+            path=str(self.path), build_epoch=self.build_epoch, keys=self.key_count, networks=self.network_count,
+            size=self.size, build_secs=self.build_secs, built_at=self.built_at, build_rss_kb=self.build_rss_kb
+        )
+
+    def close(self):
+        self._buf.close()
+
+
+class ReverseIndexes:
+    """
+    Holds the open :class:`.ReverseIndex` of each kind, making sure it matches the build epoch of the database
+    currently loaded by ``registry`` - see :meth:`.get`.
+    """
+    def __init__(self, registry: GeoIPRegistry, index_dir: Union[str, Path] = None, autobuild: bool = None):
+        self.registry = registry
+        self.index_dir = Path(settings.REVERSE_INDEX_DIR if index_dir is None else index_dir)
+        self.autobuild = settings.REVERSE_INDEX_AUTOBUILD if autobuild is None else autobuild
+        self._indexes: Dict[str, ReverseIndex] = {}
+        self._building: Dict[str, threading.Thread] = {}
+        self._failed: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, kind: str) -> ReverseIndex:
+        """
+        Returns the ``kind`` index for the currently loaded database. If the database has been updated and the new
+        index isn't ready yet, the previous index is returned while the new one is built in the background - if there's
+        no previous index, :class:`.IndexBuilding` is raised.
+        """
+        spec = INDEX_KINDS[kind]
+        epoch = self.registry.build_epoch(spec.database)
+        cur = self._indexes.get(kind)
+        if cur is not None and cur.build_epoch == epoch:
+            return cur
+        with self._lock:
+            cur = self._indexes.get(kind)
+            if cur is not None and cur.build_epoch == epoch:
+                return cur
+            path = index_path(self.index_dir, kind, epoch)
+            if path.exists():
+                self._indexes[kind] = new = ReverseIndex(kind, path)
+                metrics.index_loaded(kind, new.build_secs, new.network_count, new.size)
+                log.info("Loaded %s reverse index %s (%d networks)", kind, path, new.network_count)
+                return new
+            if self.autobuild:
+                self._start_build(kind, spec, epoch)
+        if cur is None:
+            raise IndexBuilding(f"The {kind} index is being built - please try again shortly")
+        return cur
+
+    def _start_build(self, kind: str, spec: IndexKind, epoch: int):
+        thread = self._building.get(kind)
+        # Don't keep re-trying a database which already failed to index, until it's updated again
+        if (thread is not None and thread.is_alive()) or self._failed.get(kind) == epoch:
+            return
+        db_path = self.registry.find(spec.database)
+        self._building[kind] = thread = threading.Thread(
+            target=self._build, args=(kind, db_path, epoch), name=f"myip-revindex-{kind}", daemon=True
+        )
+        thread.start()
+
+    def _build(self, kind: str, db_path: Path, epoch: int):
+        try:
+            self.index_dir.mkdir(parents=True, exist_ok=True)
+            with open(self.index_dir / f"{kind}.lock", 'w') as lock_fh:
+                # Only one worker process builds each index at once - the others wait here, then find the file already exists
+                fcntl.flock(lock_fh, fcntl.LOCK_EX)
+                if index_path(self.index_dir, kind, epoch).exists():
+                    return
+                path = build_index(kind, db_path, self.index_dir)
+                self.prune(kind, keep=path)
+        except Exception:
+            log.exception("Failed to build the %s reverse index from %s", kind, db_path)
+            self._failed[kind] = epoch
+
+    def prune(self, kind: str, keep: Path):
+        """Delete the ``kind`` index files other than ``keep`` (workers which still have them mapped can carry on using them)"""
+        for p in self.index_dir.glob(f"{kind}-*.idx"):
+            if p != keep:
+                try:
+                    p.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def build(self, *kinds: str, force=False) -> Dict[str, Path]:
+        """
+        Build the indexes ``kinds`` (default: all of them) for the current databases right away, unless they already exist.
+        Returns a dict mapping each kind to the path of it's index.
+        """
+        paths = {}
+        for kind in (kinds if len(kinds) > 0 else INDEX_KINDS.keys()):
+            spec = INDEX_KINDS[kind]
+            path = index_path(self.index_dir, kind, self.registry.build_epoch(spec.database))
+            if force or not path.exists():
+                path = build_index(kind, self.registry.find(spec.database), self.index_dir)
+                self.prune(kind, keep=path)
+            paths[kind] = path
+        return paths
+
+    def info(self) -> DictObject:
+        return DictObject({k: idx.info() for k, idx in list(self._indexes.items())})
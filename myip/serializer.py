@@ -0,0 +1,207 @@
+"""
+Serializer which converts GeoIP results, :mod:`geoip2` models, IP address objects etc. into "safe" primitive types
+(``str`` / ``int`` / ``float`` / ``bool`` / ``None``, :class:`.DictObject`, ``list`` / ``tuple`` / ``set``),
+ready to be dumped as JSON / YAML.
+
+The handler used for each type (a converter from :attr:`.CONVERTERS`, a dict / iterable walker, or the generic
+fallback) is looked up once per type and cached, instead of scanning every converter with ``isinstance``
+for every value.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import inspect
+import logging
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
+from typing import Any, Callable, Dict, Optional, Tuple, Type
+
+import geoip2.models
+from privex.helpers import DictObject, stringify
+from privex.helpers.geoip import GeoIPResult
+
+from myip.core import GeoType
+
+log = logging.getLogger(__name__)
+
+SAFE_TYPES = (str, int, float)
+"""Types which are returned as-is (``bool`` is a subclass of ``int``)"""
+ITER_TYPES = (list, tuple, set)
+"""Iterable types which have their contents converted, and are then re-built using their original type"""
+
+CONVERTERS: Dict[type, Callable[[Any], Any]] = {
+    bytes: stringify,
+    GeoIPResult: DictObject,
+    geoip2.models.ASN: lambda a: DictObject(a.raw),
+    geoip2.models.City: lambda a: DictObject(a.raw),
+    geoip2.models.Country: lambda a: DictObject(a.raw),
+    GeoType: lambda a: a.value,
+    IPv4Address: str, IPv6Address: str, IPv4Network: str, IPv6Network: str,
+}
+"""
+Maps types to a function which converts them into a safe type (or a dict / iterable, which is then walked).
+If a converter raises an exception or returns ``None``, the next matching converter is tried. Add converters
+using :func:`.register_converter`, so the per-type handler cache is reset.
+"""
+
+Handler = Callable[[Any, '_Walk'], Any]
+
+_HANDLERS: Dict[type, Handler] = {}
+_PLAIN_HANDLERS: Dict[type, Handler] = {}
+
+
+class _Walk:
+    """
+    State for a single :func:`.to_safe` call - ``raw`` is set when the generic fallback returns a dict which
+    hasn't had it's contents converted (matching the original ``_safe_dict`` behaviour, those get converted by
+    a second pass - which is skipped when nothing raw was produced, as it would be a no-op).
+    """
+    __slots__ = ('raw',)
+
+    def __init__(self):
+        self.raw = False
+
+
+def register_converter(obj_type: type, func: Callable[[Any], Any]):
+    """Register (or replace) the converter ``func`` for ``obj_type`` (and it's subclasses)"""
+    CONVERTERS[obj_type] = func
+    _HANDLERS.clear()
+
+
+def class_dict(d: Any, fallback=None, no_private=True, no_protected=True, no_funcs=True) -> Optional[dict]:
+    """Returns the attributes of the object ``d`` as a dict, skipping ``_protected`` attributes and methods by default"""
+    xdt = getattr(d, '__dict__', None)
+
+    def _chk_func(f):
+        if not no_funcs: return False
+        return inspect.ismethod(f) or inspect.isfunction(f)
+
+    if xdt is None: return fallback
+    if no_protected:
+        return {k: v for k, v in dict(xdt).items() if not k.startswith('_') and not _chk_func(v)}
+    if no_private:
+        return {k: v for k, v in dict(xdt).items() if not k.startswith('__') and not _chk_func(v)}
+    return {k: v for k, v in dict(xdt).items() if not _chk_func(v)}
+
+
+def _identity(d: Any, walk: _Walk) -> Any:
+    return d
+
+
+def _walk_dict(d: dict, walk: _Walk) -> DictObject:
+    return DictObject({k: _clean(v, walk) for k, v in d.items()})
+
+
+def _walk_list(d: list, walk: _Walk) -> list:
+    return [_clean(v, walk) for v in d]
+
+
+def _walk_iter(d: Any, walk: _Walk) -> Any:
+    # Note: iterable subclasses are re-built by passing the converted contents to their constructor as a single list
+    return d.__class__([_clean(v, walk) for v in d])
+
+
+def _fallback(d: Any, walk: _Walk) -> Any:
+    """Convert an unknown object using ``dict(d)``, then it's public attributes, then finally ``str(d)``"""
+    try:
+        res = dict(d)
+    except Exception:
+        try:
+            res = class_dict(d)
+        except Exception:
+            return str(d)
+    if res is not None: walk.raw = True
+    return res
+
+
+def _plain_handler(t: type) -> Handler:
+    """The handler for ``t``, ignoring any converters - used for objects which have already been converted"""
+    h = _PLAIN_HANDLERS.get(t)
+    if h is None:
+        if issubclass(t, SAFE_TYPES): h = _identity
+        elif issubclass(t, dict): h = _walk_dict
+        elif t is list: h = _walk_list
+        elif issubclass(t, ITER_TYPES): h = _walk_iter
+        elif t is type(None): h = _identity
+        else: h = _fallback
+        _PLAIN_HANDLERS[t] = h
+    return h
+
+
+def _converter_handler(convs: Tuple[Tuple[type, Callable], ...]) -> Handler:
+    def _convert(d: Any, walk: _Walk) -> Any:
+        for k, func in convs:
+            try:
+                res = func(d)
+            except Exception as e:
+                log.warning("Exception while converting %r - converter function (key: %r): %r - Exception was: %s - %s",
+                            d, k, func, type(e), e)
+                continue
+            if res is None: continue
+            if isinstance(res, SAFE_TYPES): return res
+            d = res
+            break
+        return _plain_handler(type(d))(d, walk)
+    return _convert
+
+
+def _get_handler(t: Type) -> Handler:
+    h = _HANDLERS.get(t)
+    if h is None:
+        convs = tuple((k, f) for k, f in CONVERTERS.items() if issubclass(t, k))
+        h = _converter_handler(convs) if len(convs) > 0 else _plain_handler(t)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Serializer handler for type %r: %r (converters: %r)", t, h, convs)
+        _HANDLERS[t] = h
+    return h
+
+
+def _clean(d: Any, walk: _Walk) -> Any:
+    return _get_handler(type(d))(d, walk)
+
+
+def _safe_mapping(d: dict) -> DictObject:
+    walk, safex = _Walk(), {}
+    for k, v in d.items():
+        walk.raw = False
+        sv = _clean(v, walk)
+        if walk.raw and isinstance(sv, dict) and not isinstance(v, dict):
+            sv = to_safe(sv)
+        safex[k] = sv
+    return DictObject(safex)
+
+
+def to_safe(d: Any) -> Any:
+    """
+    Convert ``d`` (and it's contents, recursively) into safe types that can be dumped as JSON / YAML.
+
+    Dicts (and objects which are converted into dicts) are returned as a :class:`.DictObject`, while
+    ``list`` / ``tuple`` / ``set`` keep their type.
+
+        >>> to_safe(dict(ip=IPv4Address('185.130.44.1'), kind=GeoType.ASN, hosts=(b'a', 'b')))
+        {'ip': '185.130.44.1', 'kind': 'asn', 'hosts': ('a', 'b')}
+
+    """
+    if isinstance(d, dict):
+        return _safe_mapping(d)
+    if isinstance(d, ITER_TYPES):
+        walk = _Walk()
+        return type(d)([_clean(v, walk) for v in d])
+    walk = _Walk()
+    res = _clean(d, walk)
+    if walk.raw and isinstance(res, (dict,) + ITER_TYPES):
+        return to_safe(res)
+    return res
@@ -46,6 +46,7 @@ cf = DictObject()
 APP_DIR = Path(__file__).parent.expanduser().resolve()
 TEMPLATES_DIR = APP_DIR / 'templates'
 BASE_DIR = APP_DIR.parent
+STATIC_DIR = BASE_DIR / 'static'
 
 #######################################
 #
@@ -73,7 +74,64 @@ testing the app when running it locally during development.
 FAKE_V4 = empty_if(env('FAKE_V4', '185.130.44.140' if USE_FAKE_IPS else ''), None)
 FAKE_V6 = empty_if(env('FAKE_V6', '2a07:e01:123::456' if USE_FAKE_IPS else ''), None)
 
-MAX_ADDRESSES = env_int('MAX_ADDRESSES', 20)
+MAX_ADDRESSES = env_int('MAX_ADDRESSES', 1000)
+"""The maximum amount of addresses which can be looked up in a single batch request to ``/lookup``"""
+
+LOOKUP_STREAM_BATCH = env_int('LOOKUP_STREAM_BATCH', 10)
+"""
+Batch ``/lookup`` requests using a streaming format (``ndjson`` / ``csv``) look up this many addresses at a time,
+sending each batch's results before looking up the next batch
+"""
+
+CIDR_MAX_NETWORKS = env_int('CIDR_MAX_NETWORKS', 10000)
+"""
+Maximum amount of GeoIP networks returned by a CIDR range ``/lookup`` (e.g. ``/lookup/185.130.44.0/22``) - JSON / YAML
+responses say ``truncated: true`` when the range contains more, while streamed formats just end after this many
+"""
+
+PAGE_CACHE = env_bool('PAGE_CACHE', True)
+"""
+Cache the rendered ``/api`` docs page (plus a gzip-compressed copy), and the static parts of the index page, per host
+- see :mod:`myip.pages`
+"""
+
+PAGE_CACHE_SIZE = env_int('PAGE_CACHE_SIZE', 64)
+"""The maximum number of host variants (``Host`` header + v4 / v6 hosts) to cache rendered pages for"""
+
+PAGE_GZIP_LEVEL = env_int('PAGE_GZIP_LEVEL', 9)
+"""gzip compression level (1-9) for the pre-compressed ``/api`` docs page, or ``0`` to only serve it uncompressed"""
+
+ASSETS_DIR = Path(env('ASSETS_DIR', 'static/dist')).expanduser()
+ASSETS_DIR = BASE_DIR / str(ASSETS_DIR) if not ASSETS_DIR.is_absolute() else ASSETS_DIR.resolve()
+"""
+Folder which ``python -m myip build-assets`` writes the built static assets into (the flag sprite + CSS, and
+fingerprinted / pre-compressed copies of ``app.js``) - see :mod:`myip.assets`
+"""
+
+ASSETS_URL = env('ASSETS_URL', '/static/dist').rstrip('/')
+"""The URL path which the built assets in ``ASSETS_DIR`` are served from (by the app, or ideally by your webserver)"""
+
+ASSETS_MAX_AGE = env_int('ASSETS_MAX_AGE', YEAR)
+"""``Cache-Control`` max-age (seconds) of the built assets - they're fingerprinted, so they can be cached ``immutable``"""
+
+HTTP_CACHE = env_bool('HTTP_CACHE', True)
+"""
+Send ``ETag`` / ``Cache-Control`` / ``Vary`` headers on lookup responses, and answer ``If-None-Match`` requests with
+``304 Not Modified`` before doing any GeoIP / rDNS work - see :mod:`myip.httpcache`
+"""
+
+HTTP_CACHE_MAX_AGE = env_int('HTTP_CACHE_MAX_AGE', 1 * HOUR)
+"""
+``max-age`` for lookups of an explicitly requested address (e.g. ``/lookup/1.2.3.4``), which are sent as ``public``,
+so they can be cached by a CDN / proxy. Default is 1 hour (3600 seconds)
+"""
+
+HTTP_CACHE_CLIENT_MAX_AGE = env_int('HTTP_CACHE_CLIENT_MAX_AGE', 0)
+"""
+``max-age`` for responses about the client's own IP (``/``, ``/flat``, ``/lookup`` without an address), which are
+always sent as ``private``. The default of ``0`` sends ``no-cache``, so browsers revalidate them each time.
+"""
+
 
 MAIN_HOST = env('MAIN_HOST', 'myip.privex.io')
 
@@ -126,6 +184,10 @@ Choices:
   * redis / RedisCache / RedisAdapter = Redis cache - stores cached data in ``redis`` server, requires ``redis`` service
     to be installed and running either on this server, or a remote one specified using ``REDIS_HOST`` / ``REDIS_PORT`` env vars.
     
+  * shm / shared / sharedmemory / SharedMemoryCache = Shared memory cache - stores cached data in a memory-mapped file
+    (``SHM_CACHE_PATH``, under ``/dev/shm`` by default) which every worker process on the server shares, so they share
+    their cache hits without needing a separate cache server - see :mod:`myip.shmcache`.
+
   * sqlite / sqlite3 / sqlitedb = SQLite3 DB Cache - This is the only persistent cache which doesn't require a separate
     server daemon to be running alongside the app. However, it can have performance issues, as it's file-based design means
     only one thing (thread/app) can write to it at a time, while both reading/writing likely involves Python's GIL,
@@ -144,6 +206,76 @@ When true, automatically sets and initialises the cache adapter in core.py durin
 the cache adapter will be lazy-set/init, i.e. only setup once something calls :func:`myip.core.get_cache`
 """
 
+L1_CACHE_ENABLED = env_bool('L1_CACHE_ENABLED', True)
+"""
+When true, the shared cache adapter (Redis / Memcached) is wrapped in a :class:`myip.cache.LayeredCache`, which
+keeps a small in-process LRU cache (L1) in front of it - avoiding a network round-trip for frequently requested keys.
+
+The L1 cache is skipped when the cache adapter is already in-process (i.e. ``MemoryCache``).
+"""
+L1_CACHE_SIZE = env_int('L1_CACHE_SIZE', 10000)
+"""The maximum number of keys held in each worker's in-process L1 cache, before least-recently-used keys are evicted"""
+L1_CACHE_TTL = env_int('L1_CACHE_TTL', 30)
+"""
+The maximum amount of seconds a key is kept in the L1 cache. Keys are never kept in L1 for longer than their
+Redis/Memcached timeout. Keep this short, as writes by other workers aren't seen until a worker's L1 copy expires.
+"""
+
+CACHE_TIMEOUT = float(env('CACHE_TIMEOUT', 0.25))
+"""
+Socket connect / read timeout (seconds) for each Redis / Memcached operation - kept tight, so a stalled cache server
+can only hold up a request for this long before it's answered without the cache (see ``CACHE_BREAKER``). 0 = no timeout.
+"""
+
+CACHE_BREAKER = env_bool('CACHE_BREAKER', True)
+"""
+When true, the shared cache adapter (Redis / Memcached) is wrapped in a :class:`myip.cache.CircuitBreakerCache` - failed
+operations fall back to an in-process cache, and after ``CACHE_BREAKER_FAILURES`` failures in a row the backend is left
+alone (everything uses the in-process cache) while it's retried in the background every ``CACHE_BREAKER_RETRY`` seconds.
+"""
+CACHE_BREAKER_FAILURES = env_int('CACHE_BREAKER_FAILURES', 3)
+"""Consecutive failed cache operations which open the circuit breaker"""
+CACHE_BREAKER_RETRY = float(env('CACHE_BREAKER_RETRY', 5))
+"""Seconds between the background attempts to reach the cache backend while the circuit breaker is open"""
+CACHE_FALLBACK_SIZE = env_int('CACHE_FALLBACK_SIZE', 50000)
+"""The maximum number of keys held in each worker's in-process fallback cache, used while the circuit breaker is open"""
+
+SHM_CACHE_PATH = env('SHM_CACHE_PATH', '')
+"""
+The file used by the shared memory cache adapter (``CACHE_ADAPTER=shm``, see :mod:`myip.shmcache`) - every process
+using the same file shares the cache. Default: ``/dev/shm/myip-cache-<PORT>`` (or ``<LOG_DIR>/myip-cache-<PORT>.shm``
+where there's no ``/dev/shm``)
+"""
+SHM_CACHE_SLOTS = env_int('SHM_CACHE_SLOTS', 65536)
+"""The maximum number of keys held in the shared memory cache - once it's full, the least recently used keys are replaced"""
+SHM_CACHE_SLOT_SIZE = env_int('SHM_CACHE_SLOT_SIZE', 256)
+"""
+The bytes reserved for each key in the shared memory cache, including the key itself and it's pickled value - values
+which don't fit aren't cached. The cache file is ``SHM_CACHE_SLOTS x SHM_CACHE_SLOT_SIZE`` bytes (16 MB by default).
+"""
+
+CACHE_CODEC = env('CACHE_CODEC', 'binary').lower()
+"""
+How GeoIP data and Reverse DNS hostnames are encoded when they're cached - ``binary`` (default) packs them into
+the compact fixed-schema layout from :mod:`myip.codec`, while ``json`` keeps writing the older formats (JSON text /
+``(hostname, fresh_until)`` tuples). Both formats are always readable, but workers from before :mod:`myip.codec`
+can only read ``json`` - set ``CACHE_CODEC=json`` while rolling out an update across servers which share a cache.
+"""
+
+SINGLE_FLIGHT = env_bool('SINGLE_FLIGHT', True)
+"""
+Coalesce concurrent GeoIP lookups for the same (uncached) address within each worker, so only one of them queries the
+GeoIP2 databases while the others wait for it's result - see :class:`myip.cache.SingleFlight`. Concurrent Reverse DNS
+lookups for the same address are always coalesced.
+"""
+
+CACHE_LOCK_SEC = float(env('CACHE_LOCK_SEC', 0))
+"""
+When above zero and the cache is Redis, a worker about to run a Reverse DNS lookup first takes a Redis lock
+(``myip:lock:myip:rdns:<ip>``) for up to this many seconds, so only one worker across the whole deployment resolves
+each address at once - other workers serve the stale hostname, or wait for the result to appear in the cache.
+"""
+
 
 def _gen_hosts(*domains) -> list:
     domlist = []
@@ -181,16 +313,133 @@ pvx_settings.GEOASN = GEOIP_PATH / GEOASN_NAME
 pvx_settings.GEOCITY = GEOIP_PATH / GEOCITY_NAME
 pvx_settings.GEOCOUNTRY = GEOIP_PATH / GEOCOUNTRY_NAME
 
-cf['GEOIP_CACHE_SEC'] = GEOIP_CACHE_SEC = int(env('GEOIP_CACHE_SEC', 10 * MINUTE))
-"""Amount of seconds to cache GeoIP data in Redis for. Default is 600 seconds (10 minutes)"""
+GEOIP_MODE = env('GEOIP_MODE', 'auto').lower()
+"""
+How the GeoIP2 databases are opened: ``auto`` (default - memory-mapped, using the libmaxminddb C extension if it's
+installed), ``mmap_ext``, ``mmap``, ``file`` or ``memory``. The memory-mapped modes let every worker process share
+the same page cache, instead of each worker loading it's own copy of the databases.
+"""
+GEOIP_RELOAD_INTERVAL = float(env('GEOIP_RELOAD_INTERVAL', 30))
+"""
+How often (in seconds) each worker checks whether the GeoIP2 database files have been replaced (e.g. by
+``update_geoip.sh``), re-opening any that have been - without needing a restart. Set to ``0`` to disable.
+"""
+
+cf['GEOIP_CACHE_SEC'] = GEOIP_CACHE_SEC = int(env('GEOIP_CACHE_SEC', 2 * DAY))
+"""
+Amount of seconds to cache GeoIP data in Redis for. Default is 172800 seconds (2 days). Cache keys include the build
+epoch of the loaded GeoIP2 databases, so updating them makes the old entries unreachable straight away - this only
+limits how long entries for addresses which aren't looked up again take to be evicted.
+"""
+
+GEOIP_NET_CACHE = env_bool('GEOIP_NET_CACHE', True)
+"""
+Cache GeoIP results in-process against the GeoIP network they were returned for, so every address in that network
+(e.g. rotating IPv6 privacy addresses, or a scanner sweeping a /24) is answered from memory after one lookup.
+"""
+GEOIP_NET_CACHE_SIZE = env_int('GEOIP_NET_CACHE_SIZE', 100000)
+"""Maximum amount of networks held in each worker's GeoIP network cache, before the least recently used are evicted"""
+
+REVERSE_INDEX = env_bool('REVERSE_INDEX', True)
+"""Enable the ``/asn/<number>`` and ``/country/<code>`` endpoints, backed by reverse indexes - see :mod:`myip.revindex`"""
+REVERSE_INDEX_DIR = Path(env('REVERSE_INDEX_DIR', 'index')).expanduser()
+REVERSE_INDEX_DIR = BASE_DIR / str(REVERSE_INDEX_DIR) if not REVERSE_INDEX_DIR.is_absolute() else REVERSE_INDEX_DIR.resolve()
+"""The folder reverse index files are written to (shared by every worker) - relative to the myip app, or absolute"""
+REVERSE_INDEX_AUTOBUILD = env_bool('REVERSE_INDEX_AUTOBUILD', True)
+"""
+Build missing reverse indexes in the background when they're first needed (and whenever the GeoIP2 databases are
+updated). If disabled, build them with ``python -m myip build-index`` after each database update.
+"""
+REVERSE_INDEX_PAGE_SIZE = env_int('REVERSE_INDEX_PAGE_SIZE', 1000)
+"""Default amount of networks per page of ``/asn/<number>`` and ``/country/<code>`` JSON / YAML responses"""
+REVERSE_INDEX_MAX_PAGE_SIZE = env_int('REVERSE_INDEX_MAX_PAGE_SIZE', 10000)
+"""Maximum amount of networks per page which can be requested with ``?per_page=`` (text / ndjson / csv aren't paginated)"""
 
 cf['RDNS_CACHE_SEC'] = RDNS_CACHE_SEC = int(env('RDNS_CACHE_SEC', 1 * HOUR))
 """Amount of seconds to cache Reverse DNS (rDNS) lookup results. Default is 1 hour (3600 seconds)"""
 
+RDNS_STALE_SEC = env_int('RDNS_STALE_SEC', 1 * DAY)
+"""
+After a cached rDNS hostname is ``RDNS_CACHE_SEC`` old, it's still served for up to this many more seconds while it's
+refreshed in the background (stale-while-revalidate), so requests never wait on an expired hostname. ``0`` disables this.
+"""
+
+RDNS_NEGATIVE_CACHE_SEC = env_int('RDNS_NEGATIVE_CACHE_SEC', 5 * MINUTE)
+"""Amount of seconds to cache failed Reverse DNS lookups (addresses without a resolvable PTR record). Default is 5 minutes"""
+
+RDNS_TIMEOUT = float(env('RDNS_TIMEOUT', 2.0))
+"""
+The maximum amount of seconds a request will wait for a Reverse DNS lookup. Lookups which take longer than this
+carry on in the background, and their result is cached for later requests.
+"""
+
+RDNS_WORKERS = env_int('RDNS_WORKERS', 16)
+"""The number of threads (per worker process) used to run Reverse DNS lookups - see :class:`myip.rdns.RDNSResolver`"""
+
+RDNS_MAX_PENDING = env_int('RDNS_MAX_PENDING', 1000)
+"""The maximum number of Reverse DNS lookups which can be in flight at once. Any more are skipped (returning no hostname)"""
+
+RDNS_NOWAIT_FORMATS = env_csv('RDNS_NOWAIT_FORMATS', ['html'])
+"""
+Output formats which never wait for a Reverse DNS lookup - they use the cached hostname if there is one, otherwise
+the lookup is started in the background so that it's cached for later requests. The HTML page doesn't display
+the hostname, so by default only ``html`` is included.
+"""
+
+AIO_THREADS = env_int('AIO_THREADS', 32)
+"""
+The number of threads (per worker process) the async (aiohttp) server uses to run the Flask views and cache lookups.
+Requests waiting on Reverse DNS don't hold a thread, so this can be much lower than the number of concurrent requests
+- see :mod:`myip.aioapp`
+"""
+
+METRICS_ENABLED = env_bool('METRICS_ENABLED', True)
+"""Collect Prometheus metrics, and serve them at ``METRICS_PATH`` (requires the ``prometheus_client`` package) - see :mod:`myip.metrics`"""
+METRICS_PATH = env('METRICS_PATH', '/metrics')
+"""The URL path which the Prometheus metrics are served at"""
+METRICS_ALLOW = env_csv('METRICS_ALLOW', ['127.0.0.1', '::1'])
+"""
+IP addresses / networks (e.g. ``10.0.0.0/8``) which are allowed to read the metrics, or ``*`` to allow anyone. The client
+IP is taken from ``IP_HEADER`` when ``USE_IP_HEADER`` is enabled and the header is present, otherwise from the connection.
+"""
+METRICS_TOKEN = env('METRICS_TOKEN', '')
+"""
+If set, clients sending ``Authorization: Bearer <METRICS_TOKEN>`` may read the metrics from any IP address
+(e.g. a Prometheus server configured with ``authorization: {credentials: ...}``)
+"""
+STATUS_PATH = env('STATUS_PATH', '/status')
+"""
+The URL path of the ops status endpoint (GeoIP database builds + cache key epoch, cache and reverse index stats), or
+empty to disable it. Only served to the same clients as the metrics - see ``METRICS_ALLOW`` / ``METRICS_TOKEN``.
+"""
+METRICS_DIR = env('METRICS_DIR', env('PROMETHEUS_MULTIPROC_DIR', ''))
+"""
+A directory shared by every worker process, which the metrics are written to - so that a scrape returns the totals
+for every gunicorn worker, instead of just the worker which served it. Must be emptied before the server (re)starts,
+which ``run.sh`` / ``dkr/init.sh`` do. Leave empty for a single process (e.g. the development server).
+"""
+METRICS_DIR = Path(METRICS_DIR).expanduser().resolve() if not empty(METRICS_DIR) else None
+
 pvx_settings.REDIS_HOST = REDIS_HOST = env('REDIS_HOST', 'localhost')
 pvx_settings.REDIS_PORT = REDIS_PORT = int(env('REDIS_PORT', 6379))
 pvx_settings.REDIS_DB = REDIS_DB = int(env('REDIS_DB', 0))
 
+if CACHE_TIMEOUT > 0:
+    # Passed through to redis.Redis / pylibmc.Client by privex.helpers.plugin when they're connected
+    pvx_settings.REDIS_SOCKET_TIMEOUT = pvx_settings.REDIS_SOCKET_CONNECT_TIMEOUT = CACHE_TIMEOUT
+    try:
+        # Don't retry failed commands - newer redis-py versions retry 3 times with a backoff of up to 10 seconds,
+        # leaving the circuit breaker (myip.cache.CircuitBreakerCache) to deal with a failing server instead
+        from redis.backoff import NoBackoff
+        from redis.retry import Retry
+        pvx_settings.REDIS_RETRY = Retry(NoBackoff(), 0)
+    except ImportError:
+        pass
+    pvx_settings.MEMCACHED_BEHAVIORS = dict(
+        connect_timeout=int(CACHE_TIMEOUT * 1000), _poll_timeout=int(CACHE_TIMEOUT * 1000),
+        send_timeout=int(CACHE_TIMEOUT * 1000000), receive_timeout=int(CACHE_TIMEOUT * 1000000),
+    )
+
 #######################################
 #
 # Logging configuration
@@ -216,3 +465,31 @@ if not LOG_DIR.exists():
     LOG_DIR.mkdir(parents=True, exist_ok=True)
 
 DBG_LOG, ERR_LOG = str(LOG_DIR / 'debug.log'), str(LOG_DIR / 'error.log')
+
+#######################################
+#
+# Request profiling (see myip/profiling.py)
+#
+#######################################
+
+PROFILE_SECRET = env('PROFILE_SECRET', '')
+"""
+When set, requests sending this secret in the ``PROFILE_HEADER`` header are profiled, and the report's file name
+is returned in the ``X-Profile-Report`` header. Leave empty (the default) to disable on-demand profiling.
+"""
+PROFILE_HEADER = env('PROFILE_HEADER', 'X-Profile')
+"""The request header which must contain ``PROFILE_SECRET`` for a request to be profiled on-demand"""
+PROFILE_SAMPLE_EVERY = env_int('PROFILE_SAMPLE_EVERY', 0)
+"""Profile every N'th request to the lookup views (per worker process), writing the reports to ``PROFILE_DIR``. ``0`` disables sampling"""
+PROFILE_MODE = env('PROFILE_MODE', 'collapsed').lower()
+"""
+``collapsed`` - sample the request's stack every ``PROFILE_INTERVAL`` seconds, writing collapsed stacks for flame graphs,
+or ``cprofile`` - run the request under :mod:`cProfile`, writing a ``.prof`` stats file (slower, but exact call counts)
+"""
+PROFILE_INTERVAL = float(env('PROFILE_INTERVAL', 0.001))
+"""Seconds between each stack sample in ``collapsed`` mode"""
+PROFILE_DIR = Path(env('PROFILE_DIR', str(LOG_DIR / 'profiles'))).expanduser()
+PROFILE_DIR = BASE_DIR / str(PROFILE_DIR) if not PROFILE_DIR.is_absolute() else PROFILE_DIR.resolve()
+"""The folder profiling reports are written to - relative to the myip app, or absolute. Default: ``<LOG_DIR>/profiles``"""
+PROFILE_KEEP = env_int('PROFILE_KEEP', 500)
+"""The maximum number of reports kept in ``PROFILE_DIR`` - the oldest are deleted once there's more. ``0`` keeps them all"""
@@ -0,0 +1,332 @@
+"""
+A cache adapter shared by every worker process on a host, held in a memory-mapped file (under ``/dev/shm`` by default) -
+so without Redis / Memcached, gunicorn workers still share one warm cache, instead of each keeping their own copy
+in a :class:`privex.helpers.cache.MemoryCache`. No daemon is needed, and the cache survives restarts.
+
+The file is a fixed-capacity, set-associative hash table::
+
+    header   64 bytes   magic, layout version, ways, buckets, slot size
+    buckets  ...        ``buckets`` x (64 byte bucket header + ``ways`` slots of ``slot_size`` bytes)
+
+Each bucket header holds a 32-bit tag (the CRC32 of the key, 0 = empty) and a last-used time for each of it's slots,
+and each slot holds ``seq`` (a sequence lock), the expiry time, a CRC32 of the entry, then the key and pickled value.
+A key can only live in one bucket (``crc32(key) % buckets``), so reads / writes check at most ``ways`` slots.
+
+**Reads are lock-free** - a reader finds the slot whose tag matches, and copies it out between two reads of ``seq``
+(odd while a write is in progress), retrying if a write happened in between. The entry's CRC and key are checked too,
+so a torn read is never returned. **Writes lock just their bucket** - a thread lock plus an ``fcntl`` byte-range lock
+on the bucket header, so writers in other processes only wait for each other when they hit the same bucket (and
+a worker dying mid-write can't leave a bucket locked).
+
+When a bucket is full, a write replaces an expired slot, or else the least recently used one (last-used times are
+updated on reads at most once a second per slot, rather than on every read). Values which don't fit in a slot aren't cached.
+
+Copyright::
+
+    +===================================================+
+    |                 © 2021 Privex Inc.                |
+    |               https://www.privex.io               |
+    +===================================================+
+    |                                                   |
+    |        IP Address Information Tool                |
+    |                                                   |
+    |        Core Developer(s):                         |
+    |                                                   |
+    |          (+)  Chris (@someguy123) [Privex]        |
+    |                                                   |
+    +===================================================+
+
+
+"""
+import logging
+import mmap
+import os
+import pickle
+import random
+import struct
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Union
+
+from privex.helpers import CacheAdapter, DictObject, empty
+from privex.helpers.exceptions import CacheNotFound
+from privex.helpers.settings import DEFAULT_CACHE_TIMEOUT
+
+from myip import settings
+
+try:
+    import fcntl
+except ImportError:     # Not on Windows - writers are then only locked against other threads
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'MYIPSHM1'
+LAYOUT_VERSION = 1
+
+_HEADER = struct.Struct('<8sIIII')
+_HEADER_SIZE = 64
+_BUCKET_HEAD = 64
+_SLOT = struct.Struct('<IdIHH')
+"""seq, expires (UNIX time, 0 = never), crc32(expires + key + value), key length, value length"""
+_U32 = struct.Struct('<I')
+_EXPIRES = struct.Struct('<d')
+_THREAD_LOCKS = 64
+_TICKS = 1024
+"""Last-used times are in 1/1024ths of a second, wrapping every ~48 days (they're only compared as ages)"""
+_MISSING = object()
+
+
+def _clock(now: float) -> int:
+    return int(now * _TICKS) & 0xFFFFFFFF
+
+
+def default_path() -> Path:
+    """``/dev/shm/myip-cache-<PORT>`` if ``/dev/shm`` exists (Linux), otherwise ``<LOG_DIR>/myip-cache-<PORT>.shm``"""
+    if os.path.isdir('/dev/shm'):
+        return Path(f'/dev/shm/myip-cache-{settings.PORT}')
+    return Path(settings.LOG_DIR) / f'myip-cache-{settings.PORT}.shm'
+
+
+class SharedMemoryCache(CacheAdapter):
+    """
+    A cache adapter backed by a fixed-capacity hash table in a memory-mapped file (see the module docstring), which every
+    process opening the same ``path`` shares. Values are pickled, and must fit in a slot (``slot_size`` bytes, including
+    the key and a 20 byte slot header) - larger values aren't cached.
+
+        >>> c = SharedMemoryCache('/dev/shm/myip-example', slots=1024, slot_size=256)
+        >>> c.set('geoip:1.2.3.4', b'...', 600)
+        >>> c.get('geoip:1.2.3.4')      # ...from any process which opened /dev/shm/myip-example
+        b'...'
+
+    The file is created (readable only by the current user, as values are unpickled) the first time it's opened. If it
+    exists with a different layout (e.g. ``SHM_CACHE_SLOTS`` was changed), it's replaced with a new, empty file.
+    """
+    METRICS_TIER = 'shm'
+
+    def __init__(self, path: Union[str, Path] = None, slots: int = None, slot_size: int = None, ways: int = 8, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        path = settings.SHM_CACHE_PATH if path is None else path
+        self.path = default_path() if empty(path) else Path(path)
+        slots = settings.SHM_CACHE_SLOTS if slots is None else int(slots)
+        self.ways = int(ways)
+        self.buckets = max(1, -(-slots // self.ways))
+        self.slot_size = settings.SHM_CACHE_SLOT_SIZE if slot_size is None else int(slot_size)
+        if self.slot_size <= _SLOT.size or self.ways * 8 > _BUCKET_HEAD:
+            raise ValueError(f"Invalid shared memory cache layout (slot_size={self.slot_size}, ways={self.ways})")
+        self.bucket_size = _BUCKET_HEAD + self.ways * self.slot_size
+        self.size = _HEADER_SIZE + self.buckets * self.bucket_size
+        self._tags = struct.Struct(f'<{self.ways}I')
+        self._tlocks = [threading.Lock() for _ in range(_THREAD_LOCKS)]
+        self.hits, self.misses, self.expirations, self.evictions, self.too_large = 0, 0, 0, 0, 0
+        self.fd, self.mm = self._open()
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        header = _HEADER.pack(MAGIC, LAYOUT_VERSION, self.ways, self.buckets, self.slot_size)
+        for _ in range(5):
+            fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                st = os.fstat(fd)
+                if st.st_uid != os.getuid():
+                    raise PermissionError(f"Shared memory cache {self.path} is owned by another user (uid {st.st_uid})")
+                with self._file_lock(fd, 0, _HEADER_SIZE):
+                    if not self._is_current(st):
+                        # Another process replaced the file while we were waiting for the lock - open the new one
+                        os.close(fd)
+                        continue
+                    current = os.pread(fd, _HEADER.size, 0)
+                    if current == header and os.fstat(fd).st_size == self.size:
+                        return fd, mmap.mmap(fd, self.size)
+                    if os.fstat(fd).st_size == 0:
+                        os.ftruncate(fd, self.size)
+                        os.pwrite(fd, header, 0)
+                        log.info("Created shared memory cache %s (%d buckets x %d slots of %d bytes)", self.path,
+                                 self.buckets, self.ways, self.slot_size)
+                        return fd, mmap.mmap(fd, self.size)
+                    # A different layout - workers which still have the old file mapped keep using it until they restart
+                    log.warning("Replacing shared memory cache %s, which has a different layout", self.path)
+                    os.unlink(str(self.path))
+            except BaseException:
+                os.close(fd)
+                raise
+            os.close(fd)
+        raise OSError(f"Couldn't open shared memory cache {self.path}")
+
+    def _is_current(self, st: os.stat_result) -> bool:
+        try:
+            return os.stat(str(self.path)).st_ino == st.st_ino
+        except FileNotFoundError:
+            return False
+
+    @staticmethod
+    @contextmanager
+    def _file_lock(fd: int, start: int, length: int):
+        if fcntl is None:
+            yield
+            return
+        fcntl.lockf(fd, fcntl.LOCK_EX, length, start)
+        try:
+            yield
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, length, start)
+
+    @contextmanager
+    def _locked(self, bucket: int, boff: int):
+        with self._tlocks[bucket % _THREAD_LOCKS]:
+            with self._file_lock(self.fd, boff, 1):
+                yield
+
+    def _bucket(self, kb: bytes):
+        h = zlib.crc32(kb) or 1
+        bucket = h % self.buckets
+        return h, bucket, _HEADER_SIZE + bucket * self.bucket_size
+
+    def _read(self, off: int, kb: bytes) -> Any:
+        """The entry for ``kb`` in the slot at ``off`` as ``(expires, value bytes)``, or ``None`` if it isn't there"""
+        mm = self.mm
+        for _ in range(8):
+            seq, expires, crc, klen, vlen = _SLOT.unpack_from(mm, off)
+            if seq & 1:
+                time.sleep(0)
+                continue
+            data = mm[off + _SLOT.size:off + _SLOT.size + klen + vlen]
+            if _U32.unpack_from(mm, off)[0] != seq:
+                continue
+            if klen != len(kb) or zlib.crc32(data, zlib.crc32(_EXPIRES.pack(expires))) != crc or data[:klen] != kb:
+                return None
+            return expires, data[klen:]
+        return None
+
+    def _find(self, kb: bytes, h: int, boff: int):
+        """``(way, expires, value bytes)`` for ``kb`` in the bucket at ``boff``, or ``None``"""
+        for way, tag in enumerate(self._tags.unpack_from(self.mm, boff)):
+            if tag != h:
+                continue
+            entry = self._read(boff + _BUCKET_HEAD + way * self.slot_size, kb)
+            if entry is not None:
+                return (way,) + entry
+        return None
+
+    def get(self, key: str, default: Any = None, fail: bool = False) -> Any:
+        kb = str(key).encode('utf-8')
+        h, _, boff = self._bucket(kb)
+        found, now = self._find(kb, h, boff), time.time()
+        if found is None or (found[1] and found[1] <= now):
+            if found is not None: self.expirations += 1
+            self.misses += 1
+            if fail: raise CacheNotFound(f'Cache key "{key}" was not found.')
+            return default
+        way, _, raw = found
+        self.hits += 1
+        stamp_off, clock = boff + self.ways * 4 + way * 4, _clock(now)
+        if (clock - _U32.unpack_from(self.mm, stamp_off)[0]) & 0xFFFFFFFF >= _TICKS:
+            _U32.pack_into(self.mm, stamp_off, clock)
+        return pickle.loads(raw)
+
+    def _choose(self, kb: bytes, h: int, boff: int, now: float) -> int:
+        """The slot to write ``kb`` into - it's current slot, an empty / expired one, or the least recently used"""
+        mm, tags = self.mm, self._tags.unpack_from(self.mm, boff)
+        found = self._find(kb, h, boff)
+        if found is not None:
+            return found[0]
+        if 0 in tags:
+            return tags.index(0)
+        for way in range(self.ways):
+            expires = _SLOT.unpack_from(mm, boff + _BUCKET_HEAD + way * self.slot_size)[1]
+            if expires and expires <= now:
+                return way
+        clock = _clock(now)
+        ages = [(clock - s) & 0xFFFFFFFF for s in self._tags.unpack_from(mm, boff + self.ways * 4)]
+        oldest = max(ages)
+        self.evictions += 1
+        return random.choice([way for way, age in enumerate(ages) if age == oldest])
+
+    def _write(self, boff: int, way: int, tag: int, stamp: int, body: bytes):
+        """Replace the slot ``way`` of the bucket at ``boff`` - ``body`` is everything after ``seq`` (must hold the lock)"""
+        mm, off = self.mm, boff + _BUCKET_HEAD + way * self.slot_size
+        seq = _U32.unpack_from(mm, off)[0]
+        seq = seq if seq & 1 else (seq + 1) & 0xFFFFFFFF     # odd = write in progress
+        _U32.pack_into(mm, off, seq)
+        mm[off + 4:off + 4 + len(body)] = body
+        _U32.pack_into(mm, boff + way * 4, tag)
+        _U32.pack_into(mm, boff + self.ways * 4 + way * 4, stamp)
+        _U32.pack_into(mm, off, (seq + 1) & 0xFFFFFFFF)
+
+    def set(self, key: str, value: Any, timeout: Optional[int] = DEFAULT_CACHE_TIMEOUT):
+        kb, vb = str(key).encode('utf-8'), pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if _SLOT.size + len(kb) + len(vb) > self.slot_size:
+            self.too_large += 1
+            self.remove(key)
+            return value
+        h, bucket, boff = self._bucket(kb)
+        now = time.time()
+        expires = now + timeout if timeout else 0.0
+        crc = zlib.crc32(kb + vb, zlib.crc32(_EXPIRES.pack(expires)))
+        body = _SLOT.pack(0, expires, crc, len(kb), len(vb))[4:] + kb + vb
+        with self._locked(bucket, boff):
+            self._write(boff, self._choose(kb, h, boff, now), h, _clock(now), body)
+        return value
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        res = {}
+        for k in keys:
+            val = self.get(k, _MISSING)
+            if val is not _MISSING: res[str(k)] = val
+        return res
+
+    def set_many(self, values: Dict[str, Any], timeout: Optional[int] = DEFAULT_CACHE_TIMEOUT):
+        for k, v in values.items():
+            self.set(k, v, timeout)
+
+    def remove(self, *key: str) -> bool:
+        removed = False
+        for k in key:
+            kb = str(k).encode('utf-8')
+            h, bucket, boff = self._bucket(kb)
+            with self._locked(bucket, boff):
+                found = self._find(kb, h, boff)
+                if found is not None:
+                    self._write(boff, found[0], 0, 0, _SLOT.pack(0, 0.0, 0, 0, 0)[4:])
+                    removed = True
+        return removed
+
+    def update_timeout(self, key: str, timeout: int = DEFAULT_CACHE_TIMEOUT) -> Any:
+        val = self.get(key, fail=True)
+        self.set(key, val, timeout)
+        return val
+
+    def clear(self):
+        """Empty the whole cache (for every process using it)"""
+        for bucket in range(self.buckets):
+            boff = _HEADER_SIZE + bucket * self.bucket_size
+            with self._locked(bucket, boff):
+                for way in range(self.ways):
+                    self._write(boff, way, 0, 0, _SLOT.pack(0, 0.0, 0, 0, 0)[4:])
+
+    def used(self) -> int:
+        """The number of occupied slots (including expired entries which haven't been replaced yet)"""
+        tags = self._tags
+        return sum(
+            self.ways - tags.unpack_from(self.mm, _HEADER_SIZE + b * self.bucket_size).count(0) for b in range(self.buckets)
+        )
+
+    def close(self, *args, **kwargs):
+        if self.mm is not None:
+            self.mm.close()
+            os.close(self.fd)
+            self.mm = None
+
+    def stats(self) -> DictObject:
+        """This process's hit / miss counters, plus the table's layout and current occupancy (shared by every process)"""
+        return DictObject(
+            path=str(self.path), slots=self.buckets * self.ways, slot_size=self.slot_size, used=self.used(),
+            bytes=self.size, hits=self.hits, misses=self.misses, expirations=self.expirations,
+            evictions=self.evictions, too_large=self.too_large,
+        )
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} {self.path} {self.buckets}x{self.ways} slots of {self.slot_size} bytes>"
@@ -27,5 +27,21 @@ cd "$DIR"
 : ${HOST='127.0.0.1'}
 : ${PORT='5151'}
 : ${GU_WORKERS='4'}    # Number of Gunicorn worker processes
+: ${SERVER_MODE='sync'}  # 'sync' = Flask on sync workers, 'async' = aiohttp workers (see myip/aioapp.py)
+: ${METRICS_DIR="/tmp/myip-metrics-${PORT}"}  # Shared by the workers, so /metrics covers all of them (see myip/metrics.py)
 
-pipenv run gunicorn -b "${HOST}:${PORT}" -w "$GU_WORKERS" wsgi
+# Metrics from a previous run must be cleared, otherwise they'd be added to the new workers' metrics
+if [[ -n "$METRICS_DIR" ]]; then
+    rm -rf "$METRICS_DIR" && mkdir -p "$METRICS_DIR"
+    export METRICS_DIR
+fi
+
+# Build the flag sprite + fingerprinted / pre-compressed static assets (see myip/assets.py) - the old ones keep
+# being served if the build fails
+pipenv run python3 -m myip build-assets || echo "Warning: Failed to build the static assets - using the unbuilt ones."
+
+if [[ "$SERVER_MODE" == "async" ]]; then
+    pipenv run gunicorn -c gunicorn.conf.py -b "${HOST}:${PORT}" -w "$GU_WORKERS" -k aiohttp.GunicornWebWorker myip.aioapp:make_app
+else
+    pipenv run gunicorn -c gunicorn.conf.py -b "${HOST}:${PORT}" -w "$GU_WORKERS" wsgi
+fi
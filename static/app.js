@@ -9,6 +9,9 @@
 
 
 function mkflag(code, country) {
+    if (window.flag_sprite) {
+        return `<i class="myip-flag myip-flag-${code.toLowerCase()}" role="img" aria-label="${country} Flag" title="${country}"></i>`
+    }
     return `<img class="flag" src="/static/flags/${code.toLowerCase()}.gif" alt="${country} Flag" />`
 }
 